@@ -2,62 +2,59 @@ from mesa import Agent, Model
 from mesa.time import RandomActivation
 import numpy as np
 import math
+import tracing
 
-class Node(Agent):
+class Node():
     """ Node: One hardware device used to stake tokens on the network. 
     Each node will create virtual stakers proportional to
-    the number of tokens owned by the node """
-    def __init__(self, unique_id, model, tickets, 
-    failure_percent, death_percent, node_connection_delay,
-    node_mainloop_connection_delay, operator, malicious):
-        super().__init__(unique_id, model)
+    the number of tokens owned by the node.
+    The node state lives in the model's Node_Table; a Node is a thin view of one row of it """
+    def __init__(self, table, unique_id):
+        self.table = table
+        self.model = table.model
+        self.unique_id = unique_id
         self.id = unique_id
         self.type = "node"
-        self.num_tickets = int(tickets)
-        self.ticket_list = []
-        self.connection_status = "not connected" #change later to event - currently used for node failure process
-        self.connection_delay = np.random.randint(0,node_connection_delay) #uniform randomly assigned connection delay step value
-        self.timer = self.model.timer
-        self.node_connection_failure_percent = failure_percent
-        self.node_death_percent = death_percent
-        self.connection_failure = False
-        self.death = False
-        self.dkg_misbehaving = False
-        self.node_operator = operator
-        self.malicious = malicious
-        self.model.newest_id +=1 # increments the model agent ID
 
-    def step(self):
-        #simulate node failure
-        self.connection_failure = np.random.randint(0,100) < self.node_connection_failure_percent
-        self.death = np.random.randint (0,100) < self.node_death_percent
+    @property
+    def num_tickets(self):
+        return int(self.table.tickets[self.id])
 
-        #disconnect the node if failure occurs
-        if (self.connection_failure or self.death) and self.connection_status == "connected":
-            self.node_disconnect()
-        else:
-            if self.connection_delay>0:
-                self.connection_delay -=1
-            else:
-                self.connection_status = "connected"
-                self.model.active_nodes[self.id] = self # add to the active nodes list
+    @property
+    def connection_status(self):
+        return "connected" if self.table.connected[self.id] else "not connected"
 
-    def advance(self):
-        pass
+    @property
+    def connection_delay(self):
+        return int(self.table.connection_delay[self.id])
 
-    def generate_tickets(self):
-        #generates tickets using the uniform distribution
-        self.ticket_list = np.random.random_sample(self.num_tickets)
-        
-    def node_disconnect(self):
-        # disconnect the node from the network; causes it to go through the entire reconnection sequence in the next step
-        self.connection_status = "not connected"
-        try:
-            self.model.active_nodes.pop(self.id) # remove from the active nodes list
-        except: self.model.log.debug("node not in active list")
+    @property
+    def node_connection_failure_percent(self):
+        return self.table.failure_percent[self.id]
 
-        if self.death == False: # does not reset the failure trigger if the death trigger is true
-            self.failure = False
+    @property
+    def node_death_percent(self):
+        return self.table.death_percent[self.id]
+
+    @property
+    def connection_failure(self):
+        return bool(self.table.connection_failure[self.id])
+
+    @property
+    def death(self):
+        return bool(self.table.death[self.id])
+
+    @property
+    def node_operator(self):
+        return int(self.table.operator[self.id])
+
+    @property
+    def malicious(self):
+        return bool(self.table.malicious[self.id])
+
+    def node_disconnect(self):
+        # disconnect the node from the network; it reconnects once its connection delay has run out
+        self.table.disconnect(self.id)
 
 class Signing_Group(Agent):
     """ A Group """
@@ -65,13 +62,18 @@ class Signing_Group(Agent):
         super().__init__(unique_id, model)
         self.id = unique_id
         self.type = "group"
-        self.members = members
+        # members are node ids, one per winning ticket; they are stored sparsely as (node id, seat count)
+        self.member_ids, self.member_counts = np.unique(np.asarray(members, dtype=np.int64), return_counts=True)
+        self.group_size = int(self.member_counts.sum())
+        self.model.nodes.acquire(self.member_ids) # an aggregated node table keeps member nodes materialized
+        self.weight = self.model.lottery.weight # likelihood ratio of the lottery draw, 1 unless the lottery is tilted
+        self.expected_compromise = None # closed-form chance of being compromised, with control variates
+        self.registration_steps = self.model.nodes.steps # node updates so far, when the members were connected
         self.last_signature = "none"
         self.status = "dkg" # status types: dkg, compromised, active, expired
         self.expiry = expiry # of steps before expiration
         self.timer = self.model.timer
         self.model.newest_id +=1
-        self.ownership_distr = []
         self.malicious_percent = 0
         self.offline_percent = 0
         self.compromised_percent = 0
@@ -89,48 +91,67 @@ class Signing_Group(Agent):
                 self.dkg_block_delay -=1 # counts down the block delay
                 # based on DKG process we check for missing/malicious nodes 3 blocks before dkg completes
                 if self.dkg_block_delay == 3:
-                    self.offline_percent = self.calculate_offline()/len(self.members) # calculates % nodes offline during dkg
+                    self.offline_percent = self.calculate_offline()/self.group_size # calculates % nodes offline during dkg
                     self.compromised_percent = self.malicious_percent #+ self.offline_percent
             else:
                 self.status = "active"
                 self.model.active_groups[self.id] = self # add to active groups list
+                if self.model.tracer is not None:
+                    self.model.tracer.record(self.model.timer, tracing.GROUP_ACTIVATED, self.id)
         elif self.status == "active":
             """ At each step check if the group has expired """
             self.calculate_malicious_percent #calculate the current malicious percent
             self.expiry -=1
             if self.expiry <= 0: 
                 self.status = "expired"
-                try:
-                    self.model.active_groups.pop(self.id)
-                except: self.model.log.debug("group not in active list")
+                self.model.finished_agents.append(self)
+                self.model.active_groups.pop(self.id, None) # remove from the active groups list
+                self.model.nodes.release(self.member_ids)
+                if self.model.tracer is not None:
+                    self.model.tracer.record(self.model.timer, tracing.GROUP_EXPIRED, self.id)
 
         
     def advance(self):
         pass
 
+    def next_event(self):
+        """ number of steps until the step that next changes the group state (the next step is 1),
+        None once the group has expired. Used by the event scheduler """
+        if self.status == "dkg":
+            if self.dkg_block_delay >= 4:
+                return self.dkg_block_delay - 3 # offline check 3 blocks before dkg completes
+            return self.dkg_block_delay + 2 # activation, once the delay has counted down past 0
+        elif self.status == "active":
+            return max(self.expiry, 1)
+        return None
+
+    def skip(self, steps):
+        # apply steps that only count down timers
+        if self.status == "dkg":
+            self.dkg_block_delay -= steps
+        elif self.status == "active":
+            self.expiry -= steps
+
+    @property
+    def members(self):
+        # one Node per seat, for code that still expects the member list
+        return [self.model.nodes.view(node_id) for node_id in np.repeat(self.member_ids, self.member_counts)]
+
+    @property
+    def ownership_distr(self):
+        # dense seats-per-node vector over the whole network, built on request
+        return dense_ownership(self.model.num_nodes, self.member_ids, self.member_counts)
+
     def calculate_ownership_distr(self):
-        temp_distr = np.zeros(self.model.num_nodes)
-        temp_malicious_count = 0
-        for node in self.members:    
-            temp_distr[node.id] +=1 # increments by 1 for each node index everytime it exists in the member list, at each step
-            if node.malicious:
-                temp_malicious_count +=1
-        self.malicious_percent = temp_malicious_count/sum(temp_distr)
-        self.ownership_distr = temp_distr
+        self.calculate_malicious_percent()
 
     def calculate_malicious_percent(self):
-        temp_malicious_count = 0
-        for node in self.members:    
-            if node.malicious:
-                temp_malicious_count +=1
-        self.malicious_percent = temp_malicious_count/sum(self.ownership_distr)
+        malicious = self.model.nodes.is_malicious(self.member_ids)
+        self.malicious_percent = self.member_counts[malicious].sum()/self.group_size
 
     def calculate_offline(self):
-        offline_count = 0
-        for node in self.members:
-            if node.connection_status == "not connected": 
-                offline_count +=1
-        return offline_count
+        online = self.model.nodes.is_online(self.member_ids)
+        return int(self.member_counts[~online].sum())
    
 
 class Signature(Agent):
@@ -140,13 +161,18 @@ class Signature(Agent):
         self.id = unique_id
         self.type = "signature"
         self.status = "started"
-        self.delay = np.random.poisson(self.model.signature_delay) #delay between when it is triggered and when it hits the chain
-        self.ownership_distr = []
+        self.delay = self.model.signature_delay_draws.next() #delay between when it is triggered and when it hits the chain
+        self.timer = self.model.timer
+        self.member_ids = np.array([], dtype=np.int64) # group members online when the signature completes
+        self.member_counts = np.array([], dtype=np.int64)
         self.signature_process_complete = False
         self.block_delay_complete = False
         self.lynchpin_percent = 0
         self.offline_percent = 0
         self.operator_lynchpin_percent = 0
+        self.weight = group_object.weight # a signature is as likely as the group it comes from
+        self.expected_failure = None # closed-form chance of failing, with control variates
+        self.model.nodes.acquire(self.group.member_ids) # the group may expire before the signature completes
 
         self.model.newest_id +=1 # increments the model agent ID by 1 after a new signature is created 
 
@@ -163,40 +189,69 @@ class Signature(Agent):
             self.signature_process()
             self.signature_process_complete = True
             self.status = "complete"
+            self.model.metrics.signature_completed(self)
+            self.model.nodes.release(self.group.member_ids)
+            self.model.finished_agents.append(self)
+            if self.model.tracer is not None:
+                self.model.tracer.record(self.model.timer, tracing.SIGNATURE_COMPLETED, self.id, self.group.id)
 
     def advance(self):
         pass
 
-    def signature_process(self):
-        # Calculates ownership data just before the signature is complete
-        temp_signature_distr = np.zeros(self.model.num_nodes)
-
-        for node_id,node_tickets in enumerate(self.group.ownership_distr): # checks if the node has a non-zero ownership, i is the node id
-            if node_tickets > 0:
-                if node_id in self.model.active_nodes:
-                    temp_signature_distr[node_id] = node_tickets
-        self.ownership_distr = temp_signature_distr
-        failed_list = np.array(self.group.ownership_distr)-np.array(self.ownership_distr)
-        self.offline_percent = sum(failed_list)/sum(self.group.ownership_distr)
-        self.lynchpin_percent = (sum(failed_list) + max(self.ownership_distr))/sum(self.group.ownership_distr) # adds the failed node virtual stakers and max node virtual stakers
-        
-        #Calculate lynchpin owner
-        shares_by_staker = {}
-        total_tickets = sum(self.ownership_distr)
-        for node_id,node_tickets in enumerate(self.ownership_distr):
-            if node_id in self.model.active_nodes:
-                try:
-                    shares_by_staker[self.model.active_nodes[node_id].node_owner]+=node_tickets #add tickets to owner shares
-                except:
-                    shares_by_staker.update({self.model.active_nodes[node_id].node_operator : node_tickets})
-                    
-        self.operator_lynchpin_percent = shares_by_staker[max(shares_by_staker)]/total_tickets
+    def next_event(self):
+        """ number of steps until the signature is processed, None once it is complete. Used by the event scheduler """
+        if not self.block_delay_complete:
+            return self.delay + 2 # counts the delay down to 0, flags it complete, then processes
+        elif not self.signature_process_complete:
+            return 1
+        return None
+
+    def skip(self, steps):
+        # apply steps that only count down the delay
+        if not self.block_delay_complete and steps > 0:
+            if steps > self.delay:
+                self.delay = 0
+                self.block_delay_complete = True
+            else:
+                self.delay -= steps
 
-    
+    @property
+    def ownership_distr(self):
+        # dense seats-per-node vector over the whole network, built on request
+        return dense_ownership(self.model.num_nodes, self.member_ids, self.member_counts)
 
+    def signature_process(self):
+        # Calculates ownership data just before the signature is complete
+        group_ids = self.group.member_ids
+        group_counts = self.group.member_counts
+        online = self.model.nodes.is_online(group_ids)
+        self.member_ids = group_ids[online]
+        self.member_counts = group_counts[online]
 
+        total_tickets = self.group.group_size
+        online_tickets = int(self.member_counts.sum())
+        failed_tickets = total_tickets - online_tickets
+        max_node_tickets = self.member_counts.max() if online_tickets > 0 else 0
+        self.offline_percent = failed_tickets/total_tickets
+        self.lynchpin_percent = (failed_tickets + max_node_tickets)/total_tickets # adds the failed node virtual stakers and max node virtual stakers
 
+        if self.model.control_variates:
+            import analysis
+            nodes = self.model.nodes
+            p_offline = analysis.offline_probability(nodes.failure_percent[group_ids], nodes.death_percent[group_ids],
+            nodes.steps - self.group.registration_steps)
+            self.expected_failure = analysis.sigfail_probability(group_counts, p_offline, total_tickets, self.model.failed_signature_threshold)
 
+        #Calculate lynchpin owner: the largest share of the online seats held by a single operator
+        if online_tickets > 0:
+            _, operator_index = np.unique(self.model.nodes.operator_of(self.member_ids), return_inverse=True)
+            shares_by_operator = np.bincount(operator_index, weights=self.member_counts)
+            self.operator_lynchpin_percent = shares_by_operator.max()/online_tickets
+        else:
+            self.operator_lynchpin_percent = 0
 
-        
 
+def dense_ownership(num_nodes, member_ids, member_counts):
+    distr = np.zeros(num_nodes)
+    distr[member_ids] = member_counts
+    return distr
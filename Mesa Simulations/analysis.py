@@ -1,4 +1,5 @@
 from math import floor
+from collections import OrderedDict
 import numpy as np
 from scipy import stats
 
@@ -173,3 +174,426 @@ class Beacon_Analysis():
                 p_lynchpinned += prob
 
         return p_lynchpinned
+
+
+class Beacon_Analysis_Grid():
+    """Analytical solutions for a whole grid of parameter sets at once.
+
+    Takes the same parameters as Beacon_Analysis, as arrays that are broadcast
+    against each other; every result has the broadcast shape. The pmfs are shared
+    between grid points with the same group size; the PMF_CACHE_SIZE most recently
+    used ones are cached across calls.
+
+    compromised and lynchpinned agree with Beacon_Analysis to about 1e-13 relative.
+    sigfail only agrees to within absolute rounding (about 2e-15): Beacon_Analysis
+    takes it from rv_discrete.sf, i.e. 1 - cdf, which loses the relative precision of
+    small tails (2.7e-8 relative at 1e-8..1e-5, 1e-5 at 1e-11..1e-8, worse below).
+    The reverse tail sums here match scipy.stats.binom.sf to about 2e-14 relative
+    at every magnitude."""
+    def __init__(
+            self,
+            virtual_stakers,
+            adversary_power,
+            group_size,
+            bls_threshold,
+            node_failure_probability,
+            node_death_probability
+    ):
+        arrays = np.broadcast_arrays(
+            np.asarray(virtual_stakers), np.asarray(adversary_power),
+            np.asarray(group_size), np.asarray(bls_threshold),
+            np.asarray(node_failure_probability, dtype=float),
+            np.asarray(node_death_probability, dtype=float))
+        self.shape = arrays[0].shape
+
+        self.virtual_stakers = arrays[0].ravel().astype(np.int64)
+        self.malicious_virtual_stakers = np.floor(
+            self.virtual_stakers * arrays[1].ravel()).astype(np.int64)
+        self.group_size = arrays[2].ravel().astype(np.int64)
+        self.compromise_threshold = arrays[3].ravel().astype(np.int64)
+        self.shares_required = self.compromise_threshold + 1
+        self.failure_threshold = self.group_size - self.shares_required
+
+        # a member is inactive if it died or, having survived, is offline,
+        # so the dead/offline convolution of Beacon_Analysis.inactive()
+        # collapses to a single binomial with this per-member probability
+        p_failure = arrays[4].ravel()
+        p_death = arrays[5].ravel()
+        self.p_inactive = p_death + (1 - p_death) * p_failure
+
+
+    def evaluate(self):
+        # compute all three probabilities, one group size at a time
+        compromised = np.zeros(len(self.group_size))
+        sigfail = np.zeros(len(self.group_size))
+        lynchpinned = np.zeros(len(self.group_size))
+
+        for g in np.unique(self.group_size):
+            rows = np.flatnonzero(self.group_size == g)
+
+            # survival functions sf[k] = P(n > k), by reverse cumulative sums
+            # so that small tail probabilities keep their precision
+            malicious_sf = tail_sums(malicious_pmfs(
+                self.virtual_stakers[rows], self.malicious_virtual_stakers[rows], g))
+            inactive_pmf = inactive_pmfs(self.p_inactive[rows], g)
+            inactive_sf = tail_sums(inactive_pmf)
+
+            compromise_threshold = np.clip(self.compromise_threshold[rows], -1, g)
+            failure_threshold = np.clip(self.failure_threshold[rows], -1, g)
+            row_index = np.arange(len(rows))
+
+            compromised[rows] = sf_at(malicious_sf, row_index, compromise_threshold)
+            sigfail[rows] = sf_at(inactive_sf, row_index, failure_threshold)
+
+            # lynchpinned: n_inactive = i in [0, failure_threshold]
+            # and n_malicious in [failure_threshold + 1 - i, group_size - i]
+            i = np.arange(g + 1)[None, :]
+            f = failure_threshold[:, None]
+            p_malicious = (sf_at(malicious_sf, row_index[:, None], f - i)
+                           - sf_at(malicious_sf, row_index[:, None], g - i))
+            lynchpinned[rows] = np.sum(
+                np.where(i <= f, inactive_pmf * p_malicious, 0), axis=1)
+
+        return {"compromised": compromised.reshape(self.shape),
+                "sigfail": sigfail.reshape(self.shape),
+                "lynchpinned": lynchpinned.reshape(self.shape)}
+
+
+    def compromised(self):
+        return self.evaluate()["compromised"]
+
+
+    def sigfail(self):
+        return self.evaluate()["sigfail"]
+
+
+    def lynchpinned(self):
+        return self.evaluate()["lynchpinned"]
+
+
+# pmfs already computed, shared across grid points and across calls;
+# least recently used pmfs are dropped past PMF_CACHE_SIZE per cache,
+# so sweeps over continuous probabilities do not grow them without bound
+PMF_CACHE_SIZE = 2**14
+_malicious_pmf_cache = OrderedDict()
+_inactive_pmf_cache = OrderedDict()
+
+
+def cached_pmfs(cache, keys, compute):
+    # the pmf of every key, computing the missing ones in one batch
+    found = {}
+    missing = []
+    for key in set(keys):
+        if key in cache:
+            cache.move_to_end(key)
+            found[key] = cache[key]
+        else:
+            missing.append(key)
+    if missing:
+        missing.sort()
+        for key, pmf in zip(missing, compute(missing)):
+            found[key] = pmf
+            cache[key] = pmf
+        while len(cache) > PMF_CACHE_SIZE:
+            cache.popitem(last=False)
+    return np.array([found[key] for key in keys])
+
+
+def malicious_pmfs(virtual_stakers, malicious_virtual_stakers, group_size):
+    # one hypergeometric pmf over [0, group_size] per row
+    keys = [(nv, mv, group_size) for nv, mv
+            in zip(virtual_stakers.tolist(), malicious_virtual_stakers.tolist())]
+
+    def compute(missing):
+        nv = np.array([key[0] for key in missing])[:, None]
+        mv = np.array([key[1] for key in missing])[:, None]
+        return stats.hypergeom.pmf(np.arange(group_size + 1)[None, :], nv, mv, group_size)
+
+    return cached_pmfs(_malicious_pmf_cache, keys, compute)
+
+
+def inactive_pmfs(p_inactive, group_size):
+    # one binomial pmf over [0, group_size] per row
+    keys = [(p, group_size) for p in p_inactive.tolist()]
+
+    def compute(missing):
+        p = np.array([key[0] for key in missing])[:, None]
+        return stats.binom.pmf(np.arange(group_size + 1)[None, :], group_size, p)
+
+    return cached_pmfs(_inactive_pmf_cache, keys, compute)
+
+
+def tail_sums(pmfs):
+    # sf[:, k] = sum of pmf[:, k + 1:], with a zero column appended for k = group_size
+    reverse = np.cumsum(pmfs[:, ::-1], axis=1)[:, ::-1]
+    return np.concatenate([reverse[:, 1:], np.zeros((len(pmfs), 1))], axis=1)
+
+
+def sf_at(sf, rows, k):
+    # P(n > k), which is 1 for k < 0 and 0 for k >= group_size
+    g = sf.shape[1] - 1
+    return np.where(k < 0, 1.0, sf[rows, np.clip(k, 0, g)])
+
+
+class Operator_Analysis():
+    """Exact distribution of the largest number of seats held by a single operator.
+
+    A group is a uniformly random set of group_size distinct tickets, so the seats
+    of the operators are multivariate hypergeometric. The chance that no operator
+    holds more than k of o seats is a coefficient of a product of generating
+    functions, one per operator:
+
+        P(max <= k | o seats) = [z^o] prod_i sum_{x <= k} C(T_i, x) z^x / C(T, o)
+
+    All operators with at most k tickets collapse into one factor (1 + z)^T_U.
+    The product is built once per k and gives every o at the same time.
+    Alongside the product of the truncated factors, the product where at least
+    one operator exceeds k is kept as well. Tails as small as the smallest
+    double come out at full precision instead of as 1 - P(max <= k).
+
+    Offline and dead members are thinned independently per seat, as in
+    Beacon_Analysis.inactive(). The online seats of a group are then a uniformly
+    random set of tickets whose size is binomial, and that set has the same
+    seat distribution.
+
+    With a tolerance > 0, operators whose chance of holding more than k seats
+    is at most tolerance are not tracked for that k. The tail then comes out
+    as bounds: the pruned value, plus the union (Bonferroni) bound on what the
+    pruned operators add."""
+    def __init__(
+            self,
+
+            # tickets (virtual stakers) held by each operator
+            operator_tickets,
+
+            # number of members in a group
+            group_size,
+            # threshold of the BLS signature
+            bls_threshold,
+
+            # fraction of nodes that are offline at any given moment
+            node_failure_probability,
+            # fraction of nodes that succumb to attrition while group is active
+            node_death_probability,
+
+            # largest chance of exceeding k of an operator left out at k
+            tolerance=0
+    ):
+        operator_tickets = np.asarray(operator_tickets, dtype=np.int64)
+        self.operator_tickets = operator_tickets[operator_tickets > 0]
+        self.virtual_stakers = int(self.operator_tickets.sum())
+        self.group_size = group_size
+        if self.virtual_stakers < group_size:
+            raise ValueError("fewer tickets than seats in a group")
+
+        self.shares_required = bls_threshold + 1
+        self.compromise_threshold = bls_threshold
+        self.failure_threshold = group_size - self.shares_required
+
+        self.p_failure = node_failure_probability
+        self.p_death = node_death_probability
+        self.p_inactive = node_death_probability + (1 - node_death_probability) * node_failure_probability
+        self.tolerance = tolerance
+
+        self.below = None
+        self.above = None
+        self.error = None
+
+
+    def g_range(self):
+        return np.arange(self.group_size + 1)
+
+
+    def evaluate(self):
+        # below[o, k] = P(max <= k | o seats), above[o, k] = P(max > k | o seats)
+        # error[k] bounds what the pruned operators add to above[:, k]
+        if self.below is not None:
+            return self.below, self.above, self.error
+        g = self.group_size
+        # coefficients are scaled by (g/T)^x, which keeps them near 1 for any total stake
+        scale = g / self.virtual_stakers
+        normalizer = scaled_binomials(np.array([self.virtual_stakers]), g, scale)[0]
+
+        tickets, counts = np.unique(self.operator_tickets, return_counts=True)
+        factors = scaled_binomials(tickets, g, scale)
+        exceeding = operator_tails(tickets, factors, self.virtual_stakers, g, scale, normalizer[g])
+
+        below = np.zeros((g + 1, g + 1))
+        above = np.zeros((g + 1, g + 1))
+        error = np.zeros(g + 1)
+        for k in range(g + 1):
+            # operators that can hold more than k seats and are likely enough to
+            pruned = exceeding[:, k] <= self.tolerance
+            tracked = (tickets > k) & ~pruned
+            error[k] = np.sum(counts[(tickets > k) & pruned] * exceeding[(tickets > k) & pruned, k])
+
+            collapsed = int(np.sum(tickets[~tracked] * counts[~tracked]))
+            state = (scaled_binomials(np.array([collapsed]), g, scale)[0], np.zeros(g + 1))
+            for row in np.flatnonzero(tracked):
+                factor = (np.where(self.g_range() <= k, factors[row], 0),
+                          np.where(self.g_range() > k, factors[row], 0))
+                state = combine(state, factor_power(factor, counts[row], g), g)
+
+            below[:, k] = state[0] / normalizer
+            above[:, k] = state[1] / normalizer
+
+        self.below, self.above, self.error = below, above, error
+        return below, above, error
+
+
+    def tail(self, o, k):
+        # (lower, upper) bounds of P(max > k | o seats), equal without pruning
+        below, above, error = self.evaluate()
+        if k < 0:
+            return 1.0, 1.0
+        if k >= o:
+            return 0.0, 0.0
+        return float(above[o, k]), float(min(1.0, above[o, k] + error[k]))
+
+
+    def max_seats(self):
+        # pmf of the most seats held by one operator in a group
+        below = self.evaluate()[0][self.group_size]
+        return np.diff(np.concatenate([[0], below]))
+
+
+    def online(self):
+        # pmf of the number of online seats at signing time
+        dist = stats.binom(self.group_size, 1 - self.p_inactive)
+
+        return dist.pmf(self.g_range())
+
+
+    def max_online_seats(self):
+        # pmf of the most online seats held by one operator when a signature is produced
+        below = self.evaluate()[0]
+        pmfs = np.diff(np.concatenate([np.zeros((self.group_size + 1, 1)), below], axis=1), axis=1)
+
+        return self.online() @ pmfs
+
+
+    def compromised(self, bounds=False):
+        # A single operator can produce a signature on its own
+        # if it holds more seats than the threshold:
+        #
+        #     max_seats > compromise_threshold
+        #
+        lower, upper = self.tail(self.group_size, self.compromise_threshold)
+
+        return (lower, upper) if bounds else lower
+
+
+    def lynchpinned(self, bounds=False):
+        # A signature is lynchpinned by an operator if it can be produced,
+        # but not without that operator's online seats.
+        # With o online seats:
+        #
+        #     o >= shares_required
+        #     o - max_online_seats < shares_required
+        #
+        # so the operator needs more than o - shares_required online seats
+        pmf_online = self.online()
+
+        lower = 0
+        upper = 0
+        for n_online in range(self.shares_required, self.group_size + 1):
+            tail_lower, tail_upper = self.tail(n_online, n_online - self.shares_required)
+            lower += pmf_online[n_online] * tail_lower
+            upper += pmf_online[n_online] * tail_upper
+
+        lower = float(lower)
+        upper = float(min(upper, 1.0))
+
+        return (lower, upper) if bounds else lower
+
+
+def operator_tickets(stake_distribution, min_stake_amount, operator_mode):
+    # tickets held by each owner, over all of its nodes, as the model creates them
+    import node_table
+    nodes, tickets = node_table.owner_nodes(stake_distribution, min_stake_amount, operator_mode)
+    return nodes * tickets
+
+
+def scaled_binomials(tickets, degree, scale):
+    # C(T, x) * scale^x for x in [0, degree], one row per ticket count,
+    # by a running product so that huge T keeps its precision
+    x = np.arange(1, degree + 1)
+    ratios = (tickets[:, None] - x[None, :] + 1).astype(float) * scale / x[None, :]
+    ratios = np.maximum(ratios, 0)
+    return np.concatenate([np.ones((len(tickets), 1)), np.cumprod(ratios, axis=1)], axis=1)
+
+
+def operator_tails(tickets, factors, virtual_stakers, degree, scale, normalizer):
+    # P(an operator holds more than k seats of a whole group), one row per ticket count:
+    # its seats are hypergeometric, C(T_i, x) C(T - T_i, g - x) / C(T, g)
+    rest = scaled_binomials(virtual_stakers - tickets, degree, scale)
+    pmfs = factors * rest[:, ::-1] / normalizer
+    reverse = np.cumsum(pmfs[:, ::-1], axis=1)[:, ::-1]
+    return np.concatenate([reverse[:, 1:], np.zeros((len(tickets), 1))], axis=1)
+
+
+def combine(first, second, degree):
+    # product of two (no operator above k, some operator above k) pairs of generating functions;
+    # every term is a sum of products of nonnegative coefficients
+    first_below, first_above = first
+    second_below, second_above = second
+    return (np.convolve(first_below, second_below)[0:degree + 1],
+            np.convolve(first_below, second_above)[0:degree + 1]
+            + np.convolve(first_above, second_below + second_above)[0:degree + 1])
+
+
+def factor_power(factor, count, degree):
+    # the pair of count identical operators, by repeated squaring
+    result = None
+    while count:
+        if count & 1:
+            result = factor if result is None else combine(result, factor, degree)
+        count >>= 1
+        if count:
+            factor = combine(factor, factor, degree)
+    return result
+
+
+# Closed-form chances of the model's events given what the model knows when a group
+# is registered or a signature is processed. Beacon_Analysis.compromised() for the
+# candidate tickets, and Beacon_Analysis.sigfail() for the group's actual nodes. The
+# simulated outcome minus its conditional chance has mean zero, which makes these
+# exact control variates for the model's compromised group and failed signature rates.
+
+
+def compromise_probability(total_tickets, malicious_tickets, group_size, threshold):
+    # P(malicious seats / group_size >= threshold) for a uniformly random group of
+    # group_size tickets, the comparison the model makes for a compromised group
+    import selection
+    group_size = min(group_size, total_tickets)
+    pmf = selection.hypergeometric_pmf(total_tickets, malicious_tickets, group_size)
+
+    return float(pmf[np.arange(group_size + 1) / group_size >= threshold].sum())
+
+
+def offline_probability(failure_percent, death_percent, steps):
+    # chance that a node connected steps node updates ago is offline now:
+    # a connected node disconnects with probability q per update and
+    # reconnects on the next one, so starting online
+    #
+    #     P(offline) = q / (1 + q) * (1 - (-q)^steps)
+    #
+    q = 1 - ((1 - np.clip(np.ceil(failure_percent), 0, 100) / 100)
+             * (1 - np.clip(np.ceil(death_percent), 0, 100) / 100))
+
+    return q / (1 + q) * (1 - (-q) ** steps)
+
+
+def sigfail_probability(seat_counts, p_offline, group_size, threshold):
+    # P(offline seats / group_size >= threshold) when each node holding
+    # seat_counts[j] seats is offline independently with p_offline[j];
+    # unlike Beacon_Analysis.inactive(), the seats of one node fail together
+    pmf_offline = np.zeros(group_size + 1)
+    pmf_offline[0] = 1
+
+    for seats, p in zip(np.asarray(seat_counts).tolist(), np.asarray(p_offline).tolist()):
+        shifted = np.zeros(group_size + 1)
+        shifted[seats:] = pmf_offline[0:group_size + 1 - seats]
+        pmf_offline = (1 - p) * pmf_offline + p * shifted
+
+    return float(pmf_offline[np.arange(group_size + 1) / group_size >= threshold].sum())
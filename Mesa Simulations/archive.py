@@ -0,0 +1,98 @@
+import numpy as np
+
+class Archive_Table():
+    """ Append-only columnar table. Each column is a NumPy array grown by doubling,
+    so appending a row is amortized O(1) and a column can be read without copying """
+    def __init__(self, columns, capacity = 1024):
+        self.columns = dict(columns) # column name -> dtype
+        self.size = 0
+        self.data = {name : np.zeros(capacity, dtype=dtype) for name, dtype in self.columns.items()}
+
+    def __len__(self):
+        return self.size
+
+    def append(self, row):
+        if self.size == len(next(iter(self.data.values()))):
+            self.grow()
+        for name in self.columns:
+            self.data[name][self.size] = row[name]
+        self.size += 1
+
+    def grow(self):
+        for name, values in self.data.items():
+            grown = np.zeros(2 * len(values), dtype=values.dtype)
+            grown[0:self.size] = values[0:self.size]
+            self.data[name] = grown
+
+    def column(self, name):
+        return self.data[name][0:self.size]
+
+    def to_dict(self):
+        return {name : self.column(name) for name in self.columns}
+
+    def to_dataframe(self):
+        import pandas as pd
+        return pd.DataFrame(self.to_dict())
+
+
+class Agent_Archive():
+    """ Final attributes of every group and signature that has been retired from the schedule """
+    group_columns = {"id" : np.int64,
+    "status" : "U10",
+    "malicious_percent" : float,
+    "offline_percent" : float,
+    "creation_block" : np.int64,
+    "finish_block" : np.int64,
+    "weight" : float}
+
+    signature_columns = {"id" : np.int64,
+    "group_id" : np.int64,
+    "status" : "U10",
+    "offline_percent" : float,
+    "lynchpin_percent" : float,
+    "operator_lynchpin_percent" : float,
+    "creation_block" : np.int64,
+    "finish_block" : np.int64,
+    "weight" : float}
+
+    def __init__(self):
+        self.groups = Archive_Table(self.group_columns)
+        self.signatures = Archive_Table(self.signature_columns)
+
+    def retire(self, agent, block):
+        self.table(agent.type).append(self.agent_row(agent, block))
+
+    def table(self, agent_type):
+        if agent_type == "group":
+            return self.groups
+        elif agent_type == "signature":
+            return self.signatures
+        raise ValueError("no archive table for agent type: " + str(agent_type))
+
+    def agent_row(self, agent, block):
+        if agent.type == "group":
+            return {"id" : agent.id,
+            "status" : agent.status,
+            "malicious_percent" : agent.malicious_percent,
+            "offline_percent" : agent.offline_percent,
+            "creation_block" : agent.timer,
+            "finish_block" : block,
+            "weight" : agent.weight}
+        return {"id" : agent.id,
+        "group_id" : agent.group.id,
+        "status" : agent.status,
+        "offline_percent" : agent.offline_percent,
+        "lynchpin_percent" : agent.lynchpin_percent,
+        "operator_lynchpin_percent" : agent.operator_lynchpin_percent,
+        "creation_block" : agent.timer,
+        "finish_block" : block,
+        "weight" : agent.weight}
+
+    def history(self, agent_type, live_agents = ()):
+        """ dataframe of every archived agent of a type plus the given live ones (finish_block = -1) """
+        import pandas as pd
+        archived = self.table(agent_type).to_dataframe()
+        live = [self.agent_row(agent, -1) for agent in live_agents if agent.type == agent_type]
+        if not live:
+            return archived
+        return pd.concat([archived, pd.DataFrame(live)], ignore_index=True)
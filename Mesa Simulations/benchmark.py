@@ -0,0 +1,308 @@
+""" Offline benchmark suite for Beacon_Model and the simulation_functions helpers.
+
+Every case runs in a fresh process, so its peak RSS is its own. Results are appended
+to a JSON-lines history file and compared against a stored baseline:
+
+    python benchmark.py                      # run the suite, append to the history, compare
+    python benchmark.py --quick              # shorter horizons, no 10000-owner network
+    python benchmark.py --save-baseline      # make this run the new baseline for its cases
+
+The quick and full suites have separate baseline entries in the same file. A run
+whose cases have no baseline entry fails instead of passing unchecked.
+"""
+import os
+import io
+import csv
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import contextlib
+import subprocess
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+HISTORY_PATH = os.path.join(BENCHMARK_DIRECTORY, "benchmark_history.jsonl")
+BASELINE_PATH = os.path.join(BENCHMARK_DIRECTORY, "benchmark_baseline.json")
+
+# model parameters shared by every case, from variables.ascii
+BENCHMARK_PARAMETERS = {"active_group_threshold" : 10,
+"max_malicious_threshold_percent" : 0.2,
+"group_expiry" : 14,
+"node_failure_percent" : 10,
+"node_death_percent" : 5,
+"signature_delay" : 2,
+"min_nodes" : 40,
+"node_connection_delay" : 5,
+"node_mainloop_connection_delay" : 3,
+"run_number" : 0,
+"dkg_block_delay" : 14,
+"compromised_threshold" : 0.3,
+"failed_signature_threshold" : 0.6,
+"min_stake_amount" : 100,
+"malicious_operator_percent" : 0.3}
+
+# the case every sweep dimension is varied around
+BASE_CASE = {"kind" : "model", "distribution" : "synthetic:1000", "operator_mode" : 2, "group_size" : 64, "horizon" : 500}
+
+# functions timed in every model case: (module, class, function)
+TIMED_FUNCTIONS = [("model", "Beacon_Model", "step"),
+("model", "Beacon_Model", "group_registration"),
+("model", "Beacon_Model", "calculate_compromised_groups"),
+("model", "Beacon_Model", "calculate_lynchpinned_signatures"),
+("model", "Beacon_Model", "retire_finished_agents"),
+("node_table", "Node_Table", "step"),
+("selection", "Ticket_Lottery", "select"),
+("agent", "Signing_Group", "step"),
+("agent", "Signature", "step"),
+("agent", "Signature", "signature_process")]
+
+# simulation_functions helpers timed in the Monte Carlo cases
+TIMED_HELPERS = ["preprocess_tickets", "preprocess_groups", "create_cdf", "group_distr"]
+
+
+def default_cases(quick = False):
+    """ one-factor-at-a-time sweep around BASE_CASE over network size and stake data,
+    group_size, operator_mode and horizon, plus the Monte Carlo helpers """
+    scale = 5 if quick else 1
+    base = dict(BASE_CASE, horizon = BASE_CASE["horizon"]//scale)
+    cases = []
+    distributions = ["synthetic:100", "synthetic:1000", "token", "eth"]
+    if not quick:
+        distributions.append("synthetic:10000")
+    for distribution in distributions:
+        cases.append(dict(base, distribution = distribution))
+    for group_size in [16, 256]:
+        cases.append(dict(base, group_size = group_size))
+    cases.append(dict(base, operator_mode = 1))
+    for horizon in [200, 2000]:
+        cases.append(dict(base, horizon = horizon//scale))
+    for distribution in ["synthetic:1000", "token"]:
+        cases.append({"kind" : "monte_carlo", "distribution" : distribution, "runs" : 10//scale + 1, "group_size" : 64})
+    return cases
+
+def case_key(case):
+    return json.dumps(case, sort_keys=True)
+
+def load_stake_distribution(name):
+    """ stake per owner: "token" and "eth" read the bundled csv files the way the study
+    notebooks do, "synthetic:<owners>" draws a fixed heavy-tailed distribution """
+    if name == "token":
+        stake_distribution = []
+        for value in read_first_column("token_distribution.csv"):
+            if value != "#NAME?" and float(value) > 0:
+                stake_distribution.append(int(float(value)/10000))
+        return np.sort(np.array(stake_distribution, dtype=float))
+    elif name == "eth":
+        stake_distribution = [float(value.strip('%'))*1000 for value in read_first_column("eth_distr.csv")]
+        return np.sort(np.array(stake_distribution, dtype=float))
+    elif name.startswith("synthetic:"):
+        owners = int(name.split(":")[1])
+        generator = np.random.default_rng(owners)
+        minimum = BENCHMARK_PARAMETERS["min_stake_amount"]
+        return np.sort(minimum * (1 + np.floor(generator.pareto(1.5, owners))))
+    raise ValueError("unknown stake distribution: " + str(name))
+
+def read_first_column(filename):
+    with open(os.path.join(BENCHMARK_DIRECTORY, filename), encoding="utf-8-sig") as csv_file:
+        rows = csv.reader(csv_file)
+        next(rows) # header
+        return [row[0] for row in rows if row and row[0]]
+
+
+class Function_Timer():
+    """ Context manager that wraps the given class methods or module functions and
+    accumulates their call counts and total time; the originals are restored on exit """
+    def __init__(self, targets):
+        self.targets = targets # (owner object, attribute name, label)
+        self.timings = {}
+        self.originals = []
+
+    def __enter__(self):
+        for owner, name, label in self.targets:
+            original = getattr(owner, name)
+            self.originals.append((owner, name, original))
+            self.timings[label] = {"calls" : 0, "seconds" : 0.0}
+            setattr(owner, name, self.wrap(original, self.timings[label]))
+        return self
+
+    def __exit__(self, *exc_info):
+        for owner, name, original in reversed(self.originals):
+            setattr(owner, name, original)
+        self.originals = []
+
+    def wrap(self, function, timing):
+        def timed(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timing["calls"] += 1
+                timing["seconds"] += time.perf_counter() - start_time
+        return timed
+
+
+def run_case(case, repeats = 3):
+    """ runs one benchmark case and returns its measurements; meant to run in its own process.
+    The case is repeated and the fastest repeat is kept, which filters out scheduling noise """
+    import warnings
+    if BENCHMARK_DIRECTORY not in sys.path:
+        sys.path.insert(0, BENCHMARK_DIRECTORY)
+    warnings.simplefilter("ignore", FutureWarning) # Mesa warns about Beacon_Model not calling Model.__init__
+    stake_distribution = load_stake_distribution(case["distribution"])
+    result = None
+    with contextlib.redirect_stdout(io.StringIO()): # the model and helpers print progress
+        for repeat in range(repeats):
+            if case["kind"] == "model":
+                measured = time_model(case, stake_distribution)
+            else:
+                measured = time_helpers(case, stake_distribution)
+            if result is None or measured["seconds"] < result["seconds"]:
+                result = measured
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024 # kilobytes on Linux
+    return result
+
+def time_model(case, stake_distribution):
+    import importlib
+    import tempfile
+    import model
+    targets = [(getattr(importlib.import_module(module), owner), name, owner + "." + name)
+    for module, owner, name in TIMED_FUNCTIONS]
+    parameters = dict(BENCHMARK_PARAMETERS, group_size = case["group_size"], operator_mode = case["operator_mode"],
+    stake_distribution = stake_distribution, log_filename = os.path.join(tempfile.gettempdir(), "beacon_benchmark.log"), seed = 0)
+    start_time = time.perf_counter()
+    beacon_model = model.Beacon_Model(**parameters)
+    construct_seconds = time.perf_counter() - start_time
+    with Function_Timer(targets) as timer:
+        start_time = time.perf_counter()
+        for i in range(case["horizon"]):
+            beacon_model.step()
+        elapsed = time.perf_counter() - start_time
+    return {"case" : case,
+    "nodes" : beacon_model.num_nodes,
+    "construct_seconds" : construct_seconds,
+    "seconds" : elapsed,
+    "throughput" : case["horizon"]/elapsed, # blocks/s
+    "timings" : timer.timings}
+
+def time_helpers(case, stake_distribution):
+    import simulation_functions
+    targets = [(simulation_functions, name, name) for name in TIMED_HELPERS]
+    np.random.seed(0)
+    runs = case["runs"]
+    tickets_per_owner = np.maximum(1, stake_distribution//BENCHMARK_PARAMETERS["min_stake_amount"]).astype(np.int64)
+    with Function_Timer(targets) as timer:
+        start_time = time.perf_counter()
+        tickets = simulation_functions.preprocess_tickets(runs, tickets_per_owner.sum())
+        group_members = simulation_functions.preprocess_groups(tickets, runs, case["group_size"])
+        cdf = simulation_functions.create_cdf(len(tickets_per_owner), tickets_per_owner)
+        simulation_functions.group_distr(runs, len(tickets_per_owner), np.array(group_members), cdf)
+        elapsed = time.perf_counter() - start_time
+    return {"case" : case,
+    "nodes" : len(tickets_per_owner),
+    "seconds" : elapsed,
+    "throughput" : runs/elapsed, # runs/s
+    "timings" : timer.timings}
+
+def run_suite(cases):
+    """ runs every case in a fresh worker process and returns the results in case order """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(run_case, case).result()
+        print("benchmark: %s %.1f %s, %.0f MB peak" % (case_key(case), result["throughput"],
+        "blocks/s" if case["kind"] == "model" else "runs/s", result["peak_rss_mb"]))
+        results.append(result)
+    return results
+
+
+def environment():
+    # where a history entry was measured
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=BENCHMARK_DIRECTORY,
+        capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"timestamp" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "commit" : commit,
+    "python" : platform.python_version(),
+    "numpy" : np.__version__,
+    "machine" : platform.machine(),
+    "processor" : platform.processor()}
+
+def append_history(results, history_path = HISTORY_PATH):
+    entry = environment()
+    with open(history_path, "a") as history_file:
+        for result in results:
+            history_file.write(json.dumps(dict(entry, **result)) + "\n")
+
+def load_history(history_path = HISTORY_PATH):
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path) as history_file:
+        return [json.loads(line) for line in history_file if line.strip()]
+
+def save_baseline(results, baseline_path = BASELINE_PATH):
+    # the cases of this run replace their old entries; the other cases (e.g. the full suite
+    # when saving a --quick run) are kept, so both modes can have a baseline
+    baseline = load_baseline(baseline_path)
+    baseline.update({case_key(result["case"]) : {"throughput" : result["throughput"], "peak_rss_mb" : result["peak_rss_mb"]}
+    for result in results})
+    with open(baseline_path, "w") as baseline_file:
+        json.dump(dict(environment = environment(), cases = baseline), baseline_file, indent=1)
+
+def load_baseline(baseline_path = BASELINE_PATH):
+    if not os.path.exists(baseline_path):
+        return {}
+    with open(baseline_path) as baseline_file:
+        return json.load(baseline_file)["cases"]
+
+def compare(results, baseline, threshold = 0.2):
+    """ regressions against the baseline: throughput down, or peak RSS up, by more than threshold,
+    and the number of cases compared. Cases missing from the baseline are not compared """
+    regressions = []
+    compared = 0
+    for result in results:
+        reference = baseline.get(case_key(result["case"]))
+        if reference is None:
+            continue
+        compared += 1
+        if result["throughput"] < reference["throughput"] * (1 - threshold):
+            regressions.append("%s: throughput %.1f, baseline %.1f" % (case_key(result["case"]), result["throughput"], reference["throughput"]))
+        if result["peak_rss_mb"] > reference["peak_rss_mb"] * (1 + threshold):
+            regressions.append("%s: peak RSS %.0f MB, baseline %.0f MB" % (case_key(result["case"]), result["peak_rss_mb"], reference["peak_rss_mb"]))
+    return regressions, compared
+
+
+def main(arguments = None):
+    parser = argparse.ArgumentParser(description = "Beacon_Model benchmark suite")
+    parser.add_argument("--quick", action = "store_true", help = "shorter horizons and no 10000-owner network")
+    parser.add_argument("--history", default = HISTORY_PATH)
+    parser.add_argument("--baseline", default = BASELINE_PATH)
+    parser.add_argument("--save-baseline", action = "store_true", help = "store this run as the baseline")
+    parser.add_argument("--threshold", type = float, default = 0.2, help = "allowed fractional regression")
+    options = parser.parse_args(arguments)
+
+    results = run_suite(default_cases(options.quick))
+    append_history(results, options.history)
+    if options.save_baseline:
+        save_baseline(results, options.baseline)
+        print("benchmark: baseline saved to %s" % options.baseline)
+        return 0
+    regressions, compared = compare(results, load_baseline(options.baseline), options.threshold)
+    print("benchmark: %d of %d cases compared with %s" % (compared, len(results), options.baseline))
+    if compared == 0:
+        print("benchmark: no case has a baseline, nothing was checked; store one with --save-baseline")
+        return 1
+    for regression in regressions:
+        print("regression: " + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
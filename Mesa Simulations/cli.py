@@ -0,0 +1,211 @@
+""" Headless runner: python cli.py variables.ascii --set group_size=50 --seed 1 --output run.csv
+
+Reads a variables.ascii style config (name = value lines, # comments), applies the --set
+overrides, builds Beacon_Model and runs it without Jupyter or the visualization server.
+Only the standard library is imported before the arguments are parsed; the model is then
+imported without running mesa/__init__.py, which would load the visualization server,
+networkx and tornado. scipy is only imported by the features that need it
+(e.g. control_variates), so a short run mostly pays for numpy and pandas """
+import os
+import sys
+import ast
+import csv
+import json
+import time
+import argparse
+import contextlib
+
+# variables.ascii names that differ from the Beacon_Model argument names
+VARIABLE_NAMES = {"max_malicious_threshold" : "max_malicious_threshold_percent",
+"self_operator_mode" : "operator_mode"}
+
+# values of the Beacon_Model arguments a variables.ascii file usually leaves out
+DEFAULT_VARIABLES = {"min_stake_amount" : 100,
+"operator_mode" : 1,
+"malicious_operator_percent" : 0.3,
+"compromised_threshold" : 0.3,
+"log_filename" : "master_sim.log",
+"run_number" : 0,
+"steps" : 1000}
+
+# variables.ascii names that are not model arguments: "nodes" is the number of owners of the
+# linear stake distribution, the misbehaving node percents belong to earlier model versions
+RUN_VARIABLES = ("nodes", "number_of_owners", "steps", "Misbehaving_nodes", "Misbehaving_DKG_nodes")
+
+# positional Beacon_Model arguments, then the keyword ones a config may set
+MODEL_ARGUMENTS = ("stake_distribution", "active_group_threshold", "group_size",
+"max_malicious_threshold_percent", "group_expiry", "node_failure_percent", "node_death_percent",
+"signature_delay", "min_nodes", "node_connection_delay", "node_mainloop_connection_delay",
+"log_filename", "run_number", "dkg_block_delay", "compromised_threshold",
+"failed_signature_threshold", "min_stake_amount", "operator_mode", "malicious_operator_percent")
+OPTIONAL_ARGUMENTS = ("lottery_mode", "scheduler_mode", "aggregate_nodes", "tilt_target", "control_variates")
+
+
+def read_variables(path):
+    """ name -> value of every assignment in a variables.ascii style file. Values are Python
+    literals; an expression such as the failed_signature_threshold formula of Master.ipynb
+    is evaluated with the variables assigned above it """
+    with open(path) as variables_file:
+        source = variables_file.read()
+    variables = {}
+    for statement in ast.parse(source, path).body:
+        if not isinstance(statement, ast.Assign) or len(statement.targets) != 1 or not isinstance(statement.targets[0], ast.Name):
+            raise ValueError("%s line %d: expected name = value" % (path, statement.lineno))
+        try:
+            value = ast.literal_eval(statement.value)
+        except ValueError:
+            expression = compile(ast.Expression(statement.value), path, "eval")
+            value = eval(expression, {"__builtins__" : {}}, dict(variables))
+        variables[statement.targets[0].id] = value
+    return variables
+
+def parse_override(text):
+    # name=value, the value read as a Python literal or else kept as a string
+    name, separator, value = text.partition("=")
+    if not separator or not name.strip():
+        raise argparse.ArgumentTypeError("expected name=value: " + text)
+    try:
+        return name.strip(), ast.literal_eval(value.strip())
+    except (ValueError, SyntaxError):
+        return name.strip(), value.strip()
+
+def model_parameters(variables):
+    """ Beacon_Model keyword arguments from config variables: renames the variables.ascii names,
+    fills in DEFAULT_VARIABLES and reads a max_malicious_threshold above 1 as a percent """
+    parameters = {}
+    for name, value in dict(DEFAULT_VARIABLES, **{VARIABLE_NAMES.get(name, name) : value for name, value in variables.items()}).items():
+        if name in RUN_VARIABLES:
+            continue
+        if name not in MODEL_ARGUMENTS and name not in OPTIONAL_ARGUMENTS:
+            raise ValueError("unknown variable: " + name)
+        parameters[name] = value
+    if parameters.get("max_malicious_threshold_percent", 0) > 1:
+        parameters["max_malicious_threshold_percent"] /= 100 # malicious shares are fractions
+    missing = [name for name in MODEL_ARGUMENTS if name not in parameters]
+    if missing:
+        raise ValueError("missing variables: " + ", ".join(missing))
+    return parameters
+
+def read_stake(stake, owners):
+    """ stake distribution from "linear" (owner i stakes 10*(i+1), as in Master.ipynb) or a csv
+    file with one stake per row in the first column: percents (eth_distr.csv) are scaled by 1000,
+    token amounts (token_distribution.csv) divided by 10000, like the notebooks do """
+    if stake == "linear":
+        return [10 * (i + 1) for i in range(owners)]
+    distribution = []
+    with open(stake, encoding="utf-8-sig") as stake_file:
+        rows = csv.reader(stake_file)
+        next(rows, None) # header
+        for row in rows:
+            if not row or not row[0].strip():
+                continue
+            value = row[0].strip()
+            if value.endswith("%"):
+                distribution.append(float(value.rstrip("%")) * 1000)
+                continue
+            try:
+                tokens = float(value)
+            except ValueError:
+                continue # spreadsheet errors such as #NAME?
+            if tokens > 0:
+                distribution.append(int(tokens/10000))
+    return sorted(distribution)
+
+def import_model():
+    """ imports model with the mesa modules it uses, skipping mesa/__init__.py and the
+    visualization, space and batch runner modules it loads. A process that imported mesa
+    already keeps it as it is """
+    if "mesa" not in sys.modules:
+        import types
+        import importlib.util
+        spec = importlib.util.find_spec("mesa")
+        package = types.ModuleType("mesa")
+        package.__path__ = list(spec.submodule_search_locations)
+        package.__file__ = spec.origin
+        package.__spec__ = spec
+        sys.modules["mesa"] = package
+        try:
+            import mesa.agent
+            import mesa.model
+            import mesa.time
+            import mesa.datacollection
+        except BaseException:
+            del sys.modules["mesa"]
+            raise
+        package.Agent = mesa.agent.Agent
+        package.Model = mesa.model.Model
+        package.DataCollector = mesa.datacollection.DataCollector
+    import model
+    return model
+
+def write_series(model_vars, path):
+    # one row per block with every model reporter, without pandas
+    reporters = list(model_vars)
+    with open(path, "w", newline="") as series_file:
+        writer = csv.writer(series_file)
+        writer.writerow(["block"] + reporters)
+        for block in range(min(len(model_vars[reporter]) for reporter in reporters)):
+            writer.writerow([block + 1] + [model_vars[reporter][block] for reporter in reporters])
+
+def run(parameters, steps, seed, burn_in = 0, quiet = False):
+    """ builds and steps one model; returns it and its summary line """
+    model = import_model()
+    from sweep import summarize_run
+    start_time = time.time()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull if quiet else sys.stdout):
+        beacon_model = model.Beacon_Model(**dict(parameters, seed = seed))
+        for i in range(steps):
+            beacon_model.step()
+    summary = {"seed" : seed,
+    "run_number" : parameters["run_number"],
+    "steps" : steps,
+    "elapsed" : time.time() - start_time,
+    "summary" : summarize_run(beacon_model, burn_in)}
+    if parameters.get("control_variates"):
+        summary["controls"] = beacon_model.control_values()
+    return beacon_model, summary
+
+
+def main(arguments = None):
+    parser = argparse.ArgumentParser(description = "Run Beacon_Model headless from a variables.ascii style config")
+    parser.add_argument("config", help = "variables.ascii style file of name = value lines")
+    parser.add_argument("--set", dest = "overrides", action = "append", type = parse_override, default = [],
+    metavar = "NAME=VALUE", help = "override a config variable, e.g. --set group_size=50 (repeatable)")
+    parser.add_argument("--stake", default = "linear", help = "linear (default) or a stake csv such as eth_distr.csv")
+    parser.add_argument("--steps", type = int, help = "blocks to run (default: steps in the config)")
+    parser.add_argument("--seed", type = int, help = "seed of the first run (default: unseeded)")
+    parser.add_argument("--runs", type = int, default = 1,
+    help = "runs in this process, with consecutive seeds and run numbers; the imports are paid once")
+    parser.add_argument("--burn-in", type = int, default = 0, help = "blocks left out of the summary means")
+    parser.add_argument("--output", help = "csv of every model reporter per block; {run} is replaced by the run number")
+    parser.add_argument("--summary", help = "append one JSON line per run here instead of printing it")
+    parser.add_argument("--quiet", action = "store_true", help = "silence the model's own output")
+    options = parser.parse_args(arguments)
+
+    variables = read_variables(options.config)
+    variables.update(options.overrides)
+    try:
+        parameters = model_parameters(dict(variables, stake_distribution = variables.get("stake_distribution",
+        read_stake(options.stake, variables.get("number_of_owners", variables.get("nodes", 100))))))
+    except ValueError as error:
+        parser.error(str(error))
+    steps = options.steps if options.steps is not None else variables.get("steps", DEFAULT_VARIABLES["steps"])
+
+    summary_file = open(options.summary, "a") if options.summary else sys.stdout
+    try:
+        for run_index in range(options.runs):
+            run_parameters = dict(parameters, run_number = parameters["run_number"] + run_index)
+            seed = options.seed + run_index if options.seed is not None else None
+            beacon_model, summary = run(run_parameters, steps, seed, options.burn_in, options.quiet)
+            if options.output:
+                write_series(beacon_model.datacollector.model_vars, options.output.replace("{run}", str(run_parameters["run_number"])))
+            summary_file.write(json.dumps(summary) + "\n")
+            summary_file.flush()
+    finally:
+        if summary_file is not sys.stdout:
+            summary_file.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
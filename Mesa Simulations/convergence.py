@@ -0,0 +1,137 @@
+import numpy as np
+
+# reporter -> (numerator, denominator) counters of model.metrics behind it
+RATIO_METRICS = {"% Compromised Groups" : ("compromised_groups", "total_groups"),
+"% Lynchpinned signatures" : ("lynchpinned_signatures", "total_signatures"),
+"Failed Singature %" : ("failed_signatures", "total_signatures")}
+
+DEFAULT_METRICS = ("% Compromised Groups", "% Lynchpinned signatures", "Failed Singature %")
+
+
+class Run_Controller():
+    """ Runs a Beacon_Model until its metrics have settled instead of for a fixed number of blocks.
+
+    Every block the controller records how many groups/signatures were counted and how many
+    of them were compromised, lynchpinned or failed. Every check_interval blocks it
+    - detects the end of the transient (node connection delays, the bootstrap groups) with
+      MSER-5 on the active node and group counts; at most half the run is cut,
+    - estimates each metric after the burn-in as a ratio of the post burn-in counts, with a
+      batch-means confidence interval over `batches` equal batches,
+    and stops once every interval is narrower than ci_width (full width), or at max_steps.
+
+    The estimates are steady-state fractions, unlike the reporters, which are cumulative
+    from block 0. ess is the number of independent groups/signatures worth the same precision """
+    def __init__(self, beacon_model, metrics = DEFAULT_METRICS, ci_width = 0.02, confidence = 0.95,
+    batches = 20, min_steps = 200, max_steps = 20000, check_interval = 100):
+        unknown = [metric for metric in metrics if metric not in RATIO_METRICS]
+        if unknown:
+            raise ValueError("no running counts behind: " + ", ".join(unknown))
+        self.model = beacon_model
+        self.metrics = list(metrics)
+        self.ci_width = ci_width
+        self.confidence = confidence
+        self.batches = batches
+        self.min_steps = min_steps
+        self.max_steps = max_steps
+        self.check_interval = check_interval
+
+        self.steps = 0
+        self.levels = {"# of Active Nodes" : [], "# of Active Groups" : []}
+        self.counters = sorted(set(counter for metric in self.metrics for counter in RATIO_METRICS[metric]))
+        self.counts = {counter : [] for counter in self.counters} # per-block increments
+        self.last_counts = {counter : getattr(beacon_model.metrics, counter) for counter in self.counters}
+        self.burn_in = 0
+        self.estimates = {}
+        self.converged = False
+
+    def step(self):
+        self.model.step()
+        self.steps += 1
+        self.levels["# of Active Nodes"].append(self.model.num_active_nodes)
+        self.levels["# of Active Groups"].append(self.model.num_active_groups)
+        for counter in self.counters:
+            value = getattr(self.model.metrics, counter)
+            self.counts[counter].append(value - self.last_counts[counter])
+            self.last_counts[counter] = value
+
+    def run(self):
+        """ steps the model until every metric has converged or max_steps is reached; returns report() """
+        while self.steps < self.max_steps:
+            self.step()
+            if self.steps >= self.min_steps and self.steps % self.check_interval == 0:
+                if self.check():
+                    break
+        if not self.converged:
+            self.check()
+        return self.report()
+
+    def check(self):
+        self.burn_in = self.detect_burn_in()
+        self.estimates = {metric : self.estimate(metric) for metric in self.metrics}
+        self.converged = all(estimate["half_width"] * 2 <= self.ci_width for estimate in self.estimates.values())
+        return self.converged
+
+    def detect_burn_in(self):
+        # the per-block metric counts are mostly 0 or 1, too noisy for MSER
+        return max(mser_truncation(np.asarray(values, dtype=float)) for values in self.levels.values())
+
+    def estimate(self, metric):
+        numerator, denominator = RATIO_METRICS[metric]
+        numerators = np.asarray(self.counts[numerator][self.burn_in:], dtype=float)
+        denominators = np.asarray(self.counts[denominator][self.burn_in:], dtype=float)
+        return ratio_batch_means(numerators, denominators, self.batches, self.confidence)
+
+    def report(self):
+        return {"steps" : self.steps,
+        "burn_in" : self.burn_in,
+        "converged" : self.converged,
+        "metrics" : dict(self.estimates)}
+
+    def model_data(self):
+        # the datacollector model data after the detected burn-in
+        return self.model.datacollector.get_model_vars_dataframe().loc[self.burn_in:]
+
+
+def mser_truncation(values, batch_size = 5):
+    """ MSER-5 truncation point in blocks: the start of the batch of 5 that minimizes the
+    standard error of the mean of the remaining batches, searched over the first half """
+    batch_count = len(values)//batch_size
+    if batch_count < 4:
+        return 0
+    batch_means = values[0:batch_count*batch_size].reshape(batch_count, batch_size).mean(axis=1)
+    # sums over the batches from each candidate start to the end
+    remaining = np.arange(batch_count, 0, -1)
+    sums = np.cumsum(batch_means[::-1])[::-1]
+    squares = np.cumsum((batch_means**2)[::-1])[::-1]
+    squared_errors = squares - sums**2/remaining
+    mser = squared_errors/remaining**2
+    return int(np.argmin(mser[0:batch_count//2])) * batch_size
+
+def ratio_batch_means(numerators, denominators, batches, confidence):
+    """ ratio estimate sum(numerators)/sum(denominators) with a batch-means confidence interval;
+    batches without any denominator count are left out """
+    from scipy import stats
+    total = denominators.sum()
+    estimate = float(numerators.sum()/total) if total > 0 else float("nan")
+    batch_size = len(numerators)//batches
+    result = {"estimate" : estimate, "half_width" : float("inf"), "ess" : 0.0,
+    "observations" : int(total), "batches" : 0, "batch_size" : batch_size}
+    if batch_size == 0 or total == 0:
+        return result
+    used = batch_size * batches
+    batch_numerators = numerators[0:used].reshape(batches, batch_size).sum(axis=1)
+    batch_denominators = denominators[0:used].reshape(batches, batch_size).sum(axis=1)
+    counted = batch_denominators > 0
+    if np.count_nonzero(counted) < 2:
+        return result
+    batch_ratios = batch_numerators[counted]/batch_denominators[counted]
+    k = len(batch_ratios)
+    variance = np.var(batch_ratios, ddof=1)/k # variance of the mean of the batch ratios
+    result["half_width"] = float(stats.t.ppf(0.5 + confidence/2, k - 1) * np.sqrt(variance))
+    result["batches"] = k
+    # independent Bernoulli observations with the same variance
+    if variance > 0:
+        result["ess"] = float(min(total, estimate*(1 - estimate)/variance))
+    else:
+        result["ess"] = float(total)
+    return result
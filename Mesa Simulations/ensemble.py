@@ -0,0 +1,267 @@
+import numpy as np
+import rng
+import selection
+import node_table
+
+# model reporters produced for every replica, in the DataCollector order
+MODEL_REPORTERS = ["# of Active Groups", "# of Active Nodes", "# of Signatures",
+"Median Malicious Group %", "% Compromised Groups", "Median Lynchpin %",
+"% Lynchpinned signatures", "Failed Singature %"]
+
+# Beacon_Model arguments that do not change the simulated dynamics; accepted so a
+# Beacon_Model parameter dict can be passed straight to the ensemble
+MODEL_ONLY_PARAMETERS = ("node_mainloop_connection_delay", "log_filename", "run_number",
+"compromised_threshold", "malicious_operator_percent", "lottery_mode", "recorder",
+"tracer", "log_level", "scheduler_mode")
+
+
+class Beacon_Ensemble():
+    """ Lockstep ensemble: advances `replicas` independent Beacon_Model replicas together.
+    Node state, groups, signatures and metrics are held as (replica x entity) arrays, so one
+    block of Python control flow covers every replica.
+
+    Each replica follows the Beacon_Model step order (bootstrap, relay request, group
+    registration, metrics, node churn, group expiry, signature processing) with the same
+    probabilities; only the random draws differ. Group lifetimes are fixed by dkg_block_delay
+    and group_expiry, so groups are kept in a per-replica ring ordered by registration block.
+    The lottery draws group_size distinct tickets uniformly, like the "sample" lottery mode.
+
+    model_vars holds one array per block for every model reporter, indexed by replica """
+    def __init__(self, replicas, stake_distribution, active_group_threshold,
+    group_size, max_malicious_threshold_percent, group_expiry,
+    node_failure_percent, node_death_percent, signature_delay, min_nodes,
+    node_connection_delay, dkg_block_delay, failed_signature_threshold,
+    min_stake_amount, operator_mode, seed = None, **model_parameters):
+        unknown = set(model_parameters) - set(MODEL_ONLY_PARAMETERS)
+        if unknown:
+            raise TypeError("unexpected ensemble arguments: " + ", ".join(sorted(unknown)))
+        self.rng = rng.Random_Streams(seed)
+        self.replicas = replicas
+        self.active_group_threshold = active_group_threshold
+        self.group_size = group_size
+        self.max_malicious_threshold_percent = max_malicious_threshold_percent
+        self.failed_signature_threshold = failed_signature_threshold
+        self.node_failure_percent = node_failure_percent
+        self.node_death_percent = node_death_percent
+        self.signature_delay = signature_delay
+        self.group_formation_threshold = min_nodes
+        self.relay_request_probability = 0.5
+        self.timer = 0
+        R = replicas
+
+        #nodes: the network is shared, the connection state and the malicious draw are per replica
+        self.operator, self.tickets = node_table.node_columns(stake_distribution, min_stake_amount, operator_mode)
+        self.num_nodes = len(self.operator)
+        N = self.num_nodes
+        self.malicious = self.rng["malicious"].integers(0, 100, (R, N))<30
+        self.connected = np.zeros((R, N), dtype=bool)
+        if node_connection_delay > 0:
+            self.connection_delay = self.rng["churn"].integers(0, node_connection_delay, (R, N))
+        else:
+            self.connection_delay = np.zeros((R, N), dtype=np.int64)
+        self.bootstrap_complete = np.zeros(R, dtype=bool)
+
+        #groups: a group registered in block k is in the active group list until block k + lifetime,
+        #when it expires; at most one group per block is registered after the bootstrap
+        self.group_lifetime = max(dkg_block_delay, -1) + 1 + max(group_expiry, 1)
+        self.group_capacity = active_group_threshold + self.group_lifetime + 2
+        self.group_members = np.zeros((R, self.group_capacity, group_size), dtype=np.int64) # sorted node ids, one per seat
+        self.group_block = np.full((R, self.group_capacity), np.iinfo(np.int64).min//2) # registration block of every slot
+        self.groups_registered = np.zeros(R, dtype=np.int64)
+
+        #signatures in progress: members are copied at the start, since the group may expire first
+        self.signature_capacity = 8
+        self.signature_members = np.zeros((R, self.signature_capacity, group_size), dtype=np.int64)
+        self.signature_block = np.full((R, self.signature_capacity), -1) # block the signature is processed in, -1 for a free slot
+
+        #running metrics per replica; medians are read from histograms over the values a percent can take
+        self.total_groups = np.zeros(R, dtype=np.int64)
+        self.compromised_groups = np.zeros(R, dtype=np.int64)
+        self.malicious_percent_values = np.arange(group_size + 1)/group_size
+        self.malicious_percent_counts = np.zeros((R, group_size + 1), dtype=np.int64)
+        self.total_signatures = np.zeros(R, dtype=np.int64)
+        self.lynchpinned_signatures = np.zeros(R, dtype=np.int64)
+        self.failed_signatures = np.zeros(R, dtype=np.int64)
+        seats = np.arange(1, group_size + 1)
+        shares = seats[None, :]/seats[:, None] # largest operator share / online seats
+        self.operator_lynchpin_values = np.unique(np.concatenate([[0.0], shares[shares <= 1]]))
+        self.operator_lynchpin_counts = np.zeros((R, len(self.operator_lynchpin_values)), dtype=np.int64)
+
+        self.num_active_nodes = np.zeros(R, dtype=np.int64)
+        self.num_active_groups = np.zeros(R, dtype=np.int64)
+        self.model_vars = {reporter : [] for reporter in MODEL_REPORTERS}
+
+    def step(self):
+        '''Advance every replica by one step'''
+        block = self.timer + 1 # the block whose schedule step follows
+        active_nodes = np.count_nonzero(self.connected, axis=1)
+        can_register = active_nodes >= self.group_formation_threshold
+
+        #bootstrap active groups as nodes become available
+        bootstrap = ~self.bootstrap_complete & can_register
+        if bootstrap.any():
+            for i in range(self.active_group_threshold):
+                self.group_registration(np.flatnonzero(bootstrap), block)
+            self.bootstrap_complete |= bootstrap
+
+        #generate relay requests: sign with a random group from the active group list, then register a new group
+        relay = self.rng["relay"].random(self.replicas) < self.relay_request_probability
+        active_groups = self.group_block >= block - self.group_lifetime
+        signing = relay & active_groups.any(axis=1)
+        if signing.any():
+            self.signature_start(np.flatnonzero(signing), active_groups[signing], block)
+        self.group_registration(np.flatnonzero(relay & can_register), block)
+        self.timer += 1
+
+        #calculate model measurements
+        self.record("# of Signatures", self.total_signatures.copy())
+        self.record("Median Malicious Group %", histogram_median(self.malicious_percent_counts, self.malicious_percent_values))
+        self.record("% Compromised Groups", self.compromised_groups/(self.total_groups+0.000000000000000001))
+        self.record("Median Lynchpin %", histogram_median(self.operator_lynchpin_counts, self.operator_lynchpin_values))
+        self.record("% Lynchpinned signatures", self.lynchpinned_signatures/(self.total_signatures+0.00000000000000001))
+        self.record("Failed Singature %", self.failed_signatures/(self.total_signatures+0.00000000000000001))
+
+        #advance the nodes, expire groups and process the signatures due in this block
+        self.nodes_step()
+        self.signature_process(block)
+        self.num_active_nodes = np.count_nonzero(self.connected, axis=1)
+        self.num_active_groups = np.count_nonzero(self.group_block > block - self.group_lifetime, axis=1)
+        self.record("# of Active Groups", self.num_active_groups)
+        self.record("# of Active Nodes", self.num_active_nodes)
+
+    def nodes_step(self):
+        draws = self.rng["churn"].integers(0, 100, (2,) + self.connected.shape)
+        disconnect = ((draws[0] < self.node_failure_percent) | (draws[1] < self.node_death_percent)) & self.connected
+        waiting = ~disconnect & (self.connection_delay > 0)
+        self.connection_delay[waiting] -= 1
+        self.connected[disconnect] = False
+        self.connected[~disconnect & ~waiting] = True
+
+    def group_registration(self, replicas, block):
+        """ runs the ticket lottery over the active nodes of each of the given replicas """
+        if len(replicas) == 0:
+            return
+        ticket_cdf = np.cumsum(self.tickets * self.connected[replicas], axis=1)
+        total_tickets = ticket_cdf[:, -1]
+        enough = total_tickets >= self.group_size # a replica without group_size tickets online skips the registration
+        replicas, ticket_cdf, total_tickets = replicas[enough], ticket_cdf[enough], total_tickets[enough]
+        if len(replicas) == 0:
+            return
+
+        positions = selection.distinct_positions(total_tickets, self.group_size, self.rng["lottery"])
+        # the owner of ticket position p is the first node whose cumulative ticket count exceeds p;
+        # rows are offset so one searchsorted serves every replica
+        offsets = np.arange(len(replicas))[:, None] * (int(total_tickets.max()) + 1)
+        owners = np.searchsorted((ticket_cdf + offsets).ravel(), (positions + offsets).ravel(), side = "right")
+        members = np.sort(owners.reshape(positions.shape) - np.arange(len(replicas))[:, None] * self.num_nodes, axis=1)
+
+        slots = self.groups_registered[replicas] % self.group_capacity
+        self.group_members[replicas, slots] = members
+        self.group_block[replicas, slots] = block
+        self.groups_registered[replicas] += 1
+
+        malicious_seats = np.count_nonzero(np.take_along_axis(self.malicious[replicas], members, axis=1), axis=1)
+        self.total_groups[replicas] += 1
+        self.compromised_groups[replicas] += malicious_seats/self.group_size >= self.max_malicious_threshold_percent
+        self.malicious_percent_counts[replicas, malicious_seats] += 1
+
+    def signature_start(self, replicas, active_groups, block):
+        # pick one active group uniformly at random in every signing replica
+        counts = np.count_nonzero(active_groups, axis=1)
+        picks = (self.rng["relay"].random(len(replicas)) * counts).astype(np.int64)
+        slots = np.argmax(np.cumsum(active_groups, axis=1) > picks[:, None], axis=1)
+        delays = self.rng["signature_delay"].poisson(self.signature_delay, len(replicas))
+
+        free = self.signature_block[replicas] < 0
+        while not free.any(axis=1).all():
+            self.grow_signatures()
+            free = self.signature_block[replicas] < 0
+        signature_slots = np.argmax(free, axis=1)
+        self.signature_members[replicas, signature_slots] = self.group_members[replicas, slots]
+        # the signature counts its delay down to 0, is flagged complete, and is processed the block after
+        self.signature_block[replicas, signature_slots] = block + delays + 1
+
+        # a signature in progress is counted with zero percents until it is processed
+        self.total_signatures[replicas] += 1
+        self.count_signatures(replicas, 0.0, 0.0, 1)
+        self.operator_lynchpin_counts[replicas, 0] += 1
+
+    def signature_process(self, block):
+        """ ownership measures of the signatures due in this block, from the members online now """
+        replicas, slots = np.nonzero(self.signature_block == block)
+        if len(replicas) == 0:
+            return
+        members = self.signature_members[replicas, slots]
+        online = np.take_along_axis(self.connected[replicas], members, axis=1)
+        online_seats = np.count_nonzero(online, axis=1)
+        failed_seats = self.group_size - online_seats
+
+        max_node_seats = largest_share(members, online)
+        operators = self.operator[members]
+        order = np.argsort(operators, axis=1, kind = "stable")
+        max_operator_seats = largest_share(np.take_along_axis(operators, order, axis=1), np.take_along_axis(online, order, axis=1))
+
+        offline_percent = failed_seats/self.group_size
+        lynchpin_percent = (failed_seats + max_node_seats)/self.group_size
+        operator_lynchpin_percent = np.where(online_seats > 0, max_operator_seats/np.maximum(online_seats, 1), 0.0)
+
+        # swap the in-progress values for the final ones
+        self.count_signatures(replicas, 0.0, 0.0, -1)
+        self.count_signatures(replicas, lynchpin_percent, offline_percent, 1)
+        np.add.at(self.operator_lynchpin_counts, (replicas, 0), -1)
+        values = np.searchsorted(self.operator_lynchpin_values, operator_lynchpin_percent)
+        np.add.at(self.operator_lynchpin_counts, (replicas, values), 1)
+        self.signature_block[replicas, slots] = -1
+
+    def count_signatures(self, replicas, lynchpin_percent, offline_percent, sign):
+        lynchpinned = np.broadcast_to(sign * (lynchpin_percent >= self.max_malicious_threshold_percent), replicas.shape)
+        failed = np.broadcast_to(sign * (offline_percent >= self.failed_signature_threshold), replicas.shape)
+        np.add.at(self.lynchpinned_signatures, replicas, lynchpinned.astype(np.int64))
+        np.add.at(self.failed_signatures, replicas, failed.astype(np.int64))
+
+    def grow_signatures(self):
+        R, capacity, g = self.signature_members.shape
+        self.signature_members = np.concatenate([self.signature_members, np.zeros((R, capacity, g), dtype=np.int64)], axis=1)
+        self.signature_block = np.concatenate([self.signature_block, np.full((R, capacity), -1)], axis=1)
+        self.signature_capacity = 2 * capacity
+
+    def record(self, reporter, values):
+        self.model_vars[reporter].append(np.asarray(values, dtype=float))
+
+    def get_model_vars(self, reporter):
+        """ the reporter values as a (block x replica) array """
+        values = self.model_vars[reporter]
+        if not values:
+            return np.zeros((0, self.replicas))
+        return np.stack(values)
+
+    def get_model_vars_dataframe(self, replica = None):
+        """ one replica's model reporters, shaped like DataCollector.get_model_vars_dataframe(),
+        or every replica in long form with Replica and Step columns """
+        import pandas as pd
+        if replica is not None:
+            return pd.DataFrame({reporter : self.get_model_vars(reporter)[:, replica] for reporter in MODEL_REPORTERS})
+        steps = len(self.model_vars[MODEL_REPORTERS[0]])
+        frame = {"Replica" : np.tile(np.arange(self.replicas), steps), "Step" : np.repeat(np.arange(steps), self.replicas)}
+        for reporter in MODEL_REPORTERS:
+            frame[reporter] = self.get_model_vars(reporter).ravel()
+        return pd.DataFrame(frame)
+
+
+def largest_share(keys, weights):
+    """ largest total weight of a single key in every row; keys must be sorted within each row """
+    rows, columns = keys.shape
+    starts = np.ones(keys.shape, dtype=bool)
+    starts[:, 1:] = keys[:, 1:] != keys[:, :-1]
+    runs = np.cumsum(starts, axis=1) - 1 + np.arange(rows)[:, None] * columns
+    totals = np.bincount(runs.ravel(), weights=weights.ravel(), minlength=rows*columns)
+    return totals.reshape(rows, columns).max(axis=1)
+
+def histogram_median(counts, values):
+    """ median of every row of a histogram over sorted values, nan for an empty row
+    (the mean of the two middle values for an even count, like np.median) """
+    total = counts.sum(axis=1)
+    cumulative = np.cumsum(counts, axis=1)
+    lower = np.argmax(cumulative > ((total - 1)//2)[:, None], axis=1)
+    upper = np.argmax(cumulative > (total//2)[:, None], axis=1)
+    return np.where(total > 0, (values[lower] + values[upper])/2, np.nan)
@@ -0,0 +1,199 @@
+import json
+import time
+import itertools
+import numpy as np
+from sweep import Parameter_Sweep, load_results, plain_value
+
+# parameters an exploration usually spans, with the Beacon_Model risk reporters as targets
+EXPLORED_PARAMETERS = ("group_size", "node_failure_percent", "node_death_percent",
+"min_stake_amount", "max_malicious_threshold_percent")
+
+
+class Adaptive_Sweep(Parameter_Sweep):
+    """ Finds the boundary of the safe configurations without running the full grid.
+
+    space: parameter name -> sorted candidate values, the finest grid considered
+    tolerances: reporter -> highest acceptable value, e.g. {"Failed Singature %" : 0.01};
+    a configuration is safe when every reporter stays at or below its tolerance
+
+    The exploration starts with `coarse` values per parameter and splits the boxes between them:
+    a box whose corners are all safe or all unsafe is settled, a box whose corners disagree, or
+    with a corner still uncertain, is split in half along every parameter and its new corners
+    are run. A corner is uncertain while the confidence interval of its replica mean contains
+    the tolerance; it then gets twice the replicas, up to max_replicas. Splitting stops at
+    neighbouring grid values or once max_runs runs are done. A crossing that enters and leaves
+    a settled box between two of its corners is missed, so coarse should not be too small.
+
+    Runs are ordinary sweep runs (seeds, results file and resume, store, convergence, common
+    random numbers), so results_dataframe and the dashboard read the results file as usual.
+    On resume only the runs with this sweep's settings and seeds count """
+    def __init__(self, base_parameters, space, tolerances, steps, results_path,
+    coarse = 3, replicas = 3, max_replicas = 12, max_runs = None, confidence = 0.95,
+    statistic = "mean", **sweep_options):
+        Parameter_Sweep.__init__(self, base_parameters, space, replicas, steps, results_path, **sweep_options)
+        self.names = list(space)
+        self.values = [[plain_value(value) for value in space[name]] for name in self.names]
+        self.tolerances = dict(tolerances)
+        self.coarse = coarse
+        self.max_replicas = max_replicas
+        self.max_runs = max_runs
+        self.confidence = confidence
+        self.statistic = statistic
+
+        self.observations = {} # point (value indexes) -> replica -> reporter -> value
+        self.boxes = [] # boxes left with disagreeing or uncertain corners at the finest step reached
+        self.runs = 0
+
+    def cell(self, point):
+        return {name : values[index] for name, values, index in zip(self.names, self.values, point)}
+
+    def point(self, cell):
+        return tuple(values.index(cell[name]) for name, values in zip(self.names, self.values))
+
+    def coarse_boxes(self):
+        # consecutive pairs of `coarse` evenly spread value indexes per parameter
+        edges = []
+        for values in self.values:
+            indexes = np.unique(np.round(np.linspace(0, len(values) - 1, max(2, min(self.coarse, len(values))))).astype(int))
+            edges.append(list(zip(indexes[0:-1], indexes[1:])) if len(indexes) > 1 else [(0, 0)])
+        return [tuple((int(low), int(high)) for low, high in box) for box in itertools.product(*edges)]
+
+    def run(self):
+        """ explores until every box is settled or split down to neighbouring values; returns boundary() """
+        self.load()
+        start_time = time.time()
+        boxes = self.coarse_boxes()
+        level = 0
+        while boxes:
+            corners = sorted(set(corner for box in boxes for corner in box_corners(box)))
+            self.evaluate(corners)
+            split = []
+            for box in boxes:
+                statuses = set(self.status(corner) for corner in box_corners(box))
+                if len(statuses) == 1 and "uncertain" not in statuses:
+                    continue # settled
+                children = split_box(box)
+                if children and not self.out_of_runs():
+                    split.extend(children)
+                else:
+                    self.boxes.append(box)
+            print("explore: level %d, %d boxes split, %d runs, %.1f s" % (level, len(split), self.runs, time.time() - start_time))
+            boxes = split
+            level += 1
+        cells = int(np.prod([len(values) for values in self.values]))
+        print("explore: %d runs for %d boundary points, the full grid is %d runs at %d replicas and %d at %d" %
+        (self.runs, len(self.boundary()), cells*self.replicas, self.replicas, cells*self.max_replicas, self.max_replicas))
+        return self.boundary()
+
+    def load(self):
+        # runs already in the results file count as done, if they were run with these settings and seeds
+        self.observations = {}
+        self.boxes = []
+        self.runs = 0
+        settings = self.settings()
+        for result in load_results(self.results_path):
+            try:
+                point = self.point(result["cell"])
+            except (KeyError, ValueError):
+                continue # a run of another space
+            if not self.matches(result, settings):
+                continue
+            self.observations.setdefault(point, {})[result["replica"]] = self.values_of(result)
+            self.runs += 1
+
+    def values_of(self, result):
+        return {reporter : result["summary"][reporter][self.statistic] for reporter in self.tolerances}
+
+    def evaluate(self, points):
+        # the first replicas of every point, then more replicas for the uncertain points
+        wanted = {point : self.replicas for point in points}
+        while wanted and not self.out_of_runs():
+            self.run_replicas(wanted)
+            wanted = {}
+            for point in points:
+                replicas = len(self.observations.get(point, {}))
+                if self.status(point) == "uncertain" and replicas < self.max_replicas:
+                    wanted[point] = min(2*replicas, self.max_replicas)
+
+    def run_replicas(self, wanted):
+        tasks = []
+        settings = self.settings()
+        for point, replicas in wanted.items():
+            cell = self.cell(point)
+            done = self.observations.get(point, {})
+            for replica in range(replicas):
+                if replica not in done:
+                    tasks.append(self.task(cell, replica, settings))
+        if self.max_runs is not None:
+            tasks = tasks[0:max(0, self.max_runs - self.runs)]
+        with open(self.results_path, "a") as results_file:
+            for result in self.execute(tasks):
+                results_file.write(json.dumps(result) + "\n")
+                results_file.flush()
+                self.observations.setdefault(self.point(result["cell"]), {})[result["replica"]] = self.values_of(result)
+                self.runs += 1
+
+    def out_of_runs(self):
+        return self.max_runs is not None and self.runs >= self.max_runs
+
+    def estimate(self, point, reporter):
+        """ mean of the replicas and half width of its t confidence interval """
+        from scipy import stats
+        values = np.array([replica[reporter] for replica in self.observations.get(point, {}).values()], dtype=float)
+        values = values[~np.isnan(values)]
+        n = len(values)
+        if n == 0:
+            return float("nan"), float("inf"), 0
+        if n == 1:
+            return float(values[0]), float("inf"), 1
+        half_width = stats.t.ppf(0.5 + self.confidence/2, n - 1) * np.std(values, ddof=1)/np.sqrt(n)
+        return float(values.mean()), float(half_width), n
+
+    def status(self, point):
+        """ "unsafe" if some reporter is above its tolerance with confidence, "safe" if every
+        reporter is below it, "uncertain" otherwise """
+        statuses = []
+        for reporter, tolerance in self.tolerances.items():
+            mean, half_width, n = self.estimate(point, reporter)
+            if n and mean - half_width > tolerance:
+                return "unsafe"
+            statuses.append("safe" if n and mean + half_width <= tolerance else "uncertain")
+        return "safe" if all(status == "safe" for status in statuses) else "uncertain"
+
+    def points(self, points = None):
+        """ every explored configuration (or the given value indexes): parameters, replicas,
+        mean and half width per reporter, status """
+        import pandas as pd
+        rows = []
+        for point in sorted(self.observations if points is None else points):
+            row = self.cell(point)
+            for reporter in self.tolerances:
+                mean, half_width, n = self.estimate(point, reporter)
+                row.update({reporter : mean, reporter + " half_width" : half_width, "replicas" : n})
+            row["status"] = self.status(point)
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def boundary(self):
+        """ corners of the boxes the exploration ended on: the safe configurations next to an
+        unsafe or uncertain one at the finest spacing reached there, with those neighbours.
+        The safe rows are the edge of the safe region """
+        corners = set(corner for box in self.boxes for corner in box_corners(box))
+        return self.points([corner for corner in corners if corner in self.observations])
+
+
+def box_corners(box):
+    return list(itertools.product(*(sorted(set(edge)) for edge in box)))
+
+def split_box(box):
+    # halves of every edge longer than one value; no children once the box spans neighbouring values
+    halves = []
+    for low, high in box:
+        if high - low > 1:
+            middle = (low + high)//2
+            halves.append([(low, middle), (middle, high)])
+        else:
+            halves.append([(low, high)])
+    if all(len(edge) == 1 for edge in halves):
+        return []
+    return [tuple(child) for child in itertools.product(*halves)]
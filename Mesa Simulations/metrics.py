@@ -0,0 +1,220 @@
+import numpy as np
+import heapq
+
+class Running_Median():
+    """ Streaming median of a multiset of values with O(log n) insert and remove.
+    Keeps the lower half in a max-heap and the upper half in a min-heap;
+    removed values are deleted lazily when they reach the top of their heap """
+    def __init__(self):
+        self.low = [] # max-heap of the lower half, stored as negated values
+        self.high = [] # min-heap of the upper half
+        self.low_size = 0
+        self.high_size = 0
+        self.delayed = {} # value -> number of pending deletions
+
+    def __len__(self):
+        return self.low_size + self.high_size
+
+    def add(self, value):
+        if not self.low or value <= -self.low[0]:
+            heapq.heappush(self.low, -value)
+            self.low_size += 1
+        else:
+            heapq.heappush(self.high, value)
+            self.high_size += 1
+        self.rebalance()
+
+    def remove(self, value):
+        self.delayed[value] = self.delayed.get(value, 0) + 1
+        if self.low and value <= -self.low[0]:
+            self.low_size -= 1
+            if value == -self.low[0]:
+                self.prune(self.low, -1)
+        else:
+            self.high_size -= 1
+            if self.high and value == self.high[0]:
+                self.prune(self.high, 1)
+        self.rebalance()
+
+    def replace(self, old_value, new_value):
+        if old_value != new_value:
+            self.remove(old_value)
+            self.add(new_value)
+
+    def median(self):
+        # same convention as np.median: nan when empty, mean of the two middle values for an even count
+        if len(self) == 0:
+            return float("nan")
+        if self.low_size > self.high_size:
+            return -self.low[0]
+        return (-self.low[0] + self.high[0])/2
+
+    def prune(self, heap, sign):
+        # pop values pending deletion off the top of the heap
+        while heap:
+            value = sign * heap[0]
+            count = self.delayed.get(value, 0)
+            if count == 0:
+                break
+            if count == 1:
+                del self.delayed[value]
+            else:
+                self.delayed[value] = count - 1
+            heapq.heappop(heap)
+
+    def rebalance(self):
+        # the lower half holds the extra value when the count is odd
+        if self.low_size > self.high_size + 1:
+            heapq.heappush(self.high, -heapq.heappop(self.low))
+            self.low_size -= 1
+            self.high_size += 1
+            self.prune(self.low, -1)
+        elif self.low_size < self.high_size:
+            heapq.heappush(self.low, -heapq.heappop(self.high))
+            self.high_size -= 1
+            self.low_size += 1
+            self.prune(self.high, 1)
+
+
+# weighted count -> the model reporter it estimates
+WEIGHTED_COUNTS = {"compromised_groups" : "% Compromised Groups",
+"lynchpinned_signatures" : "% Lynchpinned signatures",
+"operator_lynchpinned_signatures" : "% Operator lynchpinned signatures",
+"failed_signatures" : "Failed Singature %"}
+
+
+class Weighted_Count():
+    """ Importance sampling estimate of the probability of an event: every observation
+    carries the likelihood ratio weight of how it was drawn (1 without a tilt) and the
+    estimate is the mean of weight * hit over the observations, with a normal confidence
+    interval from the sample variance """
+    def __init__(self):
+        self.observations = 0
+        self.hits = 0
+        self.weighted_hits = 0.0
+        self.squared_hits = 0.0
+
+    def add(self, weight, hit):
+        self.observations += 1
+        if hit:
+            self.hits += 1
+            self.weighted_hits += weight
+            self.squared_hits += weight * weight
+
+    def add_many(self, weights, hits):
+        hit_weights = np.asarray(weights, dtype=float)[np.asarray(hits, dtype=bool)]
+        self.observations += len(np.asarray(weights))
+        self.hits += len(hit_weights)
+        self.weighted_hits += float(hit_weights.sum())
+        self.squared_hits += float(np.dot(hit_weights, hit_weights))
+
+    def estimate(self, confidence = 0.95):
+        """ estimate, confidence interval half width, relative error (standard error/estimate),
+        number of observations and of hits; with no hits the interval is meaningless """
+        from scipy import stats
+        n = self.observations
+        result = {"estimate" : float("nan"), "half_width" : float("inf"), "relative_error" : float("inf"),
+        "observations" : n, "hits" : self.hits}
+        if n == 0:
+            return result
+        mean = self.weighted_hits/n
+        result["estimate"] = mean
+        if n > 1:
+            standard_error = np.sqrt(max(self.squared_hits/n - mean**2, 0)/(n - 1))
+            result["half_width"] = float(stats.norm.ppf(0.5 + confidence/2) * standard_error)
+            if mean > 0:
+                result["relative_error"] = float(standard_error/mean)
+        return result
+
+
+class Model_Metrics():
+    """ Running aggregates behind the model reporters. Groups and signatures are
+    counted when they are registered and updated when a signature completes, so
+    each block reads the metrics in constant time instead of scanning every agent """
+    def __init__(self, max_malicious_threshold_percent, failed_signature_threshold):
+        self.max_malicious_threshold_percent = max_malicious_threshold_percent
+        self.failed_signature_threshold = failed_signature_threshold
+
+        self.total_groups = 0
+        self.compromised_groups = 0
+        self.malicious_percents = Running_Median()
+
+        self.total_signatures = 0
+        self.lynchpinned_signatures = 0
+        self.operator_lynchpinned_signatures = 0
+        self.failed_signatures = 0
+        self.operator_lynchpin_percents = Running_Median()
+        self.pending_signatures = {} # signature id -> values counted while the signature is in progress
+
+        # likelihood ratio weighted counts, per group at registration and per signature at completion
+        self.weighted = {name : Weighted_Count() for name in WEIGHTED_COUNTS}
+        # sums of the closed-form chances of the same events, when the model computes them
+        self.expected = {"compromised_groups" : 0.0, "failed_signatures" : 0.0}
+
+    def group_registered(self, group):
+        self.total_groups += 1
+        compromised = group.malicious_percent >= self.max_malicious_threshold_percent
+        self.compromised_groups += compromised
+        self.malicious_percents.add(group.malicious_percent)
+        self.weighted["compromised_groups"].add(group.weight, compromised)
+        if group.expected_compromise is not None:
+            self.expected["compromised_groups"] += group.expected_compromise
+
+    def signature_started(self, signature):
+        values = self.signature_values(signature)
+        self.total_signatures += 1
+        self.count_signature(values, 1)
+        self.operator_lynchpin_percents.add(signature.operator_lynchpin_percent)
+        self.pending_signatures[signature.id] = values
+
+    def signature_completed(self, signature):
+        # swap the in-progress values for the final ones
+        old_values = self.pending_signatures.pop(signature.id)
+        new_values = self.signature_values(signature)
+        self.count_signature(old_values, -1)
+        self.count_signature(new_values, 1)
+        self.operator_lynchpin_percents.replace(old_values[1], new_values[1])
+        lynchpin_percent, operator_lynchpin_percent, offline_percent = new_values
+        self.weighted["lynchpinned_signatures"].add(signature.weight, lynchpin_percent >= self.max_malicious_threshold_percent)
+        self.weighted["operator_lynchpinned_signatures"].add(signature.weight, operator_lynchpin_percent >= self.max_malicious_threshold_percent)
+        self.weighted["failed_signatures"].add(signature.weight, offline_percent >= self.failed_signature_threshold)
+        if signature.expected_failure is not None:
+            self.expected["failed_signatures"] += signature.expected_failure
+
+    def recount(self, max_malicious_threshold_percent, failed_signature_threshold, malicious_percents, signature_values):
+        """ recounts the threshold counts for new thresholds from the percents of every group and
+        signature counted so far; signature_values are the (lynchpin, operator lynchpin, offline)
+        percent arrays, holding the in-progress values of pending signatures """
+        self.max_malicious_threshold_percent = max_malicious_threshold_percent
+        self.failed_signature_threshold = failed_signature_threshold
+        self.compromised_groups = int(np.count_nonzero(np.asarray(malicious_percents) >= max_malicious_threshold_percent))
+        lynchpin_percents, operator_lynchpin_percents, offline_percents = [np.asarray(values) for values in signature_values]
+        self.lynchpinned_signatures = int(np.count_nonzero(lynchpin_percents >= max_malicious_threshold_percent))
+        self.operator_lynchpinned_signatures = int(np.count_nonzero(operator_lynchpin_percents >= max_malicious_threshold_percent))
+        self.failed_signatures = int(np.count_nonzero(offline_percents >= failed_signature_threshold))
+
+    def recount_weighted(self, malicious_percents, group_weights, signature_values, signature_weights):
+        """ rebuilds the weighted counts for the current thresholds from every group and every
+        completed signature: signature_values are the final (lynchpin, operator lynchpin, offline)
+        percent arrays """
+        self.weighted = {name : Weighted_Count() for name in WEIGHTED_COUNTS}
+        lynchpin_percents, operator_lynchpin_percents, offline_percents = [np.asarray(values) for values in signature_values]
+        self.weighted["compromised_groups"].add_many(group_weights, np.asarray(malicious_percents) >= self.max_malicious_threshold_percent)
+        self.weighted["lynchpinned_signatures"].add_many(signature_weights, lynchpin_percents >= self.max_malicious_threshold_percent)
+        self.weighted["operator_lynchpinned_signatures"].add_many(signature_weights, operator_lynchpin_percents >= self.max_malicious_threshold_percent)
+        self.weighted["failed_signatures"].add_many(signature_weights, offline_percents >= self.failed_signature_threshold)
+
+    def signature_values(self, signature):
+        return (signature.lynchpin_percent, signature.operator_lynchpin_percent, signature.offline_percent)
+
+    def count_signature(self, values, sign):
+        lynchpin_percent, operator_lynchpin_percent, offline_percent = values
+        self.lynchpinned_signatures += sign * (lynchpin_percent >= self.max_malicious_threshold_percent)
+        self.operator_lynchpinned_signatures += sign * (operator_lynchpin_percent >= self.max_malicious_threshold_percent)
+        self.failed_signatures += sign * (offline_percent >= self.failed_signature_threshold)
+
+    def median_malicious_group_percent(self):
+        return self.malicious_percents.median()
+
+    def median_operator_lynchpin_percent(self):
+        return self.operator_lynchpin_percents.median()
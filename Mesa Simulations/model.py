@@ -1,11 +1,18 @@
 from mesa import Model
 from mesa.time import SimultaneousActivation
 import agent
+import selection
+import node_table
+import metrics
+import archive
+import rng
+import tracing
+import scheduler
+from simulation_functions import create_cdf # the study notebooks call model.create_cdf
 import numpy as np
 from mesa.datacollection import DataCollector
 import logging as log
 import numpy as np
-import random as rnd
 import time
 import math
 
@@ -16,15 +23,27 @@ class Beacon_Model(Model):
     node_failure_percent, node_death_percent,
     signature_delay, min_nodes, node_connection_delay, node_mainloop_connection_delay, 
     log_filename, run_number, dkg_block_delay, compromised_threshold,
-    failed_signature_threshold, min_stake_amount, operator_mode, malicious_operator_percent):
+    failed_signature_threshold, min_stake_amount, operator_mode, malicious_operator_percent,
+    lottery_mode = "sample", recorder = None, seed = None, tracer = None, log_level = log.WARNING,
+    scheduler_mode = "synchronous", profiler = None, aggregate_nodes = False, tilt_target = None,
+    control_variates = False):
+        self.rng = rng.Random_Streams(seed) # named random substreams, replayable from self.rng.seed
         self.num_nodes = 0
-        self.schedule = SimultaneousActivation(self)
+        # "synchronous" steps every agent every block; "event" only wakes agents whose timers fire
+        if scheduler_mode == "event":
+            self.schedule = scheduler.Event_Scheduler(self)
+        elif scheduler_mode == "synchronous":
+            self.schedule = SimultaneousActivation(self)
+        else:
+            raise ValueError("unknown scheduler mode: " + str(scheduler_mode))
+        self.scheduler_mode = scheduler_mode
         self.relay_request = False
+        self.relay_request_probability = 0.5 # probability of a relay request in each block
+        self.relay_draws = self.rng.buffered("relay", "random")
+        self.signature_delay_draws = self.rng.buffered("signature_delay", "poisson", signature_delay)
         self.active_groups = {}
         self.num_active_groups = 0
-        self.active_nodes = {}
         self.num_active_nodes = 0
-        self.inactive_nodes = []
         self.active_group_threshold = active_group_threshold # number of groups that will always be maintained in an active state
         self.max_malicious_threshold_percent = max_malicious_threshold_percent # threshold above which a signature is deemed to be compromised, typically 51%
         self.group_size = group_size
@@ -46,6 +65,10 @@ class Beacon_Model(Model):
         self.perc_failed_signatures = 0
         self.number_of_owners = len(stake_distribution)
         self.min_stake_amount = min_stake_amount
+        self.metrics = metrics.Model_Metrics(max_malicious_threshold_percent, failed_signature_threshold) # running aggregates behind the model reporters
+        self.archive = archive.Agent_Archive() # final state of every retired group and signature
+        self.finished_agents = [] # groups and signatures that reached a terminal state this block
+        self.lottery = selection.Ticket_Lottery(lottery_mode, self.rng["lottery"], tilt_target) # group selection engine, "exact" reproduces per-node ticket draws, "tilted" oversamples malicious seats
         self.datacollector = DataCollector(
             model_reporters = {"# of Active Groups":"num_active_groups",
              "# of Active Nodes":"num_active_nodes",
@@ -54,141 +77,249 @@ class Beacon_Model(Model):
              "% Compromised Groups": "perc_compromised_groups",
              "Median Lynchpin %":"median_lynchpinned_signatures_percents",
              "% Lynchpinned signatures":"perc_lynchpinned_signatures",
-             "Failed Singature %" : "perc_failed_signatures" },
-            agent_reporters={"ID": "id" , 
-            "Type" : "type",
-            "Node Status (Connection_Mainloop_Stake)": lambda x : str(x.connection_status) if x.type == "node" else None,
-            "Status": lambda x: x.status if x.type == "group" or x.type == "signature" else None, 
-            "Malicious": lambda x : x.malicious if x.type == "node" else None,
-            "DKG Block Delay" : lambda x : x.dkg_block_delay if x.type =="group" else None,
-            "Ownership Distribution" : lambda x : x.ownership_distr if x.type =="group" or x.type == "signature" else None,
-            "Malicious %" : lambda x : x.malicious_percent if x.type == "group" else None,
-            "Offline %" : lambda x : x.offline_percent if x.type == "group" or x.type == "signature" else None,
-            "Lynchpin %": lambda x : x.lynchpin_percent if x.type == "signature" else None,
-            "Owner": lambda x : x.node_operator if x.type == "node" else None})
-
-        #create log file
-        log.basicConfig(filename=log_filename + str(run_number), filemode='w', format='%(name)s - %(levelname)s - %(message)s')
-        self.log = log
+             "Failed Singature %" : "perc_failed_signatures" })
+        # per-agent data is recorded by the optional columnar recorder (see recorder.Data_Recorder)
+        self.recorder = recorder
+
+        # structured event trace, only recorded when a tracing.Event_Tracer is given
+        self.tracer = tracer
+
+        # per-phase step timings and counts, only recorded when a profiling.Step_Profiler is given
+        self.profiler = profiler
+
+        # closed-form chance of every group being compromised and every signature failing, see control_values
+        self.control_variates = control_variates
+
+        #create log file: each model gets its own logger, so every run in a process logs to its own file
+        #the file is only created once something is logged at log_level or above
+        self.log_filename = log_filename
+        self.run_number = run_number
+        self.log_level = log_level
+        self.create_log()
 
         print("creating nodes")
         #create nodes
-        if operator_mode == 1: # owners nodes are proportional to its total stake amt
-            for i in range(self.number_of_owners): 
-                total_owner_nodes = math.floor(self.stake_distribution[i]/self.min_stake_amount)
-                tickets = min_stake_amount
-                for j in range(total_owner_nodes):
-                    malicious = np.random.randint(0,100)<30
-                    node = agent.Node(self.newest_id, self, 
-                    tickets, 
-                    node_failure_percent, 
-                    node_death_percent, 
-                    node_connection_delay, 
-                    node_mainloop_connection_delay,
-                    i,# operator
-                    malicious
-                    )
-                    self.schedule.add(node)
-                    self.num_nodes+=1
-        elif operator_mode == 2: # 1 node per owner
-            for i in range(self.number_of_owners):
-                malicious = np.random.randint(0,100)<30 
-                tickets = self.stake_distribution[i]
-                node = agent.Node(self.newest_id, self, 
-                tickets, 
-                node_failure_percent, 
-                node_death_percent, 
-                node_connection_delay, 
-                node_mainloop_connection_delay,
-                i,# operator
-                malicious
-                )
-                self.schedule.add(node)
-                self.num_nodes+=1
+        if aggregate_nodes: # identical nodes of an operator are held as counts, see node_table.Node_Class_Table
+            if lottery_mode != "sample":
+                raise ValueError("aggregated nodes only support the sample lottery mode")
+            if recorder is not None and "node" in recorder.tables:
+                raise ValueError("aggregated nodes cannot be recorded per node")
+            owner_nodes, owner_tickets = node_table.owner_nodes(self.stake_distribution, self.min_stake_amount, operator_mode)
+            malicious_nodes = self.rng["malicious"].binomial(owner_nodes, 0.3) # each node is malicious with 30% probability
+            self.nodes = node_table.Node_Class_Table(self, owner_nodes, owner_tickets, malicious_nodes,
+            node_failure_percent,
+            node_death_percent,
+            node_connection_delay)
+        else:
+            operators, tickets = node_table.node_columns(self.stake_distribution, self.min_stake_amount, operator_mode)
+            malicious = self.rng["malicious"].integers(0, 100, len(operators))<30
+            self.nodes = node_table.Node_Table(self, tickets, operators, malicious,
+            node_failure_percent,
+            node_death_percent,
+            node_connection_delay,
+            event_driven = scheduler_mode == "event")
+        self.num_nodes = self.nodes.num_nodes
+        self.newest_id += self.num_nodes # node ids are their row in the node table
+        self.active_nodes = node_table.Active_Nodes(self.nodes)
+        self.inactive_nodes = node_table.Active_Nodes(self.nodes, connected = False)
 
 
 
     def step(self):
         '''Advance the model by one step'''
  
-        log.debug("Number of nodes in the forked state = " + str(len(self.active_nodes)))
+        self.log.debug("Number of nodes in the forked state = %d", len(self.active_nodes))
+        profiler = self.profiler
+        if profiler is not None:
+            phase_start = profiler.start_block(self)
 
         #bootstrap active groups as nodes become available. Can only happen once enough nodes are online
         if self.bootstrap_complete == False:
-            log.debug("bootstrapping active groups")
+            self.log.debug("bootstrapping active groups")
             if len(self.active_nodes)>=self.group_formation_threshold:
                 for i in range(self.active_group_threshold):
                     new_group = self.group_registration()
                     self.active_groups[new_group.id] = new_group
                 self.bootstrap_complete = True
+        if profiler is not None:
+            phase_start = profiler.lap("bootstrap", phase_start)
         
         #generate relay requests
-        self.relay_request = np.random.choice([True,False]) # make this variable so it can be what-if'd
-        log.debug("relay request recieved? = "+ str(self.relay_request))
+        self.relay_request = self.relay_draws.next() < self.relay_request_probability
+        self.log.debug("relay request recieved? = %s", self.relay_request)
 
         if self.relay_request:
-            try:
-                log.debug('     selecting group at random')
+            if self.active_groups:
+                self.log.debug('     selecting group at random')
                 # pick an active group from the active group list and create a signature object
-                signature = agent.Signature(self.newest_id, self, self.active_groups[rnd.choice(list(self.active_groups))]) 
+                group_ids = list(self.active_groups)
+                group_id = group_ids[int(self.relay_draws.next() * len(group_ids))]
+                signature = agent.Signature(self.newest_id, self, self.active_groups[group_id]) 
             
                 self.schedule.add(signature)
-            except:
-                log.debug('     no active groups available')
+                self.metrics.signature_started(signature)
+                if self.tracer is not None:
+                    self.tracer.record(self.timer, tracing.SIGNATURE_STARTED, signature.id, group_id)
+            else:
+                self.log.debug('     no active groups available')
 
-            log.debug('     registering new group')
+            self.log.debug('     registering new group')
             self.group_registration()
         else:
-            log.debug("     No relay request")
+            self.log.debug("     No relay request")
         self.timer += 1
+        if profiler is not None:
+            phase_start = profiler.lap("relay", phase_start)
 
         #calculate model measurements
         self.calculate_compromised_groups()
+        if profiler is not None:
+            phase_start = profiler.lap("calculate_compromised_groups", phase_start)
         self.calculate_lynchpinned_signatures()
+        if profiler is not None:
+            phase_start = profiler.lap("calculate_lynchpinned_signatures", phase_start)
         
-        #advance the agents
+        #advance the nodes in one batched update, then the groups and signatures
+        self.nodes.step()
+        if profiler is not None:
+            phase_start = profiler.lap("node_step", phase_start)
         self.schedule.step()
         self.num_active_nodes = len(self.active_nodes)
         self.num_active_groups = len(self.active_groups)
+        if profiler is not None:
+            profiler.lap("schedule_step", phase_start)
+            profiler.count_stepped(self)
+            phase_start = profiler.clock() # the profiler's own bookkeeping is left out of the phases
         self.datacollector.collect(self)
+        if profiler is not None:
+            phase_start = profiler.lap("datacollector_collect", phase_start)
+        if self.recorder is not None:
+            self.recorder.collect(self)
+        if profiler is not None:
+            phase_start = profiler.lap("recorder_collect", phase_start)
+        self.retire_finished_agents()
+        if profiler is not None:
+            profiler.lap("retire", phase_start)
+            profiler.end_block(self)
 
     def group_registration(self):
-        ticket_list = {}
-        group_members = []
-
         if len(self.active_nodes)<self.group_formation_threshold: 
-            log.debug("             Not enough nodes to register a group")
+            self.log.debug("             Not enough nodes to register a group")
 
         else:
-            # make each active node generate tickets and save them to a list
-            counter = 0
-            for node_id in self.active_nodes:
-                counter +=0.00000001
-                self.active_nodes[node_id].generate_tickets()
-                # converts the list to a dict with key value as the ticket number + counter and value as node id
-                # adding a counter helps take care of repeated keys
-                temp_ticket_dict = {i : node_id for i in (self.active_nodes[node_id].ticket_list + counter)}
-                ticket_list.update(temp_ticket_dict)
-            
-            # sort the dict and pick n smallest values 
-            group_list = sorted(ticket_list.items())[0:self.group_size]
-
-            # add create the list of member nodes
-            for node_id in group_list:
-                group_members.append(self.active_nodes[node_id[1]]) # pick the node with the given ID from the active nodes list
+            profiler = self.profiler
+            if profiler is not None:
+                registration_start = profiler.clock()
+            if self.control_variates:
+                import analysis
+                total_tickets, malicious_tickets = self.nodes.candidate_tickets()
+                expected_compromise = analysis.compromise_probability(total_tickets, malicious_tickets, self.group_size, self.max_malicious_threshold_percent)
+            # run the ticket lottery over the tickets held by every active node
+            group_members = self.nodes.select_group(self.lottery, self.group_size) # node id of every winning ticket
             
             #create a group agent which can track expiry, sign, etc
             group_object = agent.Signing_Group(self.newest_id, self, group_members, self.group_expiry)
+            if self.control_variates:
+                group_object.expected_compromise = expected_compromise
 
 
             #add group to schedule
             self.schedule.add(group_object)
+            self.metrics.group_registered(group_object)
+            if self.tracer is not None:
+                self.tracer.record(self.timer, tracing.GROUP_REGISTERED, group_object.id)
 
             #add group to active group list
             self.active_groups[group_object.id] = group_object
+            if profiler is not None:
+                profiler.registration(registration_start, self.lottery.tickets_generated)
             
             return group_object
 
+    def retire_finished_agents(self):
+        # move expired groups and completed signatures out of the schedule and into the archive
+        for finished in self.finished_agents:
+            self.schedule.remove(finished)
+            if hasattr(self, "deregister_agent"):
+                self.deregister_agent(finished) # newer Mesa versions also keep a registry of every agent
+            self.archive.retire(finished, self.timer)
+        self.finished_agents = []
+
+    def group_history(self):
+        # every group created so far, retired or live
+        return self.archive.history("group", self.schedule.agents)
+
+    def signature_history(self):
+        # every signature created so far, retired or live
+        return self.archive.history("signature", self.schedule.agents)
+
+    def create_log(self):
+        self.log = log.Logger("beacon_model." + str(self.run_number), self.log_level)
+        log_handler = log.FileHandler(self.log_filename + str(self.run_number), mode='w', delay=True)
+        log_handler.setFormatter(log.Formatter('%(name)s - %(levelname)s - %(message)s'))
+        self.log.addHandler(log_handler)
+
+    def __getstate__(self):
+        # the logger is rebuilt on restore; recorder, tracer and profiler stay with the original model
+        state = dict(self.__dict__)
+        state["log"] = None
+        state["recorder"] = None
+        state["tracer"] = None
+        state["profiler"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.create_log()
+
+    def set_node_failures(self, node_failure_percent = None, node_death_percent = None):
+        # changes the churn of every node from the next block on
+        self.nodes.set_churn(node_failure_percent, node_death_percent)
+
+    def set_thresholds(self, max_malicious_threshold_percent = None, failed_signature_threshold = None):
+        """ changes the compromised/lynchpin and failed signature thresholds; the running counts
+        are rebuilt from the archived and live groups and signatures """
+        if max_malicious_threshold_percent is not None:
+            self.max_malicious_threshold_percent = max_malicious_threshold_percent
+        if failed_signature_threshold is not None:
+            self.failed_signature_threshold = failed_signature_threshold
+        live_groups = [live for live in self.schedule.agents if live.type == "group"]
+        live_signatures = [live for live in self.schedule.agents if live.type == "signature"]
+        self.metrics.recount(self.max_malicious_threshold_percent, self.failed_signature_threshold,
+        np.concatenate([self.archive.groups.column("malicious_percent"), [group.malicious_percent for group in live_groups]]),
+        [np.concatenate([self.archive.signatures.column(column), [getattr(signature, column) for signature in live_signatures]])
+        for column in ("lynchpin_percent", "operator_lynchpin_percent", "offline_percent")])
+        # completed signatures are all archived by the end of the block they complete in
+        self.metrics.recount_weighted(
+        np.concatenate([self.archive.groups.column("malicious_percent"), [group.malicious_percent for group in live_groups]]),
+        np.concatenate([self.archive.groups.column("weight"), [group.weight for group in live_groups]]),
+        [self.archive.signatures.column(column) for column in ("lynchpin_percent", "operator_lynchpin_percent", "offline_percent")],
+        self.archive.signatures.column("weight"))
+
+    def control_values(self):
+        """ observed compromised group and failed signature rates with the closed-form chance of
+        the same events given each group's candidates and each signature's nodes (see
+        analysis.compromise_probability and analysis.sigfail_probability). Observed minus expected
+        has mean zero, so sweeps use it as a control variate. Signatures count once complete and
+        the expected values follow the thresholds in force when each agent was counted """
+        groups = self.metrics.total_groups
+        signatures = self.metrics.weighted["failed_signatures"].observations
+        return {"% Compromised Groups" : {"observed" : self.metrics.compromised_groups/groups if groups else float("nan"),
+        "expected" : self.metrics.expected["compromised_groups"]/groups if groups else float("nan")},
+        "Failed Singature %" : {"observed" : self.metrics.weighted["failed_signatures"].hits/signatures if signatures else float("nan"),
+        "expected" : self.metrics.expected["failed_signatures"]/signatures if signatures else float("nan")}}
+
+    def rare_event_estimates(self, confidence = 0.95):
+        """ likelihood ratio weighted estimates of the compromised group, lynchpinned, operator
+        lynchpinned and failed signature probabilities, with confidence intervals; unbiased with
+        the tilted lottery, plain frequencies otherwise. Signatures count once complete """
+        return {reporter : self.metrics.weighted[count].estimate(confidence)
+        for count, reporter in metrics.WEIGHTED_COUNTS.items()}
+
+    def set_signature_delay(self, signature_delay):
+        self.signature_delay = signature_delay
+        self.signature_delay_draws = self.rng.buffered("signature_delay", "poisson", signature_delay)
+
     def refresh_active_group_list(self):
         temp_list = {}
 
@@ -199,87 +330,20 @@ class Beacon_Model(Model):
         self.active_groups = temp_list
 
     def refresh_connected_nodes_list(self):
-        log.debug("refreshing active nodes list")
-        temp_active_node_list = {}
-        temp_inactive_node_list = {}
-        for agent in self.schedule.agents:
-            if agent.type == "node":
-                if agent.connection_status == "connected": 
-                    temp_active_node_list[agent.id] = agent #adds the node to the active list only if it is in the connected
-                
-                else:
-                    temp_inactive_node_list[agent.id] = agent
-        self.active_nodes = temp_active_node_list
-        self.inactive_nodes = temp_inactive_node_list
+        # the active and inactive node lists are live views of the node table
+        self.log.debug("refreshing active nodes list")
+        self.active_nodes = node_table.Active_Nodes(self.nodes)
+        self.inactive_nodes = node_table.Active_Nodes(self.nodes, connected = False)
 
     def calculate_compromised_groups(self):
-    #Calculate compromised groups
-        malicious_array = []
-        total_groups = 0
-        for group in self.schedule.agents:
-            if group.type == "group":
-                total_groups +=1
-                malicious_array.append(group.malicious_percent) #creates an array of malicious percents for each group
-        self.median_malicious_group_percents = np.median(malicious_array)
-        self.perc_compromised_groups = sum(np.array(malicious_array)>=self.max_malicious_threshold_percent)/(total_groups+0.000000000000000001)
+    #Calculate compromised groups from the running aggregates updated at group registration
+        self.median_malicious_group_percents = self.metrics.median_malicious_group_percent()
+        self.perc_compromised_groups = self.metrics.compromised_groups/(self.metrics.total_groups+0.000000000000000001)
 
     def calculate_lynchpinned_signatures(self):
-        lynchpin_array = []
-        operator_lynchpin_array = []
-        lynchpin_count = 0
-        operator_lynchpin_count = 0
-        total_signatures = 0
-        failed_signatures = 0
-        for signature in self.schedule.agents:
-            if signature.type == "signature":
-                total_signatures +=1
-                lynchpin_array.append(signature.operator_lynchpin_percent)
-                operator_lynchpin_array.append(signature.operator_lynchpin_percent)
-                lynchpin_count += (signature.lynchpin_percent>=self.max_malicious_threshold_percent)
-                operator_lynchpin_count += (signature.operator_lynchpin_percent>=self.max_malicious_threshold_percent)
-                failed_signatures += (signature.offline_percent>=self.failed_signature_threshold)
-
-        self.perc_failed_signatures = failed_signatures/(total_signatures+0.00000000000000001)
-        self.median_lynchpinned_signatures_percents = np.median(lynchpin_array)
-        self.perc_lynchpinned_signatures = lynchpin_count/(total_signatures+0.00000000000000001)
+    #Calculate signature measures from the running aggregates updated when signatures start and complete
+        total_signatures = self.metrics.total_signatures
+        self.perc_failed_signatures = self.metrics.failed_signatures/(total_signatures+0.00000000000000001)
+        self.median_lynchpinned_signatures_percents = self.metrics.median_operator_lynchpin_percent()
+        self.perc_lynchpinned_signatures = self.metrics.lynchpinned_signatures/(total_signatures+0.00000000000000001)
         self.total_signatures = total_signatures
-
-
-def create_cdf(nodes,ticket_distr):
-# Create CDF's - used to determine max ownership ticket index
-    cdf = np.zeros(nodes)
-    for node,ticketmax in enumerate(ticket_distr):
-        
-        cdf[node]=sum(ticket_distr[0:node+1])
-    return cdf
-
-
-
-            
-            
-
-
-
-
-
-    
-
-
-
-
-
-
-
-
-
-
-        
-
-        
-
-
-
-
-
-
-
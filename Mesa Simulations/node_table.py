@@ -0,0 +1,483 @@
+import numpy as np
+import agent
+import selection
+import tracing
+
+def owner_nodes(stake_distribution, min_stake_amount, operator_mode):
+    """ number of nodes of every owner and the tickets held by each of its nodes """
+    stake_distribution = np.asarray(stake_distribution, dtype=float)
+    if operator_mode == 1: # owners nodes are proportional to its total stake amt
+        nodes = np.floor(stake_distribution/min_stake_amount).astype(np.int64)
+        tickets = np.full(len(stake_distribution), min_stake_amount, dtype=np.int64)
+    elif operator_mode == 2: # 1 node per owner
+        nodes = np.ones(len(stake_distribution), dtype=np.int64)
+        tickets = stake_distribution.astype(np.int64)
+    else:
+        raise ValueError("unknown operator mode: " + str(operator_mode))
+    return nodes, tickets
+
+def node_columns(stake_distribution, min_stake_amount, operator_mode):
+    """ operator and ticket count of every node created from the stake distribution """
+    nodes, tickets = owner_nodes(stake_distribution, min_stake_amount, operator_mode)
+    operators = np.repeat(np.arange(len(nodes)), nodes)
+    return operators, np.repeat(tickets, nodes)
+
+
+class Node_Table():
+    """ Struct-of-arrays store for every node in the network.
+    Each column holds one node attribute indexed by node id, so failure, death and
+    reconnection are applied to the whole network with one batched update per block """
+    def __init__(self, model, tickets, operator, malicious,
+    failure_percent, death_percent, node_connection_delay, event_driven = False):
+        self.model = model
+        self.rng = model.rng["churn"]
+        self.num_nodes = len(tickets)
+        n = self.num_nodes
+
+        self.tickets = np.asarray(tickets, dtype=np.int64)
+        self.operator = np.asarray(operator, dtype=np.int64)
+        self.malicious = np.asarray(malicious, dtype=bool)
+        self.failure_percent = np.broadcast_to(np.asarray(failure_percent, dtype=float), (n,)).copy()
+        self.death_percent = np.broadcast_to(np.asarray(death_percent, dtype=float), (n,)).copy()
+        self.connected = np.zeros(n, dtype=bool)
+        self.connection_failure = np.zeros(n, dtype=bool)
+        self.death = np.zeros(n, dtype=bool)
+        #uniform randomly assigned connection delay step value
+        if node_connection_delay > 0:
+            self.connection_delay = self.rng.integers(0, node_connection_delay, n)
+        else:
+            self.connection_delay = np.zeros(n, dtype=np.int64)
+        self.num_connected = 0
+        self.views = {} # Node objects handed out so far, created on demand
+        self.steps = 0
+        self.changed = 0 # nodes whose state changed in the last event-driven step
+
+        # event-driven mode: instead of a coin flip per node per block, each node's next
+        # state change is drawn ahead and kept in a timing wheel keyed by step
+        self.event_driven = event_driven
+        if event_driven:
+            # randint(0,100) < x fires with probability ceil(x)/100
+            self.failure_probability = np.clip(np.ceil(self.failure_percent), 0, 100)/100
+            self.death_probability = np.clip(np.ceil(self.death_percent), 0, 100)/100
+            self.disconnect_probability = 1 - (1 - self.failure_probability)*(1 - self.death_probability)
+            self.wheel = {} # step -> arrays of node ids whose state changes at that step
+            self.next_change = self.connection_delay + 1 # a node connects the step after its delay has run out
+            self.flagged = np.array([], dtype=np.int64) # nodes whose failure flags were set in the last step
+            self.schedule_changes(np.arange(n))
+
+    def step(self):
+        """ simulate node failure for every node and reconnect the nodes whose delay has run out """
+        self.steps += 1
+        if self.event_driven:
+            self.step_events()
+            return
+        draws = self.rng.integers(0, 100, (2, self.num_nodes))
+        self.connection_failure = draws[0] < self.failure_percent
+        self.death = draws[1] < self.death_percent
+
+        #disconnect the nodes where a failure occurs
+        disconnect = (self.connection_failure | self.death) & self.connected
+        #the remaining nodes count down their delay, and connect once it has run out
+        waiting = ~disconnect & (self.connection_delay > 0)
+        reconnect = ~disconnect & ~waiting
+
+        tracer = self.model.tracer
+        if tracer is not None:
+            tracer.record_many(self.model.timer, tracing.NODE_DISCONNECT, np.flatnonzero(disconnect))
+            tracer.record_many(self.model.timer, tracing.NODE_CONNECT, np.flatnonzero(reconnect & ~self.connected))
+
+        self.connection_delay[waiting] -= 1
+        self.connected[disconnect] = False
+        self.connected[reconnect] = True
+        self.num_connected = int(np.count_nonzero(self.connected))
+
+    def step_events(self):
+        """ applies only the state changes due at this step: disconnections drawn ahead by
+        geometric skip-ahead, and reconnections one step after a disconnection """
+        self.connection_failure[self.flagged] = False
+        self.death[self.flagged] = False
+        self.flagged = np.array([], dtype=np.int64)
+
+        self.changed = 0
+        due = self.wheel.pop(self.steps, None)
+        if due is None:
+            return
+        due = np.concatenate(due)
+        due = due[self.next_change[due] == self.steps] # drop changes superseded by a manual disconnect
+        self.changed = len(due)
+        disconnect = due[self.connected[due]]
+        reconnect = due[~self.connected[due]]
+
+        tracer = self.model.tracer
+        if tracer is not None:
+            tracer.record_many(self.model.timer, tracing.NODE_DISCONNECT, disconnect)
+            tracer.record_many(self.model.timer, tracing.NODE_CONNECT, reconnect)
+
+        # a disconnection is a failure, a death or both, in proportion to their probabilities
+        failure = self.failure_probability[disconnect]
+        death = self.death_probability[disconnect]
+        cause = self.rng.random(len(disconnect)) * self.disconnect_probability[disconnect]
+        self.connection_failure[disconnect] = cause >= death*(1 - failure)
+        self.death[disconnect] = cause < death*(1 - failure) + failure*death
+        self.flagged = disconnect
+
+        self.connected[disconnect] = False
+        self.next_change[disconnect] = self.steps + 1 # the delay has already run out, so it reconnects next step
+        self.connected[reconnect] = True
+        self.connection_delay[reconnect] = 0
+        self.num_connected += len(reconnect) - len(disconnect)
+        self.schedule_failures(reconnect)
+        self.schedule_changes(disconnect)
+
+    def schedule_failures(self, node_ids):
+        # steps until a connected node next fails are geometric; nodes that never fail are not scheduled
+        probability = self.disconnect_probability[node_ids]
+        can_fail = probability > 0
+        self.next_change[node_ids[~can_fail]] = -1
+        node_ids = node_ids[can_fail]
+        self.next_change[node_ids] = self.steps + self.rng.geometric(probability[can_fail])
+        self.schedule_changes(node_ids)
+
+    def schedule_changes(self, node_ids):
+        if len(node_ids) == 0:
+            return
+        steps = self.next_change[node_ids]
+        order = np.argsort(steps, kind = "stable")
+        node_ids = node_ids[order]
+        steps = steps[order]
+        boundaries = np.flatnonzero(np.diff(steps)) + 1
+        for chunk in np.split(node_ids, boundaries):
+            self.wheel.setdefault(int(self.next_change[chunk[0]]), []).append(chunk)
+
+    def disconnect(self, node_id):
+        if self.connected[node_id]:
+            self.connected[node_id] = False
+            self.num_connected -= 1
+            if self.model.tracer is not None:
+                self.model.tracer.record(self.model.timer, tracing.NODE_DISCONNECT, node_id)
+            if self.event_driven:
+                self.next_change[node_id] = self.steps + 1
+                self.schedule_changes(np.array([node_id]))
+
+    def set_churn(self, failure_percent = None, death_percent = None):
+        if failure_percent is not None:
+            self.failure_percent[:] = failure_percent
+        if death_percent is not None:
+            self.death_percent[:] = death_percent
+        if self.event_driven:
+            # the steps to the next failure are memoryless, so connected nodes simply redraw them
+            self.failure_probability = np.clip(np.ceil(self.failure_percent), 0, 100)/100
+            self.death_probability = np.clip(np.ceil(self.death_percent), 0, 100)/100
+            self.disconnect_probability = 1 - (1 - self.failure_probability)*(1 - self.death_probability)
+            self.schedule_failures(np.flatnonzero(self.connected))
+
+    def select_group(self, lottery, group_size):
+        """ runs the ticket lottery over the tickets held by every active node and
+        returns the node id of every winning ticket """
+        candidates = self.active_ids()
+        winners = lottery.select(self.tickets[candidates], group_size, self.malicious[candidates])
+        return candidates[winners]
+
+    def candidate_tickets(self):
+        # tickets held by the connected nodes, in total and by the malicious ones
+        tickets = self.tickets[self.connected]
+        return int(tickets.sum()), int(tickets[self.malicious[self.connected]].sum())
+
+    def acquire(self, node_ids):
+        pass # every node is stored individually, see Node_Class_Table
+
+    def release(self, node_ids):
+        pass
+
+    def is_online(self, node_ids):
+        return self.connected[node_ids]
+
+    def is_malicious(self, node_ids):
+        return self.malicious[node_ids]
+
+    def operator_of(self, node_ids):
+        return self.operator[node_ids]
+
+    def active_ids(self):
+        return np.flatnonzero(self.connected)
+
+    def view(self, node_id):
+        # returns the Node object for a node id, creating it the first time it is requested
+        node = self.views.get(node_id)
+        if node is None:
+            node = agent.Node(self, node_id)
+            self.views[node_id] = node
+        return node
+
+    def __len__(self):
+        return self.num_nodes
+
+    def __iter__(self):
+        for node_id in range(self.num_nodes):
+            yield self.view(node_id)
+
+
+class Node_Class_Table():
+    """ Aggregated node store for very large networks. The identical nodes of an operator
+    form a class per malicious flag, held as counts: how many are connected and how many
+    are waiting out each value of the reconnection delay. Churn is applied to the counts
+    with binomial draws, so memory and runtime follow the number of classes, not nodes.
+
+    A node only gets an id and a row of its own (it is materialized) when it wins a seat,
+    and goes back into its class counts when no live group or signature holds it any more.
+    Anonymous and materialized nodes follow the same churn, so group composition and
+    online status are distributed as in Node_Table. Ids of released nodes are reused.
+    The lottery draws distinct tickets uniformly, like the "sample" lottery mode """
+    def __init__(self, model, owner_nodes, owner_tickets, malicious_nodes,
+    failure_percent, death_percent, node_connection_delay):
+        self.model = model
+        self.rng = model.rng["churn"]
+        self.event_driven = False
+        self.steps = 0
+
+        #classes: the honest and the malicious nodes of every operator
+        owner_nodes = np.asarray(owner_nodes, dtype=np.int64)
+        malicious_nodes = np.asarray(malicious_nodes, dtype=np.int64)
+        operators = np.arange(len(owner_nodes))
+        class_nodes = np.concatenate([owner_nodes - malicious_nodes, malicious_nodes])
+        keep = class_nodes > 0
+        self.class_nodes = class_nodes[keep]
+        self.class_operator = np.concatenate([operators, operators])[keep]
+        self.class_malicious = np.concatenate([np.zeros(len(operators), dtype=bool), np.ones(len(operators), dtype=bool)])[keep]
+        self.class_tickets = np.concatenate([owner_tickets, owner_tickets])[keep].astype(np.int64)
+        self.num_classes = len(self.class_nodes)
+        self.num_nodes = int(self.class_nodes.sum())
+
+        # randint(0,100) < x fires with probability ceil(x)/100
+        self.node_failure_percent = failure_percent
+        self.node_death_percent = death_percent
+        self.disconnect_probability = 1 - (1 - min(max(np.ceil(failure_percent), 0), 100)/100)*(1 - min(max(np.ceil(death_percent), 0), 100)/100)
+
+        #anonymous nodes: connected count and, per delay value, the disconnected nodes waiting it out
+        delays = max(node_connection_delay, 1)
+        self.anonymous_connected = np.zeros(self.num_classes, dtype=np.int64)
+        self.anonymous_waiting = self.rng.multinomial(self.class_nodes, np.full(delays, 1/delays))
+        self.num_connected = 0
+
+        #materialized nodes, one row each; class -1 marks a free row
+        self.capacity = 0
+        self.node_class = np.zeros(0, dtype=np.int64)
+        self.references = np.zeros(0, dtype=np.int64)
+        self.tickets = np.zeros(0, dtype=np.int64)
+        self.operator = np.zeros(0, dtype=np.int64)
+        self.malicious = np.zeros(0, dtype=bool)
+        self.failure_percent = np.zeros(0, dtype=float)
+        self.death_percent = np.zeros(0, dtype=float)
+        self.connected = np.zeros(0, dtype=bool)
+        self.connection_delay = np.zeros(0, dtype=np.int64)
+        self.connection_failure = np.zeros(0, dtype=bool)
+        self.death = np.zeros(0, dtype=bool)
+        self.free = []
+        self.materialized = 0
+        self.views = {}
+        self.grow(min(1024, self.num_nodes))
+
+    def grow(self, capacity):
+        capacity = min(max(capacity, 1), self.num_nodes)
+        added = capacity - self.capacity
+        if added <= 0:
+            return
+        for name, fill in [("node_class", -1), ("references", 0), ("tickets", 0), ("operator", 0), ("malicious", False),
+        ("failure_percent", self.node_failure_percent), ("death_percent", self.node_death_percent), ("connected", False), ("connection_delay", 0), ("connection_failure", False), ("death", False)]:
+            values = getattr(self, name)
+            setattr(self, name, np.concatenate([values, np.full(added, fill, dtype=values.dtype)]))
+        self.free.extend(range(capacity - 1, self.capacity - 1, -1)) # lowest ids are handed out first
+        self.capacity = capacity
+
+    def step(self):
+        """ churn for every class count and every materialized node """
+        self.steps += 1
+        #anonymous nodes: connected nodes fail, waiting nodes count down, nodes at delay 0 reconnect
+        disconnect = self.rng.binomial(self.anonymous_connected, self.disconnect_probability)
+        self.anonymous_connected += self.anonymous_waiting[:, 0] - disconnect
+        self.anonymous_waiting[:, 0:-1] = self.anonymous_waiting[:, 1:]
+        self.anonymous_waiting[:, -1] = 0
+        self.anonymous_waiting[:, 0] += disconnect
+
+        #materialized nodes, as in Node_Table.step
+        rows = np.flatnonzero(self.node_class >= 0)
+        draws = self.rng.integers(0, 100, (2, len(rows)))
+        connection_failure = draws[0] < self.failure_percent[rows]
+        death = draws[1] < self.death_percent[rows]
+        self.connection_failure[:] = False
+        self.death[:] = False
+        self.connection_failure[rows] = connection_failure
+        self.death[rows] = death
+        disconnect = (connection_failure | death) & self.connected[rows]
+        waiting = ~disconnect & (self.connection_delay[rows] > 0)
+        reconnect = rows[~disconnect & ~waiting]
+        disconnect = rows[disconnect]
+        waiting = rows[waiting]
+
+        tracer = self.model.tracer
+        if tracer is not None:
+            tracer.record_many(self.model.timer, tracing.NODE_DISCONNECT, disconnect)
+            tracer.record_many(self.model.timer, tracing.NODE_CONNECT, reconnect[~self.connected[reconnect]])
+
+        self.connection_delay[waiting] -= 1
+        self.connected[disconnect] = False
+        self.connected[reconnect] = True
+        self.num_connected = int(self.anonymous_connected.sum()) + int(np.count_nonzero(self.connected))
+
+    def set_churn(self, failure_percent = None, death_percent = None):
+        if failure_percent is not None:
+            self.node_failure_percent = failure_percent
+            self.failure_percent[:] = failure_percent
+        if death_percent is not None:
+            self.node_death_percent = death_percent
+            self.death_percent[:] = death_percent
+        self.disconnect_probability = 1 - (1 - min(max(np.ceil(self.node_failure_percent), 0), 100)/100)*(1 - min(max(np.ceil(self.node_death_percent), 0), 100)/100)
+
+    def select_group(self, lottery, group_size):
+        """ draws group_size distinct tickets over the connected nodes of every class and
+        returns the node id of every winning ticket, materializing the anonymous winners """
+        materialized_connected = np.flatnonzero(self.connected)
+        materialized_classes = self.node_class[materialized_connected]
+        order = np.argsort(materialized_classes, kind = "stable")
+        materialized_connected = materialized_connected[order]
+        materialized_counts = np.bincount(materialized_classes, minlength=self.num_classes)
+        materialized_starts = np.cumsum(materialized_counts) - materialized_counts
+
+        class_tickets = (self.anonymous_connected + materialized_counts) * self.class_tickets
+        ticket_cdf = np.cumsum(class_tickets)
+        total_tickets = int(ticket_cdf[-1]) if len(ticket_cdf) else 0
+        positions = selection.sample_without_replacement(total_tickets, min(group_size, total_tickets), lottery.rng)
+        lottery.tickets_generated = len(positions)
+
+        #the winning class, then the winning node within the class: its materialized nodes come first
+        classes = np.searchsorted(ticket_cdf, positions, side = "right")
+        local = (positions - (ticket_cdf[classes] - class_tickets[classes])) // self.class_tickets[classes]
+        members = np.empty(len(positions), dtype=np.int64)
+        existing = local < materialized_counts[classes]
+        members[existing] = materialized_connected[materialized_starts[classes[existing]] + local[existing]]
+
+        #each distinct (class, anonymous index) pair is a distinct node taken out of its class count
+        pairs, inverse = np.unique(np.stack([classes[~existing], local[~existing]]), axis=1, return_inverse=True)
+        members[~existing] = self.materialize(pairs[0])[inverse.ravel()]
+        return members
+
+    def candidate_tickets(self):
+        # tickets held by the connected nodes of every class, in total and by the malicious classes
+        materialized = np.bincount(self.node_class[self.connected & (self.node_class >= 0)], minlength=self.num_classes)
+        tickets = (self.anonymous_connected + materialized) * self.class_tickets
+        return int(tickets.sum()), int(tickets[self.class_malicious].sum())
+
+    def materialize(self, classes):
+        # gives connected anonymous nodes of the given classes a row each
+        if len(self.free) < len(classes):
+            self.grow(max(2 * self.capacity, self.materialized + len(classes)))
+        ids = np.array([self.free.pop() for i in range(len(classes))], dtype=np.int64)
+        np.subtract.at(self.anonymous_connected, classes, 1)
+        self.node_class[ids] = classes
+        self.tickets[ids] = self.class_tickets[classes]
+        self.operator[ids] = self.class_operator[classes]
+        self.malicious[ids] = self.class_malicious[classes]
+        self.connected[ids] = True
+        self.connection_delay[ids] = 0
+        self.references[ids] = 0
+        self.materialized += len(ids)
+        return ids
+
+    def acquire(self, node_ids):
+        self.references[node_ids] += 1
+
+    def release(self, node_ids):
+        """ drops one reference to every node; nodes nobody holds go back into their class counts """
+        self.references[node_ids] -= 1
+        released = node_ids[self.references[node_ids] == 0]
+        if len(released) == 0:
+            return
+        classes = self.node_class[released]
+        connected = self.connected[released]
+        np.add.at(self.anonymous_connected, classes[connected], 1)
+        np.add.at(self.anonymous_waiting, (classes[~connected], self.connection_delay[released[~connected]]), 1)
+        self.node_class[released] = -1
+        self.connected[released] = False
+        self.materialized -= len(released)
+        for node_id in released.tolist():
+            self.views.pop(node_id, None)
+        self.free.extend(released.tolist())
+
+    def disconnect(self, node_id):
+        if self.connected[node_id]:
+            self.connected[node_id] = False
+            self.num_connected -= 1
+            if self.model.tracer is not None:
+                self.model.tracer.record(self.model.timer, tracing.NODE_DISCONNECT, node_id)
+
+    def is_online(self, node_ids):
+        return self.connected[node_ids]
+
+    def is_malicious(self, node_ids):
+        return self.malicious[node_ids]
+
+    def operator_of(self, node_ids):
+        return self.operator[node_ids]
+
+    def active_ids(self):
+        # only materialized nodes have ids
+        return np.flatnonzero(self.connected)
+
+    def view(self, node_id):
+        node = self.views.get(node_id)
+        if node is None:
+            node = agent.Node(self, node_id)
+            self.views[node_id] = node
+        return node
+
+    def __len__(self):
+        return self.num_nodes
+
+
+class Active_Nodes():
+    """ Dict-like view of the connected nodes (node id -> Node), backed by the node table """
+    def __init__(self, table, connected = True):
+        self.table = table
+        self.connected = connected
+
+    def __len__(self):
+        if self.connected:
+            return self.table.num_connected
+        return self.table.num_nodes - self.table.num_connected
+
+    def __contains__(self, node_id):
+        try:
+            return bool(self.table.connected[node_id]) == self.connected
+        except (IndexError, TypeError):
+            return False
+
+    def __getitem__(self, node_id):
+        if node_id not in self:
+            raise KeyError(node_id)
+        return self.table.view(node_id)
+
+    def __iter__(self):
+        return iter(self.ids().tolist())
+
+    def ids(self):
+        if self.connected:
+            return np.flatnonzero(self.table.connected)
+        return np.flatnonzero(~self.table.connected)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self.table.view(node_id) for node_id in self]
+
+    def items(self):
+        return [(node_id, self.table.view(node_id)) for node_id in self]
+
+    def get(self, node_id, default = None):
+        return self[node_id] if node_id in self else default
+
+    def pop(self, node_id):
+        # removing a node from the active view disconnects it
+        node = self[node_id]
+        self.table.disconnect(node_id)
+        return node
@@ -0,0 +1,111 @@
+import sys
+import time
+import numpy as np
+import archive
+
+# phases of Beacon_Model.step, in step order; group_registration runs inside bootstrap and relay
+PHASES = ["bootstrap", "relay", "group_registration", "calculate_compromised_groups",
+"calculate_lynchpinned_signatures", "node_step", "schedule_step", "datacollector_collect",
+"recorder_collect", "retire"]
+
+COUNTS = ["group_registrations", "tickets_generated", "nodes_stepped", "groups_stepped",
+"signatures_stepped", "signatures_processed", "groups_expired"]
+
+MEMORY = ["group_bytes", "signature_bytes", "archive_bytes"]
+
+
+class Step_Profiler():
+    """ Per-phase instrumentation of Beacon_Model.step, switched on per model by passing a
+    profiler (Beacon_Model(..., profiler=...)). Without one the step only pays a few None checks.
+
+    Every block appends one row: the seconds spent in each phase (monotonic clock), the work
+    done (agents stepped by type, tickets generated, signatures processed) and, every
+    memory_interval blocks, the bytes held by live groups, live signatures and the archive
+    (-1 in the other rows). Row i lines up with row i of the datacollector model data.
+    group_registration time is also included in the bootstrap and relay times """
+    columns = dict({"block" : np.int64, "total" : float},
+    **{phase : float for phase in PHASES},
+    **{count : np.int64 for count in COUNTS},
+    **{memory : np.int64 for memory in MEMORY})
+
+    def __init__(self, memory_interval = 10):
+        self.memory_interval = memory_interval
+        self.clock = time.perf_counter
+        self.table = archive.Archive_Table(self.columns)
+        self.row = None
+        self.block_start = 0
+        self.archived_groups = 0
+        self.archived_signatures = 0
+
+    def start_block(self, model):
+        self.row = dict.fromkeys(self.columns, 0)
+        self.block_start = self.clock()
+        return self.block_start
+
+    def lap(self, phase, start):
+        """ adds the time since start to the phase and returns the time the next phase starts """
+        now = self.clock()
+        self.row[phase] += now - start
+        return now
+
+    def registration(self, start, tickets_generated):
+        self.row["group_registration"] += self.clock() - start
+        self.row["group_registrations"] += 1
+        self.row["tickets_generated"] += tickets_generated
+
+    def count_stepped(self, model):
+        # agents about to be stepped by the schedule, by type
+        nodes = model.nodes
+        self.row["nodes_stepped"] = nodes.changed if nodes.event_driven else nodes.num_nodes
+        stepped = getattr(model.schedule, "stepped", None)
+        if stepped is None:
+            stepped = {}
+            for scheduled in model.schedule.agents:
+                stepped[scheduled.type] = stepped.get(scheduled.type, 0) + 1
+        self.row["groups_stepped"] = stepped.get("group", 0)
+        self.row["signatures_stepped"] = stepped.get("signature", 0)
+
+    def end_block(self, model):
+        row = self.row
+        row["block"] = model.timer
+        row["total"] = self.clock() - self.block_start
+
+        # finished groups and signatures are archived in the block they finish
+        row["signatures_processed"] = len(model.archive.signatures) - self.archived_signatures
+        row["groups_expired"] = len(model.archive.groups) - self.archived_groups
+        self.archived_signatures = len(model.archive.signatures)
+        self.archived_groups = len(model.archive.groups)
+
+        if model.timer % self.memory_interval == 0:
+            row["group_bytes"], row["signature_bytes"] = live_agent_bytes(model.schedule.agents)
+            row["archive_bytes"] = sum(values.nbytes for table in (model.archive.groups, model.archive.signatures)
+            for values in table.data.values())
+        else:
+            for memory in MEMORY:
+                row[memory] = -1
+        self.table.append(row)
+
+    def to_dict(self):
+        return self.table.to_dict()
+
+    def to_dataframe(self):
+        return self.table.to_dataframe()
+
+    def summary(self):
+        """ total seconds per phase over every profiled block, slowest first """
+        totals = {phase : float(self.table.column(phase).sum()) for phase in PHASES}
+        return dict(sorted(totals.items(), key = lambda item : -item[1]))
+
+
+def live_agent_bytes(agents):
+    """ approximate bytes held by the live groups and signatures: the objects, their attribute
+    dicts and their member arrays """
+    group_bytes = 0
+    signature_bytes = 0
+    for live in agents:
+        size = sys.getsizeof(live) + sys.getsizeof(live.__dict__) + live.member_ids.nbytes + live.member_counts.nbytes
+        if live.type == "group":
+            group_bytes += size
+        else:
+            signature_bytes += size
+    return group_bytes, signature_bytes
@@ -0,0 +1,246 @@
+import os
+import json
+import shutil
+import weakref
+import tempfile
+import numpy as np
+
+# agent status strings are recorded as small integer codes
+STATUS_CODES = {"dkg" : 0, "active" : 1, "expired" : 2, "started" : 3, "complete" : 4}
+
+# reporters per agent type: column name -> (dtype, function of the agent)
+GROUP_REPORTERS = {"id" : (np.int64, lambda x : x.id),
+"status" : (np.int8, lambda x : STATUS_CODES[x.status]),
+"dkg_block_delay" : (np.int32, lambda x : x.dkg_block_delay),
+"malicious_percent" : (np.float64, lambda x : x.malicious_percent),
+"offline_percent" : (np.float64, lambda x : x.offline_percent)}
+
+SIGNATURE_REPORTERS = {"id" : (np.int64, lambda x : x.id),
+"group_id" : (np.int64, lambda x : x.group.id),
+"status" : (np.int8, lambda x : STATUS_CODES[x.status]),
+"offline_percent" : (np.float64, lambda x : x.offline_percent),
+"lynchpin_percent" : (np.float64, lambda x : x.lynchpin_percent),
+"operator_lynchpin_percent" : (np.float64, lambda x : x.operator_lynchpin_percent)}
+
+# node columns are copied straight out of the node table
+NODE_COLUMNS = {"connected" : np.bool_,
+"connection_delay" : np.int32,
+"malicious" : np.bool_,
+"operator" : np.int64}
+
+# sparse ownership, recorded once per group (at registration) and per signature (at completion)
+OWNERSHIP_COLUMNS = {"agent_id" : np.int64, "node_id" : np.int64, "seats" : np.int32}
+
+
+class Recorder_Table():
+    """ Typed columnar table with a fixed-size chunk buffer.
+    A full chunk is written to disk as one .npy file per column, so the memory held by the
+    table never exceeds one chunk """
+    def __init__(self, name, columns, chunk_size, directory):
+        self.name = name
+        self.columns = {column : np.dtype(dtype) for column, dtype in columns.items()}
+        self.chunk_size = chunk_size
+        self.directory = directory
+        self.buffers = {column : np.empty(chunk_size, dtype=dtype) for column, dtype in self.columns.items()}
+        self.fill = 0
+        self.num_chunks = 0
+        self.num_rows = 0
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    def append(self, values):
+        """ appends a batch of rows given as column name -> array """
+        rows = len(next(iter(values.values())))
+        offset = 0
+        while offset < rows:
+            take = min(rows - offset, self.chunk_size - self.fill)
+            for column, buffer in self.buffers.items():
+                buffer[self.fill:self.fill + take] = values[column][offset:offset + take]
+            self.fill += take
+            offset += take
+            if self.fill == self.chunk_size:
+                self.flush()
+        self.num_rows += rows
+
+    def flush(self):
+        if self.fill == 0:
+            return
+        for column, buffer in self.buffers.items():
+            np.save(chunk_path(self.directory, self.name, self.num_chunks, column), buffer[0:self.fill])
+        self.num_chunks += 1
+        self.fill = 0
+
+    def chunks(self):
+        """ yields every chunk recorded so far as column name -> array, including the unflushed buffer """
+        for chunk in range(self.num_chunks):
+            yield load_chunk(self.directory, self.name, chunk, self.columns)
+        if self.fill > 0:
+            yield {column : buffer[0:self.fill] for column, buffer in self.buffers.items()}
+
+    def column(self, column):
+        return concatenate_column(self.chunks(), column, self.columns[column])
+
+    def to_dataframe(self):
+        return table_dataframe(self.chunks(), self.columns)
+
+    def manifest(self):
+        return {"columns" : {column : dtype.str for column, dtype in self.columns.items()},
+        "chunks" : self.num_chunks,
+        "rows" : self.num_rows}
+
+
+class Data_Recorder():
+    """ Columnar replacement for the DataCollector agent reporters.
+    Records the selected per-agent-type tables every `interval` blocks. The ownership table
+    is recorded every block whatever the interval: it holds one entry per group registration
+    and signature completion, and those happen between the sampled blocks too.
+
+    tables: any of "node", "group", "signature", "ownership"
+    columns: optional dict of table -> list of columns to keep
+    directory: where chunks are flushed; None flushes them to a temporary directory that is
+    removed with the recorder. Either way at most one chunk per table is held in memory """
+    def __init__(self, directory = None, tables = ("group", "signature", "ownership"),
+    interval = 1, chunk_size = 65536, columns = None):
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="beacon_recording_")
+            weakref.finalize(self, shutil.rmtree, directory, True)
+        self.directory = directory
+        self.interval = interval
+        self.group_reporters = select_columns(GROUP_REPORTERS, columns, "group")
+        self.signature_reporters = select_columns(SIGNATURE_REPORTERS, columns, "signature")
+        self.node_columns = select_columns(NODE_COLUMNS, columns, "node")
+        self.last_group_id = -1 # groups are recorded in the ownership table once, in id order
+        os.makedirs(directory, exist_ok=True)
+
+        self.tables = {}
+        for name in tables:
+            if name == "group":
+                table_columns = {column : dtype for column, (dtype, _) in self.group_reporters.items()}
+            elif name == "signature":
+                table_columns = {column : dtype for column, (dtype, _) in self.signature_reporters.items()}
+            elif name == "node":
+                table_columns = dict(self.node_columns, id = np.int64)
+            elif name == "ownership":
+                table_columns = dict(OWNERSHIP_COLUMNS)
+            else:
+                raise ValueError("unknown recorder table: " + str(name))
+            table_columns = dict(step = np.int64, **table_columns)
+            self.tables[name] = Recorder_Table(name, table_columns, chunk_size, directory)
+
+    def collect(self, model):
+        sampled = model.timer % self.interval == 0
+        if not sampled and "ownership" not in self.tables:
+            return
+        groups = []
+        signatures = []
+        for agent in model.schedule.agents:
+            if agent.type == "group":
+                groups.append(agent)
+            elif agent.type == "signature":
+                signatures.append(agent)
+
+        # completed signatures are retired right after this collect, so ownership is taken every block
+        if "ownership" in self.tables:
+            new_groups = [group for group in groups if group.id > self.last_group_id]
+            completed = [signature for signature in signatures if signature.status == "complete"]
+            self.record_ownership(model.timer, new_groups + completed)
+            if new_groups:
+                self.last_group_id = max(group.id for group in new_groups)
+        if not sampled:
+            return
+
+        if "group" in self.tables:
+            self.record_agents("group", model.timer, groups, self.group_reporters)
+        if "signature" in self.tables:
+            self.record_agents("signature", model.timer, signatures, self.signature_reporters)
+        if "node" in self.tables:
+            self.record_nodes(model)
+
+    def record_agents(self, name, step, agents, reporters):
+        values = {column : np.fromiter((report(agent) for agent in agents), dtype=dtype, count=len(agents))
+        for column, (dtype, report) in reporters.items()}
+        values["step"] = np.full(len(agents), step, dtype=np.int64)
+        self.tables[name].append(values)
+
+    def record_nodes(self, model):
+        nodes = model.nodes
+        values = {column : getattr(nodes, column) for column in self.node_columns}
+        values["id"] = np.arange(nodes.num_nodes)
+        values["step"] = np.full(nodes.num_nodes, model.timer, dtype=np.int64)
+        self.tables["node"].append(values)
+
+    def record_ownership(self, step, agents):
+        if not agents:
+            return
+        counts = [len(agent.member_ids) for agent in agents]
+        values = {"agent_id" : np.repeat([agent.id for agent in agents], counts),
+        "node_id" : np.concatenate([agent.member_ids for agent in agents]),
+        "seats" : np.concatenate([agent.member_counts for agent in agents])}
+        values["step"] = np.full(len(values["agent_id"]), step, dtype=np.int64)
+        self.tables["ownership"].append(values)
+
+    def table(self, name):
+        return self.tables[name]
+
+    def to_dataframe(self, name):
+        return self.tables[name].to_dataframe()
+
+    def close(self):
+        """ flushes every partial chunk and writes the manifest used by load_recording """
+        for table in self.tables.values():
+            table.flush()
+        manifest = {name : table.manifest() for name, table in self.tables.items()}
+        with open(os.path.join(self.directory, "manifest.json"), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+
+
+class Recorded_Table():
+    """ Read-only view of a table flushed to disk; every chunk is memory-mapped """
+    def __init__(self, directory, name, manifest):
+        self.directory = directory
+        self.name = name
+        self.columns = {column : np.dtype(dtype) for column, dtype in manifest["columns"].items()}
+        self.num_chunks = manifest["chunks"]
+        self.num_rows = manifest["rows"]
+
+    def __len__(self):
+        return self.num_rows
+
+    def chunks(self):
+        for chunk in range(self.num_chunks):
+            yield load_chunk(self.directory, self.name, chunk, self.columns)
+
+    def column(self, column):
+        return concatenate_column(self.chunks(), column, self.columns[column])
+
+    def to_dataframe(self):
+        return table_dataframe(self.chunks(), self.columns)
+
+
+def load_recording(directory):
+    """ opens a recording written by Data_Recorder: returns table name -> Recorded_Table """
+    with open(os.path.join(directory, "manifest.json")) as manifest_file:
+        manifest = json.load(manifest_file)
+    return {name : Recorded_Table(directory, name, table) for name, table in manifest.items()}
+
+
+def select_columns(reporters, columns, table):
+    if columns is None or table not in columns:
+        return dict(reporters)
+    return {column : reporters[column] for column in columns[table]}
+
+def chunk_path(directory, name, chunk, column):
+    return os.path.join(directory, name, "%06d_%s.npy" % (chunk, column))
+
+def load_chunk(directory, name, chunk, columns):
+    return {column : np.load(chunk_path(directory, name, chunk, column), mmap_mode="r") for column in columns}
+
+def concatenate_column(chunks, column, dtype):
+    parts = [chunk[column] for chunk in chunks]
+    if not parts:
+        return np.array([], dtype=dtype)
+    return np.concatenate(parts)
+
+def table_dataframe(chunks, columns):
+    import pandas as pd
+    chunks = list(chunks)
+    return pd.DataFrame({column : concatenate_column(chunks, column, dtype) for column, dtype in columns.items()})
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+
+STORE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "result_store")
+
+# source files whose contents change what a run produces
+MODEL_SOURCES = ("model.py", "agent.py", "node_table.py", "selection.py", "metrics.py", "archive.py",
+"rng.py", "scheduler.py", "tracing.py", "simulation_functions.py", "analysis.py", "convergence.py")
+
+# Beacon_Model arguments that do not change the results of a run
+UNKEYED_PARAMETERS = ("log_filename", "run_number", "log_level", "recorder", "tracer", "profiler")
+
+_code_versions = {}
+
+
+class Result_Store():
+    """ Local content-addressed store of Beacon_Model runs.
+
+    A run is keyed by a hash of every model parameter (the stake distribution by a hash of
+    its values, plus the raw bytes of the file it was read from when given), the seed, the
+    number of steps, run options such as convergence settings, and the code version: a hash
+    of the model sources, so editing the model never serves stale results.
+
+    The index is a sqlite table in directory/index.sqlite with the parameters as JSON, which
+    query() filters on; the metric time series of each run (the datacollector model reporters)
+    are a compressed .npz file next to it. Once the files take more than max_bytes, the least
+    recently used runs are evicted. Several processes can share a store """
+    def __init__(self, directory = STORE_DIRECTORY, max_bytes = 2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(directory, "index.sqlite"), timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS runs (
+            key TEXT PRIMARY KEY, parameters TEXT, seed INTEGER, steps INTEGER, code_version TEXT,
+            extra TEXT, bytes INTEGER, created REAL, last_used REAL)""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS runs_last_used ON runs (last_used)")
+
+    def __contains__(self, key):
+        return self.connection.execute("SELECT 1 FROM runs WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    def path(self, key):
+        return os.path.join(self.directory, key[0:2], key + ".npz")
+
+    def get(self, key):
+        """ the stored run: parameters, seed, steps, code_version, extra (whatever was stored
+        with the run) and series (reporter -> values); None on a miss """
+        row = self.connection.execute("SELECT parameters, seed, steps, code_version, extra FROM runs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            with np.load(self.path(key)) as arrays:
+                names = json.loads(str(arrays["names"]))
+                series = {name : arrays["series_%d" % column] for column, name in enumerate(names)}
+        except (OSError, KeyError, ValueError):
+            self.delete(key) # the series file is gone or damaged: rerun
+            return None
+        with self.connection:
+            self.connection.execute("UPDATE runs SET last_used = ? WHERE key = ?", (time.time(), key))
+        return {"key" : key,
+        "parameters" : json.loads(row[0]),
+        "seed" : row[1],
+        "steps" : row[2],
+        "code_version" : row[3],
+        "extra" : json.loads(row[4]),
+        "series" : series}
+
+    def put(self, key, parameters, seed, steps, series, extra = None):
+        """ stores a run; series maps reporter -> values per block """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        names = list(series)
+        arrays = {"series_%d" % column : np.asarray(series[name], dtype=float) for column, name in enumerate(names)}
+        temporary = path + ".%d.tmp" % os.getpid()
+        with open(temporary, "wb") as series_file:
+            np.savez_compressed(series_file, names = json.dumps(names), **arrays)
+        os.replace(temporary, path) # readers never see a half written file
+        extra_json = json.dumps(extra if extra is not None else {})
+        now = time.time()
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, json.dumps(parameter_record(parameters), sort_keys=True), seed, steps, code_version(),
+            extra_json, os.path.getsize(path) + len(extra_json), now, now))
+        self.evict(keep = key)
+
+    def delete(self, key):
+        with self.connection:
+            self.connection.execute("DELETE FROM runs WHERE key = ?", (key,))
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def size(self):
+        return self.connection.execute("SELECT COALESCE(SUM(bytes), 0) FROM runs").fetchone()[0]
+
+    def evict(self, keep = None):
+        # least recently used runs go first, until the store fits in max_bytes; the run just
+        # stored (keep) stays even if it alone is larger than max_bytes
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+        for key, run_bytes in self.connection.execute("SELECT key, bytes FROM runs ORDER BY last_used").fetchall():
+            if excess <= 0:
+                break
+            if key == keep:
+                continue
+            self.delete(key)
+            excess -= run_bytes
+
+    def run(self, parameters, steps, seed, stake_file = None):
+        """ the stored run for these Beacon_Model parameters, running and storing it on a miss.
+        seed is required: an unseeded run cannot be reproduced, so it is never cached """
+        if seed is None:
+            raise ValueError("only seeded runs can be stored")
+        key = run_key(parameters, seed, steps, stake_file = stake_file)
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+        import model
+        start_time = time.time()
+        beacon_model = model.Beacon_Model(**dict(parameters, seed = seed))
+        for i in range(steps):
+            beacon_model.step()
+        self.put(key, parameters, seed, steps, beacon_model.datacollector.model_vars,
+        {"elapsed" : time.time() - start_time})
+        return self.get(key)
+
+    def series(self, key):
+        """ the metric time series of a stored run as a dataframe, one row per block """
+        import pandas as pd
+        entry = self.get(key)
+        return pd.DataFrame(entry["series"]) if entry is not None else None
+
+    def query(self, **conditions):
+        """ index rows of the stored runs matching every condition on a model parameter:
+        a value (equal), a list or tuple (any of) or a slice(low, high) (inclusive range,
+        either end may be None). One row per run with its parameters, seed, steps and key """
+        import pandas as pd
+        clauses = []
+        values = []
+        for name, condition in conditions.items():
+            column = "json_extract(parameters, ?)"
+            if isinstance(condition, slice):
+                if condition.start is not None:
+                    clauses.append(column + " >= ?")
+                    values += ["$." + name, condition.start]
+                if condition.stop is not None:
+                    clauses.append(column + " <= ?")
+                    values += ["$." + name, condition.stop]
+            elif isinstance(condition, (list, tuple)):
+                clauses.append(column + " IN (%s)" % ", ".join("?" * len(condition)))
+                values += ["$." + name] + [plain(value) for value in condition]
+            else:
+                clauses.append(column + " = ?")
+                values += ["$." + name, plain(condition)]
+        sql = "SELECT key, parameters, seed, steps, code_version, extra FROM runs"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        rows = []
+        for key, parameters, seed, steps, version, extra in self.connection.execute(sql, values):
+            parameters = json.loads(parameters)
+            parameters.pop("stake_distribution", None)
+            rows.append(dict(parameters, seed = seed, steps = steps, code_version = version, key = key))
+        return pd.DataFrame(rows)
+
+    def close(self):
+        self.connection.close()
+
+
+def code_version(directory = None):
+    """ hash of the model sources, computed once per process """
+    directory = directory or os.path.dirname(os.path.abspath(__file__))
+    if directory not in _code_versions:
+        digest = hashlib.sha256()
+        for source in MODEL_SOURCES:
+            path = os.path.join(directory, source)
+            if os.path.exists(path):
+                digest.update(source.encode())
+                with open(path, "rb") as source_file:
+                    digest.update(source_file.read())
+        _code_versions[directory] = digest.hexdigest()[0:16]
+    return _code_versions[directory]
+
+def parameter_record(parameters):
+    # JSON form of the parameters that change a run; the stake distribution is summarized by a hash of its values
+    record = {}
+    for name, value in parameters.items():
+        if name in UNKEYED_PARAMETERS:
+            continue
+        if name == "stake_distribution":
+            values = np.ascontiguousarray(value, dtype=float)
+            record[name] = {"sha256" : hashlib.sha256(values.tobytes()).hexdigest(),
+            "owners" : len(values),
+            "total" : float(values.sum())}
+        else:
+            record[name] = plain(value)
+    return record
+
+def run_key(parameters, seed, steps, options = None, stake_file = None):
+    """ content address of a run; options holds anything else that changes what is stored """
+    content = {"parameters" : parameter_record(parameters),
+    "seed" : seed,
+    "steps" : steps,
+    "options" : options or {},
+    "code_version" : code_version()}
+    if stake_file is not None:
+        with open(stake_file, "rb") as stake:
+            content["stake_file"] = hashlib.sha256(stake.read()).hexdigest()
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+def plain(value):
+    # numpy values as plain Python values, so they serialize to JSON and compare in sqlite
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
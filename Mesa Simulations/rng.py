@@ -0,0 +1,65 @@
+import numpy as np
+
+class Random_Streams():
+    """ Per-model random number service.
+    Every named substream is an independent numpy Generator spawned from one seed,
+    so a run is replayed exactly from its seed and parallel runs never share state """
+    STREAMS = ("churn", "relay", "lottery", "signature_delay", "malicious")
+
+    def __init__(self, seed = None, buffer_size = 4096):
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.seed = self.seed_sequence.entropy # replays this run when passed back as the seed
+        self.buffer_size = buffer_size
+        children = self.seed_sequence.spawn(len(self.STREAMS))
+        self.generators = {name : np.random.Generator(np.random.PCG64(child)) for name, child in zip(self.STREAMS, children)}
+        self.buffers = [] # every Buffered_Draws handed out, so a reseed can drop their pre-drawn values
+
+    def __getitem__(self, name):
+        return self.generators[name]
+
+    def buffered(self, name, method, *args):
+        """ scalar draws of generator.method(*args) from a substream, pre-drawn in blocks """
+        draws = Buffered_Draws(self.generators[name], method, args, self.buffer_size)
+        self.buffers.append(draws)
+        return draws
+
+    def reseed(self, seed = None):
+        """ restarts every substream from a new seed, in place, so generators held elsewhere follow """
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.seed = self.seed_sequence.entropy
+        for name, child in zip(self.STREAMS, self.seed_sequence.spawn(len(self.STREAMS))):
+            self.generators[name].bit_generator.state = np.random.PCG64(child).state
+        for draws in self.buffers:
+            draws.clear()
+
+    def get_state(self):
+        return {name : generator.bit_generator.state for name, generator in self.generators.items()}
+
+    def set_state(self, state):
+        for name, generator_state in state.items():
+            self.generators[name].bit_generator.state = generator_state
+
+
+class Buffered_Draws():
+    """ Hands out pre-drawn values one at a time as plain Python scalars,
+    refilling the buffer with one bulk draw when it runs out """
+    def __init__(self, generator, method, args, buffer_size):
+        self.generator = generator
+        self.method = method
+        self.args = tuple(args)
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.position = 0
+
+    def clear(self):
+        # drops the values drawn ahead
+        self.buffer = []
+        self.position = 0
+
+    def next(self):
+        if self.position == len(self.buffer):
+            self.buffer = getattr(self.generator, self.method)(*self.args, size=self.buffer_size).tolist()
+            self.position = 0
+        value = self.buffer[self.position]
+        self.position += 1
+        return value
@@ -0,0 +1,56 @@
+class Event_Scheduler():
+    """ Discrete-event alternative to SimultaneousActivation.
+    Agents are kept in a timing wheel keyed by the step of their next state change
+    (agent.next_event()) and are only stepped when it comes up; the countdown-only
+    steps in between are applied at once with agent.skip(). Agents due in the same
+    step are stepped in the order they were added, as SimultaneousActivation does.
+    Between wake-ups an agent's countdown fields (delay, dkg_block_delay, expiry) are
+    not brought up to date, so per-block agent recordings read stale countdowns """
+    def __init__(self, model):
+        self.model = model
+        self.steps = 0
+        self.time = 0
+        self.wheel = {} # step -> agents due at that step
+        self.scheduled = {} # agent id -> (order added, agent, step it was last brought up to date)
+        self.added = 0
+        self.stepped = {} # agents stepped in the last step, by type
+
+    def add(self, agent):
+        if agent.unique_id in self.scheduled:
+            raise ValueError("agent already added to scheduler")
+        self.scheduled[agent.unique_id] = (self.added, agent, self.steps)
+        self.added += 1
+        self.wake_at(agent, agent.next_event())
+
+    def remove(self, agent):
+        # entries left in the wheel are dropped when they come up
+        self.scheduled.pop(agent.unique_id, None)
+
+    def wake_at(self, agent, steps):
+        if steps is not None:
+            self.wheel.setdefault(self.steps + steps, []).append(agent)
+
+    @property
+    def agents(self):
+        return [agent for _, agent, _ in self.scheduled.values()]
+
+    def get_agent_count(self):
+        return len(self.scheduled)
+
+    def step(self):
+        self.steps += 1
+        self.time += 1
+        due = []
+        for agent in self.wheel.pop(self.steps, []):
+            entry = self.scheduled.get(agent.unique_id)
+            if entry is not None and entry[1] is agent:
+                due.append(entry)
+        due.sort(key = lambda entry : entry[0])
+        self.stepped = {}
+
+        for order, agent, last_step in due:
+            agent.skip(self.steps - last_step - 1)
+            agent.step()
+            self.stepped[agent.type] = self.stepped.get(agent.type, 0) + 1
+            self.scheduled[agent.unique_id] = (order, agent, self.steps)
+            self.wake_at(agent, agent.next_event())
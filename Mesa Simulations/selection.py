@@ -0,0 +1,170 @@
+import numpy as np
+
+# share of the nominal pmf mixed into a tilted one: likelihood ratios stay below 1/DEFENSIVE_SHARE,
+# so events the tilt does not aim at are still estimated with bounded variance
+DEFENSIVE_SHARE = 0.1
+
+class Ticket_Lottery():
+    """ Group selection engine: picks the group_size winning tickets out of all
+    the tickets held by the candidate nodes and returns the winning node indexes.
+
+    Modes:
+    - "sample": draws group_size distinct ticket positions uniformly at random and
+      maps them to their owners. Every subset of group_size tickets is equally likely,
+      which is the same distribution as keeping the smallest of uniform ticket values,
+      but no ticket is materialized. Cost grows with the group size, not the total stake.
+    - "exact": every node draws one uniform value per ticket and the group_size
+      smallest values win (including the id counter used to break ties), exactly
+      like the original per-node ticket dict
+    - "tilted": importance sampling for rare groups. The number of seats won by the
+      favoured candidates (the malicious nodes) is drawn from its hypergeometric pmf
+      exponentially tilted so that its mean is tilt_target * group_size, mixed with the
+      untilted pmf (DEFENSIVE_SHARE); the seats are
+      then uniform within the favoured and the other tickets, as in "sample". weight is
+      the likelihood ratio of the last draw, which makes weighted averages unbiased """
+    def __init__(self, mode = "sample", rng = None, tilt_target = None):
+        if mode not in ("sample", "exact", "tilted"):
+            raise ValueError("unknown lottery mode: " + str(mode))
+        if mode == "tilted" and tilt_target is None:
+            raise ValueError("the tilted lottery needs a tilt_target seat share")
+        self.mode = mode
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.tilt_target = tilt_target
+        self.tilt = None # (total tickets, favoured tickets, group size, nominal pmf, tilted pmf) of the last draw
+        self.tickets_generated = 0 # number of ticket values drawn by the last selection
+        self.weight = 1.0 # likelihood ratio of the last selection, 1 unless tilted
+
+    def select(self, ticket_counts, group_size, favoured = None):
+        """ returns the candidate indexes of the group members, ordered by winning ticket.
+        A candidate appears once for every winning ticket it holds; favoured flags the
+        candidates the tilted mode biases toward and is ignored by the other modes """
+        ticket_counts = np.asarray(ticket_counts, dtype=np.int64)
+        if self.mode == "exact":
+            return self.select_exact(ticket_counts, group_size)
+        elif self.mode == "tilted":
+            return self.select_tilted(ticket_counts, group_size, np.asarray(favoured, dtype=bool))
+        return self.select_sample(ticket_counts, group_size)
+
+    def select_sample(self, ticket_counts, group_size):
+        ticket_cdf = np.cumsum(ticket_counts)
+        total_tickets = int(ticket_cdf[-1]) if len(ticket_cdf) else 0
+        group_size = min(group_size, total_tickets)
+        positions = sample_without_replacement(total_tickets, group_size, self.rng)
+        self.tickets_generated = len(positions)
+        # the owner of ticket position p is the first candidate whose cumulative ticket count exceeds p
+        return np.searchsorted(ticket_cdf, positions, side = "right")
+
+    def select_exact(self, ticket_counts, group_size):
+        total_tickets = int(ticket_counts.sum())
+        tickets = self.rng.random(total_tickets)
+        # the original implementation offsets each node's tickets by a running counter so repeated keys do not collide
+        counters = np.cumsum(np.full(len(ticket_counts), 0.00000001))
+        tickets += np.repeat(counters, ticket_counts)
+        self.tickets_generated = total_tickets
+
+        group_size = min(group_size, total_tickets)
+        winners = np.argpartition(tickets, group_size - 1)[0:group_size] if group_size > 0 else np.array([], dtype=np.int64)
+        winners = winners[np.argsort(tickets[winners], kind = "stable")] # order by ticket value
+        owners = np.repeat(np.arange(len(ticket_counts)), ticket_counts)
+        return owners[winners]
+
+    def select_tilted(self, ticket_counts, group_size, favoured):
+        # the favoured candidates' tickets come first, then the others
+        order = np.concatenate([np.flatnonzero(favoured), np.flatnonzero(~favoured)])
+        ticket_cdf = np.cumsum(ticket_counts[order])
+        total_tickets = int(ticket_cdf[-1]) if len(ticket_cdf) else 0
+        favoured_tickets = int(ticket_counts[favoured].sum())
+        group_size = min(group_size, total_tickets)
+
+        nominal, tilted = self.seat_pmfs(total_tickets, favoured_tickets, group_size)
+        favoured_seats = int(self.rng.choice(len(tilted), p = tilted))
+        self.weight = float(nominal[favoured_seats]/tilted[favoured_seats])
+        positions = np.concatenate([sample_without_replacement(favoured_tickets, favoured_seats, self.rng),
+        favoured_tickets + sample_without_replacement(total_tickets - favoured_tickets, group_size - favoured_seats, self.rng)])
+        self.rng.shuffle(positions)
+        self.tickets_generated = len(positions)
+        return order[np.searchsorted(ticket_cdf, positions, side = "right")]
+
+    def seat_pmfs(self, total_tickets, favoured_tickets, group_size):
+        # nominal and tilted pmfs of the favoured seats; the candidates rarely change between draws
+        key = (total_tickets, favoured_tickets, group_size)
+        if self.tilt is None or self.tilt[0:3] != key:
+            nominal = hypergeometric_pmf(total_tickets, favoured_tickets, group_size)
+            tilted = defensive_pmf(nominal, self.tilt_target * group_size)
+            self.tilt = key + (nominal, tilted)
+        return self.tilt[3], self.tilt[4]
+
+
+def hypergeometric_pmf(population, successes, draws):
+    """ pmf over 0..draws of the successes among draws without replacement, from the ratios of
+    consecutive terms; much faster than scipy for the large ticket counts of a network """
+    pmf = np.zeros(draws + 1)
+    low = max(0, draws - (population - successes))
+    high = min(draws, successes)
+    k = np.arange(low, high, dtype=float)
+    log_ratios = (np.log(successes - k) + np.log(draws - k)
+    - np.log(k + 1) - np.log(population - successes - draws + k + 1))
+    log_pmf = np.concatenate([[0], np.cumsum(log_ratios)])
+    pmf[low:high + 1] = np.exp(log_pmf - log_pmf.max())
+    return pmf/pmf.sum()
+
+def tilted_pmf(pmf, theta):
+    """ pmf over 0, 1, ... reweighted by exp(theta * k) and renormalized, in logs so that
+    large tilts do not overflow """
+    with np.errstate(divide = "ignore"):
+        log_weights = np.log(pmf) + theta * np.arange(len(pmf))
+    weights = np.exp(log_weights - log_weights.max())
+    return weights/weights.sum()
+
+def tilt_for_mean(pmf, target_mean):
+    """ the tilt whose tilted pmf has the target mean. Newton steps use the tilted variance as the
+    slope of the mean and fall back to bisection when they leave the bracket found so far """
+    support = np.flatnonzero(pmf > 0)
+    target_mean = min(max(target_mean, support[0] + 1e-9), support[-1] - 1e-9)
+    values = np.arange(len(pmf))
+    theta = 0.0
+    low, high = -np.inf, np.inf
+    for i in range(200):
+        tilted = tilted_pmf(pmf, theta)
+        mean = np.dot(tilted, values)
+        if abs(mean - target_mean) <= 1e-9 * max(1.0, target_mean):
+            break
+        if mean < target_mean:
+            low = theta
+        else:
+            high = theta
+        variance = np.dot(tilted, (values - mean)**2)
+        step = theta + (target_mean - mean)/variance if variance > 0 else np.nan
+        if not low < step < high:
+            if np.isfinite(low) and np.isfinite(high):
+                step = (low + high)/2
+            else:
+                step = theta + (1 if mean < target_mean else -1) * max(1.0, 2 * abs(theta))
+        theta = step
+    return theta
+
+def defensive_pmf(pmf, target_mean):
+    # the pmf tilted toward the target mean, mixed with the pmf itself
+    return (1 - DEFENSIVE_SHARE) * tilted_pmf(pmf, tilt_for_mean(pmf, target_mean)) + DEFENSIVE_SHARE * pmf
+
+def sample_without_replacement(population, size, rng):
+    """ draws size distinct integers from range(population), uniformly at random and in random order.
+    numpy's Generator uses a set-based draw for small samples, so the cost is O(size) when
+    the population is much larger than the sample """
+    if size <= 0:
+        return np.array([], dtype=np.int64)
+    return rng.choice(population, size, replace=False)
+
+def distinct_positions(population, size, generator):
+    """ draws size distinct integers from range(population[i]) for every row i, uniformly at random.
+    Repeated draws are redrawn until every row is distinct; the procedure treats every
+    population member alike, so every subset of size members is equally likely """
+    positions = np.floor(generator.random((len(population), size)) * population[:, None]).astype(np.int64)
+    while True:
+        positions.sort(axis=1)
+        repeated = np.zeros(positions.shape, dtype=bool)
+        repeated[:, 1:] = positions[:, 1:] == positions[:, :-1]
+        rows, columns = np.nonzero(repeated)
+        if len(rows) == 0:
+            return positions
+        positions[rows, columns] = np.floor(generator.random(len(rows)) * population[rows]).astype(np.int64)
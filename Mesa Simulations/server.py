@@ -1,4 +1,298 @@
-import model
-from mesa.visualization.modules import CanvasGrid
-from mesa.visualization.ModularVisualization import ModularServer
+import os
+import sys
+import json
+import math
+import asyncio
+import argparse
+import threading
 
+# model reporters plotted for a running model
+DASHBOARD_REPORTERS = ["# of Active Groups", "# of Active Nodes", "# of Signatures",
+"% Compromised Groups", "% Lynchpinned signatures", "Failed Singature %"]
+
+PORT = 8521
+
+
+class Model_Source():
+    """ new datacollector rows of a running Beacon_Model: poll() returns the rows added since
+    the last poll as [block, reporter values...]. Only the row count is kept, the history
+    stays in the model's datacollector """
+    def __init__(self, beacon_model, reporters = DASHBOARD_REPORTERS):
+        self.model = beacon_model
+        self.reporters = list(reporters)
+        self.columns = ["block"] + self.reporters
+        self.sent = 0
+
+    def poll(self):
+        model_vars = self.model.datacollector.model_vars
+        # the model may be collecting while we read: only rows every reporter has reached are complete
+        available = min(len(model_vars[reporter]) for reporter in self.reporters)
+        rows = [[block + 1] + [model_vars[reporter][block] for reporter in self.reporters]
+        for block in range(self.sent, available)]
+        self.sent = available
+        return rows
+
+
+class Sweep_Source():
+    """ new runs of a Parameter_Sweep, read from the end of its results file: one row per
+    finished run with the post burn-in mean of every reporter """
+    def __init__(self, results_path, reporters = DASHBOARD_REPORTERS, statistic = "mean"):
+        self.results_path = results_path
+        self.reporters = list(reporters)
+        self.statistic = statistic
+        self.columns = ["run"] + self.reporters
+        self.offset = 0
+        self.runs = 0
+
+    def poll(self):
+        rows = []
+        if not os.path.exists(self.results_path):
+            return rows
+        with open(self.results_path) as results_file:
+            results_file.seek(self.offset)
+            for line in results_file:
+                if not line.endswith("\n"):
+                    break # a run still being written is read on the next poll
+                self.offset += len(line)
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                self.runs += 1
+                rows.append([self.runs] + [result["summary"][reporter][self.statistic] for reporter in self.reporters])
+        return rows
+
+
+class Downsampler():
+    """ keeps every stride-th row and at most max_points rows: when the kept rows overflow,
+    every other one is dropped and the stride doubles, so a run of any length is shown with
+    evenly spaced points in bounded memory """
+    def __init__(self, max_points = 2000):
+        self.max_points = max_points
+        self.stride = 1
+        self.seen = 0
+        self.rows = []
+
+    def add(self, rows):
+        """ returns the new rows kept and whether the kept rows were thinned (the browser
+        then needs every kept row again) """
+        kept = []
+        thinned = False
+        for row in rows:
+            self.seen += 1
+            if (self.seen - 1) % self.stride != 0:
+                continue
+            self.rows.append(row)
+            kept.append(row)
+            if len(self.rows) > self.max_points:
+                self.rows = self.rows[0::2]
+                self.stride *= 2
+                thinned = True
+        return kept, thinned
+
+
+class Dashboard():
+    """ Local live dashboard for a running model or sweep.
+
+    A tornado server polls its source every interval seconds, downsamples the new rows and
+    pushes only those to the connected browsers over a websocket; a browser holds at most
+    max_points points per reporter. The simulation never waits for the dashboard: the server
+    runs on its own thread (start) and only reads the rows the model has already collected.
+    Nothing is rendered per agent """
+    def __init__(self, source, port = PORT, interval = 1.0, max_points = 2000):
+        self.source = source
+        self.port = port
+        self.interval = interval
+        self.downsampler = Downsampler(max_points)
+        self.clients = set()
+        self.loop = None
+        self.thread = None
+        self.stopped = None
+
+    def application(self):
+        import tornado.web
+        import tornado.websocket
+        dashboard = self
+
+        class Page_Handler(tornado.web.RequestHandler):
+            def get(self):
+                self.set_header("Content-Type", "text/html")
+                self.write(PAGE)
+
+        class Rows_Handler(tornado.websocket.WebSocketHandler):
+            def open(self):
+                dashboard.clients.add(self)
+                self.write_message(dashboard.message("reset", dashboard.downsampler.rows))
+
+            def on_close(self):
+                dashboard.clients.discard(self)
+
+        return tornado.web.Application([(r"/", Page_Handler), (r"/ws", Rows_Handler)])
+
+    def message(self, kind, rows):
+        return json.dumps({"type" : kind,
+        "columns" : self.source.columns,
+        "stride" : self.downsampler.stride,
+        "seen" : self.downsampler.seen,
+        "max_points" : self.downsampler.max_points,
+        "rows" : [[plain_number(value) for value in row] for row in rows]})
+
+    def push(self):
+        kept, thinned = self.downsampler.add(self.source.poll())
+        if not kept and not thinned:
+            return
+        if thinned:
+            message = self.message("reset", self.downsampler.rows)
+        else:
+            message = self.message("rows", kept)
+        for client in list(self.clients):
+            try:
+                client.write_message(message)
+            except Exception:
+                self.clients.discard(client) # closed while we were sending
+
+    async def serve(self):
+        import tornado.ioloop
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        server = self.application().listen(self.port, address = "127.0.0.1")
+        callback = tornado.ioloop.PeriodicCallback(self.push, self.interval * 1000)
+        callback.start()
+        print("dashboard: http://127.0.0.1:%d/" % self.port)
+        await self.stopped.wait()
+        callback.stop()
+        self.push() # the rows collected since the last poll
+        server.stop()
+
+    def serve_forever(self):
+        """ runs the server on this thread until interrupted, e.g. to watch a sweep """
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    def start(self):
+        """ runs the server on a daemon thread and returns; step the model as usual """
+        self.thread = threading.Thread(target = asyncio.run, args = (self.serve(),), daemon = True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+        if self.thread is not None:
+            self.thread.join()
+
+
+def watch(beacon_model, reporters = DASHBOARD_REPORTERS, **options):
+    """ starts a dashboard for a model stepped by the caller; returns it, call stop() when done """
+    return Dashboard(Model_Source(beacon_model, reporters), **options).start()
+
+def watch_sweep(results_path, reporters = DASHBOARD_REPORTERS, **options):
+    """ starts a dashboard following the results file of a sweep run elsewhere """
+    return Dashboard(Sweep_Source(results_path, reporters), **options).start()
+
+def plain_number(value):
+    # JSON has no NaN or numpy scalars
+    value = float(value)
+    return None if math.isnan(value) or math.isinf(value) else value
+
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Beacon simulation</title>
+<style>
+body { font-family: sans-serif; margin: 16px; }
+.chart { display: inline-block; margin: 8px; }
+canvas { border: 1px solid #ccc; }
+#status { color: #666; }
+</style>
+</head>
+<body>
+<div id="status">connecting</div>
+<div id="charts"></div>
+<script>
+var columns = [], rows = [], maxPoints = 2000, dirty = false;
+var canvases = [], labels = [];
+
+function layout() {
+  var charts = document.getElementById("charts");
+  charts.innerHTML = "";
+  canvases = []; labels = [];
+  for (var c = 1; c < columns.length; c++) {
+    var chart = document.createElement("div");
+    chart.className = "chart";
+    var label = document.createElement("div");
+    var canvas = document.createElement("canvas");
+    canvas.width = 420; canvas.height = 180;
+    chart.appendChild(label); chart.appendChild(canvas); charts.appendChild(chart);
+    labels.push(label); canvases.push(canvas);
+  }
+}
+
+function draw() {
+  dirty = false;
+  for (var c = 1; c < columns.length; c++) {
+    var canvas = canvases[c - 1], context = canvas.getContext("2d");
+    context.clearRect(0, 0, canvas.width, canvas.height);
+    var low = Infinity, high = -Infinity, last = null;
+    for (var i = 0; i < rows.length; i++) {
+      var value = rows[i][c];
+      if (value === null) continue;
+      low = Math.min(low, value); high = Math.max(high, value); last = value;
+    }
+    labels[c - 1].textContent = columns[c] + ": " + (last === null ? "-" : +last.toFixed(4));
+    if (rows.length < 2 || last === null) continue;
+    if (high == low) { high += 1; low -= 1; }
+    var first = rows[0][0], span = Math.max(rows[rows.length - 1][0] - first, 1);
+    context.beginPath();
+    var moved = false;
+    for (var i = 0; i < rows.length; i++) {
+      var value = rows[i][c];
+      if (value === null) { moved = false; continue; }
+      var x = 4 + (canvas.width - 8) * (rows[i][0] - first) / span;
+      var y = canvas.height - 4 - (canvas.height - 8) * (value - low) / (high - low);
+      if (moved) context.lineTo(x, y); else context.moveTo(x, y);
+      moved = true;
+    }
+    context.stroke();
+    context.fillText(+high.toFixed(4), 4, 12);
+    context.fillText(+low.toFixed(4), 4, canvas.height - 6);
+  }
+}
+
+var socket = new WebSocket("ws://" + location.host + "/ws");
+socket.onmessage = function (event) {
+  var message = JSON.parse(event.data);
+  if (message.type == "reset" || columns.length != message.columns.length) {
+    columns = message.columns; rows = message.rows; layout();
+  } else {
+    rows = rows.concat(message.rows);
+  }
+  maxPoints = message.max_points;
+  while (rows.length > maxPoints) rows = rows.filter(function (row, i) { return i % 2 == 0; });
+  document.getElementById("status").textContent = message.seen + " " + columns[0] + "s, every " + message.stride + " shown";
+  if (!dirty) { dirty = true; requestAnimationFrame(draw); }
+};
+socket.onclose = function () { document.getElementById("status").textContent += " (disconnected)"; };
+</script>
+</body>
+</html>
+"""
+
+
+def main(arguments = None):
+    parser = argparse.ArgumentParser(description = "Live dashboard for a Parameter_Sweep results file")
+    parser.add_argument("results", help = "results file of the sweep (Parameter_Sweep results_path)")
+    parser.add_argument("--port", type = int, default = PORT)
+    parser.add_argument("--interval", type = float, default = 1.0, help = "seconds between pushes")
+    parser.add_argument("--max-points", type = int, default = 2000)
+    options = parser.parse_args(arguments)
+    Dashboard(Sweep_Source(options.results), options.port, options.interval, options.max_points).serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
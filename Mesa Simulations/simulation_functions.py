@@ -1,34 +1,25 @@
-import random
-import datetime
 import numpy as np
-import copy
-import pandas as pd
+import selection
 
 def min_index(ticket_array, group_size):
-    array = copy.deepcopy(ticket_array)
-    group = sorted(array)[0:group_size] # generates a sorted list of min values of length = group size
-    #print(group)
-    indexes = [] #initializes the array of indexes for min ticket values
-    
-    for ticket in group: #iterates through each ticket value in the sorted list
-        
-        ticket_index = np.where(array==(ticket)) #finds the index with the ticket value
-        #print("ticket_index = " + str(ticket_index))
-        indexes.append(ticket_index[0][0]) # adds the index value to the array of indexes
-        #print("indexes = " + str(indexes))
-        array[ticket_index[0][0]] = 1 #sets the vaue at that index to the max value of 1 to address the problem of repeatd values
-        
-    #print(ticket_array_temp)
-    return sorted(indexes)
+    # indexes of the group_size smallest ticket values, in index order;
+    # a partial sort finds them, equal values at the cut-off go to the lowest indexes
+    array = np.asarray(ticket_array)
+    if group_size <= 0:
+        return np.array([], dtype=np.int64)
+    if group_size >= len(array):
+        return np.arange(len(array))
+    cutoff = np.partition(array, group_size - 1)[group_size - 1]
+    below = np.flatnonzero(array < cutoff)
+    at_cutoff = np.flatnonzero(array == cutoff)[0:group_size - len(below)]
+    return np.sort(np.concatenate([below, at_cutoff]))
 
 def preprocess_tickets(runs, total_tickets):
 # Pre-processing ticket arrays
 # runs = number of simulation runs
 # total_tickets = total # of tickets (virtual stakers)
-    tickets=[]
-    for i in range(0, runs):
-        tickets.append(np.random.random_sample(int(total_tickets)))
-    return tickets
+# every run is held in memory; ticket_chunks streams them instead
+    return list(np.random.random_sample((runs, int(total_tickets))))
 
 def preprocess_groups(tickets, runs, group_size):
 # Pre-processing groups
@@ -40,28 +31,147 @@ def preprocess_groups(tickets, runs, group_size):
 def create_cdf(nodes,ticket_distr):
 # Create CDF's - used to determine max ownership ticket index
     cdf = np.zeros(nodes)
-    for node,ticketmax in enumerate(ticket_distr):
-        
-        cdf[node]=sum(ticket_distr[0:node+1])
+    cdf[0:len(ticket_distr)] = np.cumsum(ticket_distr)
     return cdf
 
 def group_distr(runs, nodes, group_members, cdf):
 # function to calculate group ownership distribution
-    total_group_distr = np.zeros(nodes)
-    max_owned = np.zeros(runs)
-    group_distr_matrix = np.zeros((runs,nodes))
-    for i in range(runs):
-        group_distr = np.zeros(nodes)
-        group_distr[1] = sum(group_members[i]<cdf[0])
-        for j in range(1,nodes):
-            group_distr[j] = sum(group_members[i]<cdf[j])-sum(group_members[i]<cdf[j-1])
-        max_owned[i] = max(group_distr)/sum(group_distr)
-        total_group_distr +=group_distr
-        group_distr_matrix[i] = group_distr #saves the group ticket distribution for each run
-        print(group_distr_matrix[i])
+    owners = ticket_owners(np.asarray(group_members)[0:runs], cdf)
+    group_distr_matrix = ownership_matrix(owners, nodes) # saves the group ticket distribution for each run
+    total_group_distr = group_distr_matrix.sum(axis=0)
+    max_owned = group_distr_matrix.max(axis=1)/group_distr_matrix.sum(axis=1)
     return total_group_distr, max_owned, group_distr_matrix
 
 def node_failures(nodes, runs, node_failure_percent):
 # pre-processes failed nodes
     failed_nodes = np.random.rand(runs, nodes) < node_failure_percent
-    return failed_nodes
\ No newline at end of file
+    return failed_nodes
+
+
+# Streaming pipeline: runs are generated and reduced in fixed-size chunks, so the memory
+# used depends on the chunk size and not on the number of runs
+
+def ticket_owners(ticket_indexes, cdf):
+    # node owning each ticket index: node j holds the tickets in [cdf[j-1], cdf[j])
+    return np.searchsorted(cdf, ticket_indexes, side="right")
+
+def ownership_matrix(owners, nodes):
+    """ runs x nodes matrix of the seats every node holds in each run's group. Tickets past
+    the last node's (owner == nodes, from an index at or beyond cdf[-1]) belong to no node
+    and are left out, as in the original per-node loop """
+    owners = np.asarray(owners)
+    runs = len(owners)
+    owned = owners < nodes
+    flat = (np.arange(runs)[:, None] * nodes + owners)[owned]
+    return np.bincount(flat, minlength=runs*nodes).reshape(runs, nodes)
+
+def max_seats(owners):
+    """ most seats held by a single node in every run, from the owner of every seat """
+    owners = np.sort(owners, axis=1)
+    columns = np.arange(owners.shape[1])
+    starts = np.ones(owners.shape, dtype=bool)
+    starts[:, 1:] = owners[:, 1:] != owners[:, :-1]
+    # length of the run of equal owners ending at each seat
+    run_start = np.maximum.accumulate(np.where(starts, columns, 0), axis=1)
+    return (columns - run_start + 1).max(axis=1)
+
+def chunk_runs(total_tickets, group_size, method, memory_budget):
+    # runs per chunk that keep the working arrays within memory_budget bytes
+    bytes_per_run = 16 * total_tickets if method == "tickets" else 32 * group_size
+    return max(1, int(memory_budget // bytes_per_run))
+
+def ticket_chunks(runs, total_tickets, group_size, method = "sample", memory_budget = 64*2**20, seed = None):
+    """ yields the winning ticket indexes of every run, (chunk runs x group_size) at a time.
+    "tickets" draws one uniform value per ticket and keeps the group_size smallest with a
+    partial sort, like preprocess_tickets and min_index; "sample" draws the same uniformly
+    random set of group_size distinct tickets directly, without a value per ticket """
+    generator = np.random.default_rng(seed)
+    size = chunk_runs(total_tickets, group_size, method, memory_budget)
+    done = 0
+    while done < runs:
+        chunk = min(size, runs - done)
+        if method == "tickets":
+            tickets = generator.random((chunk, total_tickets))
+            yield np.argpartition(tickets, group_size - 1, axis=1)[:, 0:group_size]
+        elif method == "sample":
+            yield selection.distinct_positions(np.full(chunk, total_tickets), group_size, generator)
+        else:
+            raise ValueError("unknown selection method: " + str(method))
+        done += chunk
+
+def stream_max_ownership(ticket_distr, group_size, runs, method = "sample", memory_budget = 64*2**20, seed = None):
+    """ Monte Carlo of the largest single-node share of a group, streamed chunk by chunk.
+    Yields (runs done, running histogram of the max seats, running seats per node);
+    histogram[k] counts the runs whose largest node holds k of the group_size seats,
+    a max ownership of k/group_size. Both arrays are updated in place """
+    ticket_distr = np.asarray(ticket_distr, dtype=np.int64)
+    cdf = np.cumsum(ticket_distr)
+    histogram = np.zeros(group_size + 1, dtype=np.int64)
+    total_group_distr = np.zeros(len(ticket_distr), dtype=np.int64)
+    done = 0
+    for chunk in ticket_chunks(runs, int(cdf[-1]), group_size, method, memory_budget, seed):
+        owners = ticket_owners(chunk, cdf)
+        histogram += np.bincount(max_seats(owners), minlength=group_size + 1)
+        total_group_distr += np.bincount(owners.ravel(), minlength=len(ticket_distr))
+        done += len(chunk)
+        yield done, histogram, total_group_distr
+
+def max_ownership_distribution(ticket_distr, group_size, runs, method = "sample", memory_budget = 64*2**20, seed = None):
+    """ runs the streamed Monte Carlo to the end: returns the max ownership values (k/group_size),
+    the number of runs at each value, and the total seats per node over every run """
+    histogram = np.zeros(group_size + 1, dtype=np.int64)
+    total_group_distr = np.zeros(len(ticket_distr), dtype=np.int64)
+    for done, histogram, total_group_distr in stream_max_ownership(ticket_distr, group_size, runs, method, memory_budget, seed):
+        pass
+    return np.arange(group_size + 1)/group_size, histogram, total_group_distr
+
+def rare_event_probabilities(ticket_distr, malicious, group_size, bls_threshold, node_failure_probability,
+node_death_probability, runs, malicious_target = None, inactive_target = None, chunk_size = 2**20,
+seed = None, confidence = 0.95):
+    """ Importance sampling Monte Carlo of the probabilities of Beacon_Analysis: a group is
+    compromised if its malicious seats exceed bls_threshold, a signature fails if more than
+    group_size - bls_threshold - 1 seats are inactive and is lynchpinned if it only succeeds
+    with the malicious seats.
+
+    A group's malicious seats are hypergeometric over the tickets of the malicious nodes and its
+    inactive seats binomial, like the seats of the ticket lottery. Both counts are drawn from
+    pmfs exponentially tilted to the target shares of the group (default: just past the
+    compromise threshold, and no tilt), mixed with the untilted pmfs as the tilted lottery
+    does, and every run is weighted by its likelihood ratio, so
+    probabilities far below 1/runs still get hits. Only the counts decide the events, so no
+    ticket positions are drawn. Returns metrics.Weighted_Count estimates per event """
+    from scipy import stats
+    import metrics
+    ticket_distr = np.asarray(ticket_distr, dtype=np.int64)
+    total_tickets = int(ticket_distr.sum())
+    malicious_tickets = int(ticket_distr[np.asarray(malicious, dtype=bool)].sum())
+    p_inactive = node_death_probability + (1 - node_death_probability) * node_failure_probability
+    failure_threshold = group_size - bls_threshold - 1
+    if malicious_target is None:
+        malicious_target = (bls_threshold + 1)/group_size
+    if inactive_target is None:
+        inactive_target = p_inactive
+
+    seats = np.arange(group_size + 1)
+    malicious_pmf = selection.hypergeometric_pmf(total_tickets, malicious_tickets, group_size)
+    inactive_pmf = stats.binom.pmf(seats, group_size, p_inactive)
+    malicious_tilted = selection.defensive_pmf(malicious_pmf, malicious_target * group_size)
+    inactive_tilted = selection.defensive_pmf(inactive_pmf, inactive_target * group_size)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        ratios = np.nan_to_num(malicious_pmf/malicious_tilted)[:, None] * np.nan_to_num(inactive_pmf/inactive_tilted)[None, :]
+
+    generator = np.random.default_rng(seed)
+    counts = {event : metrics.Weighted_Count() for event in ("compromised", "sigfail", "lynchpinned")}
+    done = 0
+    while done < runs:
+        chunk = min(chunk_size, runs - done)
+        n_malicious = generator.choice(seats, chunk, p = malicious_tilted)
+        n_inactive = generator.choice(seats, chunk, p = inactive_tilted)
+        weights = ratios[n_malicious, n_inactive]
+        counts["compromised"].add_many(weights, n_malicious > bls_threshold)
+        counts["sigfail"].add_many(weights, n_inactive > failure_threshold)
+        # the counts are drawn independently, so their sum is capped at group_size like Beacon_Analysis does
+        counts["lynchpinned"].add_many(weights, (n_inactive <= failure_threshold) & (n_inactive + n_malicious > failure_threshold)
+        & (n_inactive + n_malicious <= group_size))
+        done += chunk
+    return {event : count.estimate(confidence) for event, count in counts.items()}
@@ -0,0 +1,72 @@
+import gzip
+import pickle
+
+# model settings a branch can change when it is forked
+KNOBS = ("node_failure_percent", "node_death_percent", "max_malicious_threshold_percent",
+"failed_signature_threshold", "relay_request_probability", "signature_delay")
+
+
+def take_snapshot(beacon_model):
+    """ complete state of a model between two steps, as compact bytes: the node table,
+    live groups and signatures, the active group and node lists, timers, archive, running
+    metrics, datacollector history and the state of every random stream with its pre-drawn
+    values. The recorder, tracer and profiler are not part of a snapshot """
+    return gzip.compress(pickle.dumps(beacon_model, protocol=pickle.HIGHEST_PROTOCOL), compresslevel=3)
+
+def save_snapshot(beacon_model, path):
+    with open(path, "wb") as snapshot_file:
+        snapshot_file.write(take_snapshot(beacon_model))
+
+def load_snapshot(path):
+    with open(path, "rb") as snapshot_file:
+        return snapshot_file.read()
+
+def restore(snapshot):
+    """ rebuilds the model a snapshot was taken of; stepping it continues the original run exactly """
+    return pickle.loads(gzip.decompress(snapshot))
+
+def fork(source, seed = None, run_number = None, log_filename = None,
+recorder = None, tracer = None, profiler = None, **knobs):
+    """ Branch off a warmed-up model.
+
+    source: a Beacon_Model, a snapshot (bytes) or the path of a saved snapshot
+    seed: restarts every random stream from this seed, so branches of one snapshot differ;
+    None keeps the snapshot's streams and the branch continues the original run
+    knobs: any of KNOBS, applied from the next block on. Changing a threshold recounts the
+    running metrics of every group and signature created so far """
+    unknown = set(knobs) - set(KNOBS)
+    if unknown:
+        raise TypeError("unknown fork knobs: " + ", ".join(sorted(unknown)))
+    if isinstance(source, str):
+        source = load_snapshot(source)
+    if not isinstance(source, bytes):
+        source = take_snapshot(source)
+    branch = restore(source)
+
+    if run_number is not None or log_filename is not None:
+        branch.run_number = run_number if run_number is not None else branch.run_number
+        branch.log_filename = log_filename if log_filename is not None else branch.log_filename
+        branch.create_log()
+    branch.recorder = recorder
+    branch.tracer = tracer
+    branch.profiler = profiler
+    if seed is not None:
+        branch.rng.reseed(seed)
+
+    if "node_failure_percent" in knobs or "node_death_percent" in knobs:
+        branch.set_node_failures(knobs.get("node_failure_percent"), knobs.get("node_death_percent"))
+    if "max_malicious_threshold_percent" in knobs or "failed_signature_threshold" in knobs:
+        branch.set_thresholds(knobs.get("max_malicious_threshold_percent"), knobs.get("failed_signature_threshold"))
+    if "relay_request_probability" in knobs:
+        branch.relay_request_probability = knobs["relay_request_probability"]
+    if "signature_delay" in knobs:
+        branch.set_signature_delay(knobs["signature_delay"])
+    return branch
+
+def fork_many(source, branches):
+    """ forks one branch per dict of fork() arguments, paying for the snapshot once """
+    if isinstance(source, str):
+        source = load_snapshot(source)
+    if not isinstance(source, bytes):
+        source = take_snapshot(source)
+    return [fork(source, **arguments) for arguments in branches]
@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import hashlib
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# model reporters summarized for every run
+SUMMARY_REPORTERS = ["# of Active Groups", "# of Active Nodes", "# of Signatures",
+"Median Malicious Group %", "% Compromised Groups", "Median Lynchpin %",
+"% Lynchpinned signatures", "Failed Singature %"]
+
+
+class Parameter_Sweep():
+    """ Runs Beacon_Model over a parameter grid with a number of replicas per grid cell.
+
+    base_parameters: Beacon_Model keyword arguments shared by every run
+    grid: parameter name -> list of values; every combination is a grid cell
+    Each run gets its own seed derived from (seed, cell, replica), so a run can be
+    reproduced on its own and a restarted sweep skips the runs already in results_path.
+    Every run records a hash of the sweep settings (base_parameters, steps, burn_in,
+    convergence, control_variates); a results file holding runs of other settings or
+    seeds is refused rather than mixed in.
+    With convergence (convergence.Run_Controller arguments) every run stops once its metrics
+    have converged, steps becomes the maximum, and the detected burn-in replaces burn_in.
+
+    Variance reduction:
+    - common_random_numbers: the seed only depends on (seed, replica), so replica r of every
+      cell draws from the same named random streams: the same malicious nodes and churn draws
+      while the node count is the same, the same relay requests, signature delays and ticket
+      draws while the group size and candidates allow. Differences between neighbouring cells
+      then come from the parameters, see paired_differences
+    - control_variates: every run also records the closed-form chance of its groups being
+      compromised and its signatures failing (Beacon_Model.control_values), see controlled_estimates
+    With store (a result_store.Result_Store directory) a run already stored by any sweep or
+    notebook is read back instead of simulated, and every new run is stored """
+    def __init__(self, base_parameters, grid, replicas, steps, results_path,
+    processes = None, seed = 0, burn_in = 0, convergence = None,
+    common_random_numbers = False, control_variates = False, store = None):
+        self.base_parameters = dict(base_parameters)
+        self.grid = dict(grid)
+        self.replicas = replicas
+        self.steps = steps
+        self.results_path = results_path
+        self.processes = processes if processes is not None else os.cpu_count()
+        self.seed = seed
+        self.burn_in = burn_in # blocks left out of the run averages
+        self.convergence = convergence
+        self.common_random_numbers = common_random_numbers
+        self.control_variates = control_variates
+        self.store = store
+
+    def cells(self):
+        names = list(self.grid)
+        for values in itertools.product(*(self.grid[name] for name in names)):
+            yield {name : plain_value(value) for name, value in zip(names, values)}
+
+    def tasks(self):
+        settings = self.settings()
+        for cell in self.cells():
+            for replica in range(self.replicas):
+                yield self.task(cell, replica, settings)
+
+    def task(self, cell, replica, settings = None):
+        return {"cell" : cell,
+        "replica" : replica,
+        "seed" : run_seed(self.seed, cell, replica, self.common_random_numbers),
+        "settings" : settings or self.settings(),
+        "steps" : self.steps,
+        "burn_in" : self.burn_in,
+        "convergence" : self.convergence,
+        "control_variates" : self.control_variates,
+        "store" : self.store}
+
+    def settings(self):
+        """ hash of the sweep settings that change a run besides its cell and seed """
+        import result_store
+        content = {"base_parameters" : result_store.parameter_record(self.base_parameters),
+        "steps" : self.steps,
+        "burn_in" : self.burn_in,
+        "convergence" : self.convergence,
+        "control_variates" : bool(self.control_variates)}
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()[0:16]
+
+    def matches(self, result, settings = None):
+        # a result of this sweep: same settings and the seed this sweep gives its cell and replica
+        return (result.get("settings") == (settings or self.settings()) and
+        result["seed"] == run_seed(self.seed, result["cell"], result["replica"], self.common_random_numbers))
+
+    def completed(self):
+        # keys of the runs already written to the results file
+        done = set()
+        settings = self.settings()
+        for result in load_results(self.results_path):
+            if not self.matches(result, settings):
+                raise ValueError("%s holds runs of other sweep settings or seeds (replica %d of %s); use a new results file"
+                % (self.results_path, result["replica"], json.dumps(result["cell"], sort_keys=True)))
+            done.add(run_key(result["cell"], result["replica"]))
+        return done
+
+    def run(self):
+        done = self.completed()
+        pending = [task for task in self.tasks() if run_key(task["cell"], task["replica"]) not in done]
+        print("sweep: %d runs pending, %d already complete" % (len(pending), len(done)))
+        if not pending:
+            return
+
+        start_time = time.time()
+        finished = 0
+        cached = 0
+        blocks = 0
+        with open(self.results_path, "a") as results_file:
+            for result in self.execute(pending):
+                results_file.write(json.dumps(result) + "\n")
+                results_file.flush()
+                finished += 1
+                if result.get("cached"):
+                    cached += 1 # read back from the result store, not simulated
+                else:
+                    blocks += result["blocks"]
+                elapsed = time.time() - start_time
+                print("sweep: %d/%d runs (%d stored), %.2f runs/s, %.1f blocks/s" % (finished, len(pending), cached, finished/elapsed, blocks/elapsed))
+
+    def execute(self, tasks):
+        # yields results as runs finish, in a process pool unless a single process is requested
+        if self.processes <= 1:
+            for task in tasks:
+                yield run_task(self.base_parameters, task)
+            return
+        with ProcessPoolExecutor(max_workers=self.processes) as pool:
+            futures = [pool.submit(run_task, self.base_parameters, task) for task in tasks]
+            for future in as_completed(futures):
+                yield future.result()
+
+
+def run_task(base_parameters, task):
+    """ builds and runs one Beacon_Model and returns its summary; with a result store, a run
+    stored before is read back instead of simulated again """
+    seed = task["seed"]
+    parameters = dict(base_parameters, **task["cell"])
+    # every run logs to its own file (log_filename + run_number): replicas of different cells
+    # run side by side, so the replica alone would make parallel workers overwrite each other
+    parameters["run_number"] = "%s_%d" % (cell_digest(task["cell"]), task["replica"])
+    result = {"cell" : task["cell"],
+    "replica" : task["replica"],
+    "seed" : seed,
+    "settings" : task.get("settings")}
+
+    # run options that change what is stored, besides the model parameters
+    options = {}
+    if task.get("convergence") is not None:
+        options["convergence"] = task["convergence"]
+    if task.get("control_variates"):
+        options["control_variates"] = True
+    store = None
+    if task.get("store") is not None:
+        import result_store
+        store = result_store.Result_Store(task["store"])
+        key = result_store.run_key(parameters, seed, task["steps"], options)
+        entry = store.get(key)
+        store.close()
+        if entry is not None:
+            stored = entry["extra"]
+            burn_in = stored["burn_in"] if "convergence" in options else task["burn_in"]
+            for name in ("blocks", "elapsed", "convergence", "controls"):
+                if name in stored:
+                    result[name] = stored[name]
+            result["summary"] = summarize_series(entry["series"], burn_in)
+            result["cached"] = True
+            return result
+
+    import model
+    start_time = time.time()
+    beacon_model = model.Beacon_Model(**dict(parameters, seed = seed, **({"control_variates" : True} if "control_variates" in options else {})))
+    if "convergence" in options:
+        import convergence
+        controller = convergence.Run_Controller(beacon_model, **dict(task["convergence"], max_steps = task["steps"]))
+        result["convergence"] = controller.run()
+        blocks = controller.steps
+        burn_in = controller.burn_in
+    else:
+        for i in range(task["steps"]):
+            beacon_model.step()
+        blocks = task["steps"]
+        burn_in = task["burn_in"]
+    result["blocks"] = blocks
+    result["elapsed"] = time.time() - start_time
+    result["summary"] = summarize_run(beacon_model, burn_in)
+    if "control_variates" in options:
+        result["controls"] = beacon_model.control_values()
+
+    if store is not None:
+        stored = {name : result[name] for name in ("blocks", "elapsed", "convergence", "controls") if name in result}
+        stored["burn_in"] = burn_in
+        store = result_store.Result_Store(task["store"])
+        store.put(key, parameters, seed, task["steps"], beacon_model.datacollector.model_vars, stored)
+        store.close()
+    return result
+
+def summarize_run(beacon_model, burn_in = 0):
+    return summarize_series(beacon_model.datacollector.model_vars, burn_in)
+
+def summarize_series(model_vars, burn_in = 0):
+    # final value and post burn-in mean of every model reporter
+    summary = {}
+    for reporter in SUMMARY_REPORTERS:
+        values = np.array(model_vars[reporter][burn_in:], dtype=float)
+        summary[reporter] = {"final" : float(values[-1]) if len(values) else float("nan"),
+        "mean" : float(np.nanmean(values)) if np.any(~np.isnan(values)) else float("nan")}
+    return summary
+
+def plain_value(value):
+    # numpy scalars in the grid are stored as plain Python values so cells serialize to JSON
+    return value.item() if isinstance(value, np.generic) else value
+
+def run_key(cell, replica):
+    return json.dumps(cell, sort_keys=True) + "#" + str(replica)
+
+def run_seed(seed, cell, replica, common_random_numbers = False):
+    # deterministic per (seed, cell, replica), independent of the grid order;
+    # with common random numbers every cell shares the seed of the replica
+    if common_random_numbers:
+        return int(np.random.SeedSequence([seed, replica]).generate_state(1)[0])
+    cell_hash = int(cell_digest(cell), 16)
+    return int(np.random.SeedSequence([seed, cell_hash, replica]).generate_state(1)[0])
+
+def cell_digest(cell):
+    return hashlib.sha256(json.dumps(cell, sort_keys=True).encode()).hexdigest()[0:8]
+
+def load_results(results_path):
+    results = []
+    if not os.path.exists(results_path):
+        return results
+    with open(results_path) as results_file:
+        for line in results_file:
+            line = line.strip()
+            if line:
+                try:
+                    results.append(json.loads(line))
+                except ValueError:
+                    pass # a run interrupted while writing its line is rerun
+    return results
+
+def results_dataframe(results_path, statistic = "mean"):
+    """ one row per run with the grid parameters and the chosen summary statistic of every reporter """
+    import pandas as pd
+    rows = []
+    for result in load_results(results_path):
+        row = dict(result["cell"], replica = result["replica"], seed = result["seed"])
+        for reporter, values in result["summary"].items():
+            row[reporter] = values[statistic]
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def paired_differences(results_path, parameter, reporter, statistic = "mean", confidence = 0.95):
+    """ difference of a reporter between neighbouring values of one parameter, replica by
+    replica, for every combination of the other parameters. With common random numbers the
+    paired replicas share their randomness: crn_variance_reduction is the variance of the
+    difference of independent runs over the variance of the paired difference """
+    import pandas as pd
+    from scipy import stats
+    frame = results_dataframe(results_path, statistic)
+    others = [column for column in frame.columns if column not in (parameter, reporter, "replica", "seed")
+    and column not in SUMMARY_REPORTERS]
+    rows = []
+    groups = frame.groupby(others) if others else [((), frame)]
+    for key, group in groups:
+        values = sorted(group[parameter].unique())
+        for low, high in zip(values[0:-1], values[1:]):
+            low_runs = group[group[parameter] == low].set_index("replica")[reporter]
+            high_runs = group[group[parameter] == high].set_index("replica")[reporter]
+            paired = (high_runs - low_runs).dropna()
+            n = len(paired)
+            if n < 2:
+                continue
+            paired_variance = paired.var()
+            independent_variance = low_runs.var() + high_runs.var()
+            row = dict(zip(others, key if isinstance(key, tuple) else (key,)))
+            row.update({"from" : low, "to" : high, "replicas" : n,
+            "difference" : paired.mean(),
+            "half_width" : stats.t.ppf(0.5 + confidence/2, n - 1) * np.sqrt(paired_variance/n),
+            "crn_variance_reduction" : independent_variance/paired_variance if paired_variance > 0 else float("inf")})
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+def controlled_estimates(results_path, confidence = 0.95):
+    """ per grid cell and controlled reporter: the plain mean of the runs and the control variate
+    estimate mean(observed) - beta * mean(observed - expected), whose control has mean zero.
+    beta = cov(observed, observed - expected)/var(observed - expected) is pooled over the cells
+    (within-cell deviations), so a few replicas per cell are enough. variance_reduction is the
+    variance of the plain mean over that of the controlled one """
+    import pandas as pd
+    from scipy import stats
+    rows = []
+    for result in load_results(results_path):
+        for reporter, values in result.get("controls", {}).items():
+            rows.append({"cell" : json.dumps(result["cell"], sort_keys=True), "reporter" : reporter,
+            "observed" : values["observed"], "control" : values["observed"] - values["expected"]})
+    frame = pd.DataFrame(rows).dropna()
+    estimates = []
+    for reporter, runs in frame.groupby("reporter"):
+        centered = runs[["observed", "control"]] - runs.groupby("cell")[["observed", "control"]].transform("mean")
+        control_variance = (centered["control"]**2).sum()
+        beta = (centered["observed"] * centered["control"]).sum()/control_variance if control_variance > 0 else 0.0
+        for cell, cell_runs in runs.groupby("cell"):
+            n = len(cell_runs)
+            controlled = cell_runs["observed"] - beta * cell_runs["control"]
+            plain_variance = cell_runs["observed"].var() if n > 1 else float("nan")
+            controlled_variance = controlled.var() if n > 1 else float("nan")
+            t = stats.t.ppf(0.5 + confidence/2, n - 1) if n > 1 else float("nan")
+            estimates.append(dict(json.loads(cell), reporter = reporter, replicas = n, beta = beta,
+            mean = cell_runs["observed"].mean(),
+            half_width = t * np.sqrt(plain_variance/n),
+            controlled_mean = controlled.mean(),
+            controlled_half_width = t * np.sqrt(controlled_variance/n),
+            variance_reduction = plain_variance/controlled_variance if controlled_variance > 0 else float("inf")))
+    return pd.DataFrame(estimates)
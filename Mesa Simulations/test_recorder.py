@@ -0,0 +1,32 @@
+import numpy as np
+import model
+import recorder
+
+
+def run_recorded(interval, steps = 300, seed = 5):
+    stake = [10*(i + 1) for i in range(100)]
+    data_recorder = recorder.Data_Recorder(interval = interval, chunk_size = 1024)
+    beacon_model = model.Beacon_Model(stake, 10, 100, 0.25, 14, 10, 5, 2, 40, 5, 3, "/tmp/test_recorder.log", 0, 14,
+    0.3, 0.74, 100, 1, 0.3, recorder = data_recorder, seed = seed)
+    for i in range(steps):
+        beacon_model.step()
+    data_recorder.close()
+    return data_recorder
+
+def test_ownership_does_not_depend_on_interval():
+    every_block = run_recorded(1).to_dataframe("ownership")
+    sampled = run_recorded(5).to_dataframe("ownership")
+    assert len(sampled) == len(every_block)
+    assert sampled["agent_id"].nunique() == every_block["agent_id"].nunique()
+    assert np.array_equal(sampled["seats"].to_numpy(), every_block["seats"].to_numpy())
+
+def test_sampled_tables_follow_interval():
+    steps = run_recorded(5, steps = 100).to_dataframe("group")["step"].unique()
+    assert np.all(steps % 5 == 0)
+
+def test_default_directory_is_flushed_to_disk():
+    data_recorder = run_recorded(1, steps = 100)
+    table = data_recorder.table("ownership")
+    assert table.num_chunks > 0
+    assert table.fill < table.chunk_size
+    assert len(recorder.load_recording(data_recorder.directory)["ownership"]) == table.num_rows
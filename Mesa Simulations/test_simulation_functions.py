@@ -0,0 +1,15 @@
+import numpy as np
+import analysis
+import simulation_functions
+
+
+def test_rare_event_probabilities_match_beacon_analysis():
+    # a non-rare setting: 200 one-ticket nodes, 120 of them malicious
+    ticket_distr = np.ones(200, dtype=np.int64)
+    malicious = np.arange(200) < 120
+    estimates = simulation_functions.rare_event_probabilities(ticket_distr, malicious, 20, 10, 0.3, 0.2,
+    400000, seed = 1)
+    exact = analysis.Beacon_Analysis(200, 0.6, 20, 10, 0.3, 0.2)
+    for event, probability in (("compromised", exact.compromised()), ("sigfail", exact.sigfail()),
+    ("lynchpinned", exact.lynchpinned())):
+        assert abs(estimates[event]["estimate"] - probability) < 4 * estimates[event]["half_width"] + 1e-3, event
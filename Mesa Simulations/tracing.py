@@ -0,0 +1,86 @@
+import numpy as np
+
+# event kinds
+NODE_CONNECT = 1
+NODE_DISCONNECT = 2
+GROUP_REGISTERED = 3
+GROUP_ACTIVATED = 4
+GROUP_EXPIRED = 5
+SIGNATURE_STARTED = 6
+SIGNATURE_COMPLETED = 7
+
+EVENT_NAMES = {NODE_CONNECT : "node connect",
+NODE_DISCONNECT : "node disconnect",
+GROUP_REGISTERED : "group registered",
+GROUP_ACTIVATED : "group activated",
+GROUP_EXPIRED : "group expired",
+SIGNATURE_STARTED : "signature started",
+SIGNATURE_COMPLETED : "signature completed"}
+
+# one fixed-size record per event; related is the group of a signature, -1 otherwise
+EVENT_DTYPE = np.dtype([("block", np.int64), ("kind", np.uint8), ("agent", np.int64), ("related", np.int64)])
+
+
+class Event_Tracer():
+    """ Typed event trace kept in a preallocated ring buffer.
+    When the buffer is full the oldest events are overwritten and counted in dropped.
+    A model only pays for tracing when it is given a tracer (Beacon_Model(..., tracer=...)) """
+    def __init__(self, capacity = 1 << 20):
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=EVENT_DTYPE)
+        self.position = 0 # index of the next record
+        self.recorded = 0 # total events ever recorded
+        self.dropped = 0
+
+    def record(self, block, kind, agent, related = -1):
+        self.buffer[self.position] = (block, kind, agent, related)
+        self.position = (self.position + 1) % self.capacity
+        self.recorded += 1
+        if self.recorded > self.capacity:
+            self.dropped += 1
+
+    def record_many(self, block, kind, agents, related = -1):
+        """ records one event per agent id in a single batched write """
+        agents = np.asarray(agents)
+        total = len(agents)
+        if total == 0:
+            return
+        agents = agents[-self.capacity:] # only the newest events fit when a batch exceeds the buffer
+        count = len(agents)
+        indexes = (self.position + np.arange(count)) % self.capacity
+        self.buffer["block"][indexes] = block
+        self.buffer["kind"][indexes] = kind
+        self.buffer["agent"][indexes] = agents
+        self.buffer["related"][indexes] = related
+        self.position = (self.position + count) % self.capacity
+        self.recorded += total
+        self.dropped = max(0, self.recorded - self.capacity)
+
+    def events(self):
+        """ the events still in the buffer, oldest first """
+        if self.recorded < self.capacity:
+            return self.buffer[0:self.position].copy()
+        return np.concatenate([self.buffer[self.position:], self.buffer[0:self.position]])
+
+    def export(self, path):
+        # compact binary trace: the raw event records
+        np.save(path, self.events())
+
+
+def load_trace(path):
+    return np.load(path)
+
+def agent_timelines(events):
+    """ rebuilds every agent's timeline from a trace: agent id -> list of (block, event name, related) """
+    timelines = {}
+    for block, kind, agent, related in events.tolist():
+        timelines.setdefault(agent, []).append((block, EVENT_NAMES[kind], related))
+    return timelines
+
+def replay(events):
+    """ yields (block, events of that block) in order, for stepping through a trace offline """
+    if len(events) == 0:
+        return
+    boundaries = np.flatnonzero(np.diff(events["block"])) + 1
+    for block_events in np.split(events, boundaries):
+        yield int(block_events["block"][0]), block_events